@@ -1,12 +1,17 @@
-from flask import request, abort, g
+from flask import request, abort, g, Response
 import urllib.parse as url_parser
 import uuid
 import time
 import base64
 import os
+import json
+import math
+from itertools import islice
+from functools import partial
 from collections.abc import Mapping
 import jwt
-from threading import Thread, Lock, Event
+from threading import Thread, Lock, Condition, BoundedSemaphore
+from concurrent.futures import Future
 
 from pagdDB_interface import PagdDBInterface
 from subject_interface import SubjectInterface
@@ -15,68 +20,129 @@ SECRET_KEY = base64.b64decode(os.environ["JWT_SECRET_KEY"].encode("utf-8")) # de
 
 # Settings
 TOKEN_VALIDITY = 30*24*60*60*1000 # 30 days in milliseconds
-BULK_PROCESSING_TIMEOUT = 1
-CONCURRENT_REQUEST_DIFF = 0.2
+BULK_MAX_SIZE = 256 # maximum number of reports inserted in one batch
+BULK_MAX_DELAY = 0.005 # maximum time in seconds a report waits in the queue before its batch is inserted
+BATCH_MAX_REPORTS = 100 # maximum number of reports accepted by the batch endpoint
+PAGE_SIZE = 1000 # number of reports or gunshots returned by a search if no limit is given
+PAGE_MAX_SIZE = 10000 # maximum number of reports or gunshots returned by a search, larger results must be paged or streamed
+STREAM_CHUNK_ROWS = 500 # rows encoded and sent together when streaming a search result
+STREAM_MAX_CONCURRENT = 4 # streamed searches at a time, each holding a database connection until its client has read it, further streams are rejected
 
-def create_routes(app, db: PagdDBInterface, gunshot_subject: SubjectInterface):
+def create_routes(app, db: PagdDBInterface, gunshot_subject: SubjectInterface, metrics = None):
     """ Define the endpoints for the API.
     @param app (Flask): the Flask app that handles all routes
     @param db (PagdDBInterface): an implementation of a PAGD database for storing and retrieving data
     @param gunshot_subject (SubjectInterface): an implementation of a subject for letting other apps know about changes (observer pattern)
+    @param metrics (dict, optional): named functions returning runtime statistics to expose at /api/metrics
     """
+    metrics = metrics or {}
+    app.json.sort_keys = False # Keep the column order of the rows rather than sorting the keys of every object in large responses
 
     class ReportProcessor:
-        def __init__(self):
-            self.report_queue = []
-            self.results = {}
+        """Group-commit queue for incoming reports. Requests are collected by a single writer thread and
+        inserted together with one call to add_reports, either when the batch is full or when the oldest
+        queued report has waited BULK_MAX_DELAY seconds. Each request waits on its own future.
+        """
+        def __init__(self, max_size = BULK_MAX_SIZE, max_delay = BULK_MAX_DELAY):
+            self.max_size = max_size
+            self.max_delay = max_delay
+            self.report_queue = [] # (report values, future, time.monotonic() when queued) in the order they arrived
             self.lock = Lock()
-            self.event = Event()
-            self.last_request_time = 0
-        
-        def _bulk_process_requests(self):
-            time.sleep(BULK_PROCESSING_TIMEOUT)
-            with self.lock:
-                db_result = db.add_reports(self.report_queue)
-                # Create a dictionary of reports for each client
-                if isinstance(db_result, list):
-                    for r in db_result:
-                        client_id = r.get("client_id")
-                        self.results[client_id] = r
-                else:
-                    client_id = db_result.get("client_id")
-                    self.results[client_id] = db_result
-                
-                self.report_queue = [] # Clear the queue
-                self.event.set() # Threads may proceed to access the result
-            return self.results
-        
+            self.not_empty = Condition(self.lock)
+            self.writer = Thread(target=self._process_queue, daemon=True)
+            self.writer.start()
+
+        def _next_batch(self):
+            with self.not_empty:
+                while not self.report_queue:
+                    self.not_empty.wait()
+                # Keep collecting until the batch is full or the deadline of the oldest report is reached. Reports left
+                # over from a full batch are already waiting, so their deadline is not moved
+                deadline = self.report_queue[0][2] + self.max_delay
+                while len(self.report_queue) < self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+                batch = self.report_queue[:self.max_size]
+                self.report_queue = self.report_queue[self.max_size:]
+            return batch
+
+        def _process_queue(self):
+            while True:
+                batch = self._next_batch()
+                values = [report for report, _, _ in batch]
+                try:
+                    db_result = db.add_reports(values)
+                    if len(db_result) != len(batch):
+                        raise RuntimeError(f"expected {len(batch)} inserted reports, got {len(db_result)}")
+                except Exception as e:
+                    for _, future, _ in batch:
+                        future.set_exception(e)
+                    continue
+                # Rows are returned in insertion order, so each request gets its own row back
+                for (_, future, _), r in zip(batch, db_result):
+                    future.set_result(r)
+
         def handle_request(self, timestamp, coord_lat, coord_long, coord_alt, gun, client_id):
-            current_time = time.time()
-            # Process concurrent reports in bulk
-            if current_time - self.last_request_time <= CONCURRENT_REQUEST_DIFF:
-                with self.lock:
-                    if not self.report_queue: # Start collecting reports
-                        self.report_queue.append((timestamp, coord_lat, coord_long, coord_alt, gun, client_id))
-                        Thread(target=self._bulk_process_requests).start()
-                    else: # Keep filling the queue
-                        self.report_queue.append((timestamp, coord_lat, coord_long, coord_alt, gun, client_id))
-                # Wait for the bulk insert to finish
-                self.event.wait()
-                with self.lock:
-                    try:
-                        result = self.results.pop(client_id)
-                    except KeyError as e: # Unable to find the report. Error in receiving or processing?
-                        print(f"ERROR: Unable to find the report.\n\t{str(e)}")
-                        return None
-            else: # Process individually
-                result = db.add_report(timestamp, coord_lat, coord_long, coord_alt, gun, client_id)
-            
-            # Prepare for the next request
-            with self.lock:
-                self.event.clear()
-                self.last_request_time = time.time()
-            return result
+            future = Future()
+            with self.not_empty:
+                self.report_queue.append(((timestamp, coord_lat, coord_long, coord_alt, gun, client_id), future, time.monotonic()))
+                self.not_empty.notify()
+            try:
+                return future.result()
+            except Exception as e: # Error in processing the batch
+                print(f"ERROR: Unable to add the report.\n\t{str(e)}")
+                return None
+
+
+    # A streamed search holds a pooled connection for as long as its client takes to read it, so only a few may run
+    # at a time and slow clients can not take the connections needed to add reports
+    streams = BoundedSemaphore(STREAM_MAX_CONCURRENT)
+
+    def page_arguments():
+        """Read the keyset pagination arguments of a search request. Without after_id and limit the whole result is
+        returned, as before paging was added, so clients that do not read X-Next-After-Id still get every result
+        @return (tuple): the ID to start after, the maximum number of results (None for all) and whether to stream
+        """
+        after_id = request.args.get("after_id", type=int)
+        limit = request.args.get("limit", type=int)
+        stream = request.args.get("stream", "false").lower() in ("1", "true")
+        if limit is not None and limit <= 0:
+            abort(400, "limit must be at least 1")
+        if not stream and (limit is not None or after_id is not None):
+            limit = min(limit or PAGE_SIZE, PAGE_MAX_SIZE)
+        return after_id or 0, limit, stream
+
+    def page_response(search, key, after_id, limit, stream):
+        """Respond with a page of results, with the header X-Next-After-Id set to the after_id of the next page if
+        the page is full, or stream the results as newline delimited JSON
+        @param search (function): the search, called with after_id, limit and stream
+        @param key (string): the ID the results are ordered by
+        """
+        if stream:
+            if not streams.acquire(blocking=False):
+                abort(503, f"too many streamed searches, at most {STREAM_MAX_CONCURRENT} are allowed at a time")
+            # The search runs when the body is first iterated, so a response that is closed without being iterated,
+            # e.g. for a HEAD request, never takes a database connection
+            response = Response(ndjson_chunks(search, after_id, limit), mimetype="application/x-ndjson")
+            response.call_on_close(streams.release)
+            return response
+        result = search(after_id, limit, stream)
+        headers = {"X-Next-After-Id": result[-1][key]} if limit is not None and len(result) == limit else {}
+        return result, headers
 
+    def ndjson_chunks(search, after_id, limit):
+        """Run a streamed search and encode its rows as newline delimited JSON, a chunk of STREAM_CHUNK_ROWS rows at a time"""
+        rows = search(after_id, limit, True)
+        try:
+            while True:
+                chunk = list(islice(rows, STREAM_CHUNK_ROWS))
+                if not chunk:
+                    break
+                yield "".join([json.dumps(row, default=str) + "\n" for row in chunk])
+        finally:
+            rows.close() # Release the database connection also if the client disconnected
 
     @app.before_request
     def auth():
@@ -175,26 +241,90 @@ def create_routes(app, db: PagdDBInterface, gunshot_subject: SubjectInterface):
         if result is not None:
             report_id = result.get("report_id")
             report = (report_id, (coord_lat, coord_long, coord_alt), timestamp, gun, g.client_id)
-            gunshot_subject.notify(report)
+            try:
+                gunshot_subject.notify(report)
+            except ConnectionError as e: # The correlator is unavailable
+                print(f"ERROR: Unable to correlate report {report_id}.\n\t{str(e)}")
+                abort(503, description=f"Report {report_id} was added but could not be correlated.")
 
         return result or abort(500, description="Failed to add the report.")
 
+    @app.route("/api/reports/batch", methods = ["POST"])
+    def add_reports():
+        """Add multiple reports to the database in one request, e.g. detections buffered by the client
+        @param reports (list[json]): a list of reports, each with the same parameters as POST /api/reports
+        @return (json): a list with one result per report in the same order, either the newly added report or an error message
+        """
+        data = request.get_json()
+        if isinstance(data, Mapping):
+            data = data.get("reports")
+        if not isinstance(data, list):
+            abort(400, "expected a list of reports")
+        if len(data) > BATCH_MAX_REPORTS:
+            abort(400, f"too many reports, at most {BATCH_MAX_REPORTS} are allowed per batch")
+
+        results = [None] * len(data)
+        indices = []
+        values = []
+        for i, item in enumerate(data):
+            if not isinstance(item, Mapping):
+                results[i] = {"error": "expected a report object"}
+                continue
+            report = tuple(item.get(key) for key in ("timestamp", "coord_lat", "coord_long", "coord_alt", "gun"))
+            if None in report:
+                results[i] = {"error": "missing required parameters"}
+                continue
+            if type(report[0]) is not int:
+                results[i] = {"error": "timestamp must be an integer"}
+                continue
+            indices.append(i)
+            values.append(report + (g.client_id,))
+
+        if values:
+            # Insert and let the observers process the reports in the order they were heard
+            order = sorted(range(len(values)), key=lambda j: values[j][0])
+            indices, values = [indices[j] for j in order], [values[j] for j in order]
+            try:
+                db_result = db.add_reports(values)
+            except Exception as e:
+                print(f"ERROR: Unable to add the reports.\n\t{str(e)}")
+                abort(500, description="Failed to add the reports.")
+
+            reports = []
+            for i, r, (timestamp, coord_lat, coord_long, coord_alt, gun, client_id) in zip(indices, db_result, values):
+                results[i] = r
+                reports.append((r.get("report_id"), (coord_lat, coord_long, coord_alt), timestamp, gun, client_id))
+            try:
+                gunshot_subject.notify_batch(reports)
+            except ConnectionError as e: # The correlator is unavailable
+                print(f"ERROR: Unable to correlate {len(reports)} reports.\n\t{str(e)}")
+                abort(503, description=f"{len(reports)} reports were added but could not be correlated.")
+
+        return results
+
     @app.route("/api/reports", methods = ["GET"])
     def get_report():
         """Search for a report in the database
         @param report_id (int, optional): the report ID
         @param time_from (int, optional): UNIX timestamp of the start of the range
         @param time_to (int, optional): UNIX timestamp of the end of the range
+        @param after_id (int, optional): only return reports with a greater report ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of reports to return
+        @param stream (bool, optional): return all matching reports as newline delimited JSON
         @return (json): a JSON object with the result
         """
         report_id = request.args.get("id")
         time_from = request.args.get("time_from", type=int)
         time_to   = request.args.get("time_to",   type=int)
+        after_id, limit, stream = page_arguments()
 
         if time_from is not None and time_to is not None:
-            return db.get_report_range(time_from, time_to)
+            search = partial(db.get_report_range, time_from, time_to)
+        elif report_id is None:
+            search = partial(db.get_report, None)
         else:
             return db.get_report(report_id)
+        return page_response(search, "report_id", after_id, limit, stream)
 
     # TODO: separate this into "/api/gunshots/temporary"
     @app.route("/api/gunshots", methods = ["POST"])
@@ -261,23 +391,45 @@ def create_routes(app, db: PagdDBInterface, gunshot_subject: SubjectInterface):
         @param gunshot_id (int, optional): the gunshot ID
         @param time_from (int, optional): UNIX timestamp of the start of the range
         @param time_to (int, optional): UNIX timestamp of the end of the range
+        @param coord_lat (float, optional): the latitude coordinate of the center of a radius search
+        @param coord_long (float, optional): the longitude coordinate of the center of a radius search
+        @param radius (float, optional): only return gunshots within this many meters of the center
+        @param min_lat, min_long, max_lat, max_long (float, optional): only return gunshots within this box
+        @param after_id (int, optional): only return gunshots with a greater gunshot ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of gunshots to return
+        @param stream (bool, optional): return all matching gunshots as newline delimited JSON
         @return (json): a JSON object with the result
         """
         gunshot_id = request.args.get("id")
         time_from = request.args.get("time_from", type=int)
         time_to = request.args.get("time_to", type=int)
+        center = (request.args.get("coord_lat", type=float), request.args.get("coord_long", type=float))
+        radius = request.args.get("radius", type=float)
+        box = tuple(request.args.get(name, type=float) for name in ("min_lat", "min_long", "max_lat", "max_long"))
+        after_id, limit, stream = page_arguments()
+        if any(value is not None and not math.isfinite(value) for value in center + (radius,) + box):
+            abort(400, "coordinates and radius must be finite numbers") # The WKT of the box is built from them
 
         if gunshot_id:
             return db.get_gunshot_by_id(gunshot_id)
+        elif radius is not None:
+            if None in center or radius < 0:
+                abort(400, "a radius search requires coord_lat, coord_long and a radius of at least 0")
+            search = partial(db.get_gunshots_by_radius, *center, radius, time_from, time_to)
+        elif any(bound is not None for bound in box):
+            if None in box or box[0] > box[2] or box[1] > box[3]:
+                abort(400, "a box search requires min_lat, min_long, max_lat and max_long, with each minimum at most its maximum")
+            search = partial(db.get_gunshots_by_bounding_box, *box, time_from, time_to)
         elif time_from and time_to:
-            return db.get_gunshots_by_timestamp(time_from, time_to)
+            search = partial(db.get_gunshots_by_timestamp, time_from, time_to)
         elif time_from:
             time_now = time.time() * 1000
-            return db.get_gunshots_by_timestamp(time_from, time_now)
+            search = partial(db.get_gunshots_by_timestamp, time_from, time_now)
         elif time_to:
-            return db.get_gunshots_by_timestamp(0, time_to)
-        
-        return db.get_all_gunshots()
+            search = partial(db.get_gunshots_by_timestamp, 0, time_to)
+        else:
+            search = db.get_all_gunshots
+        return page_response(search, "gunshot_id", after_id, limit, stream)
 
     @app.route("/api/gunshots/latest", methods = ["GET"])
     def get_latest_gunshot_id():
@@ -285,3 +437,10 @@ def create_routes(app, db: PagdDBInterface, gunshot_subject: SubjectInterface):
         @return (int): the most recent gunshot ID
         """
         return db.get_latest_gunshot_id()
+
+    @app.route("/api/metrics", methods = ["GET"])
+    def get_metrics():
+        """Get runtime statistics of the server, e.g. the observer dispatch queue
+        @return (json): a JSON object with the statistics of each component
+        """
+        return {name: collect() for name, collect in metrics.items()}
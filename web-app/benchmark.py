@@ -0,0 +1,832 @@
+from gunshot import Position, GunshotEvent, GunshotReport, MAX_DISTANCE, MAX_TIME_DIFF, SPEED_OF_SOUND_MS
+from gunshot import enu_to_geodetic, fast_distance, solve_tdoa
+from event_index import EventIndex
+from localization import LocalizationService
+from gunshot_subject import GunshotSubject
+from gunshot_observer import GunshotObserver
+from notifications import NotificationDispatcher, FakeBackend, LATENCY_BUCKETS
+from push import GunshotFeed, PushServer, STREAM_PATH
+from pagdDB import PagdDB
+from database import Database
+from flask import Flask
+import numpy as np
+from test_localization import Test
+import os, time, json, base64, random, asyncio, argparse, statistics, threading, tracemalloc, multiprocessing, queue, tempfile
+from threading import Thread
+import jwt
+
+def random_events(amount, reports_per_event = 3):
+    """Create events spread over Sweden with a few reports each, all within the same live time window"""
+    events = []
+    start_timestamp = int(time.time() * 1000)
+    for i in range(amount):
+        origin = Position(random.uniform(55, 69), random.uniform(11, 24), 0)
+        timestamp = start_timestamp + random.randrange(0, int(MAX_TIME_DIFF))
+        reports = [GunshotReport(origin.shift(random.uniform(0, 500), theta=random.uniform(0, 360), phi=0),
+                                 timestamp + random.randrange(0, 100), "AK-47", f"{i}-{j}") for j in range(reports_per_event)]
+        event = GunshotEvent(reports[0])
+        event.event_id = i
+        for report in reports[1:]:
+            event.add_report(report)
+        events.append(event)
+    return events
+
+def bench_matching(args):
+    """Cost of finding the events a new report fits, scanning all events versus using the spatio-temporal index"""
+    print(f"{'events':>8} {'scan (ms/report)':>18} {'index (ms/report)':>18}")
+    for amount in args.events:
+        events = random_events(amount)
+        index = EventIndex()
+        for event in events:
+            for report in event.gunshots:
+                index.add(event, report)
+        probes = [GunshotReport(random.choice(events).gunshots[0].position.shift(random.uniform(0, 500), theta=random.uniform(0, 360), phi=0),
+                                random.choice(events).gunshots[0].timestamp, "AK-47", "probe") for _ in range(args.reports)]
+
+        scan_start = time.perf_counter()
+        scanned = [[event for event in events if event.fits(probe)] for probe in probes]
+        scan_time = time.perf_counter() - scan_start
+
+        index_start = time.perf_counter()
+        indexed = [[event for event in index.candidates(probe) if event.fits(probe)] for probe in probes]
+        index_time = time.perf_counter() - index_start
+
+        assert all({e.event_id for e in s} == {e.event_id for e in i} for s, i in zip(scanned, indexed))
+        print(f"{amount:>8} {scan_time / args.reports * 1000:>18.3f} {index_time / args.reports * 1000:>18.3f}")
+
+def pairwise_fits(event, report):
+    """Check a report against every report of the event, like GunshotEvent.fits does when it can not decide from the bounds"""
+    if event.reports is not None: # No columns are kept for a few reports
+        coordinates, timestamps = np.array([gs.position.v for gs in event.reports]), np.array([gs.timestamp for gs in event.reports])
+    else:
+        coordinates, timestamps = event.coordinates[:event.size], event.timestamps[:event.size]
+    distances = fast_distance(coordinates, report.position.v)
+    return bool(report.weapontype == event.weapontype and
+                np.any(np.abs(timestamps - report.timestamp) < MAX_TIME_DIFF) and
+                np.all(distances < MAX_DISTANCE*2))
+
+def bench_fits(args):
+    """Cost of checking whether a report fits an event with many reports, using the bounds of the event versus pairwise"""
+    print(f"{'reports/event':>14} {'pairwise (us/check)':>20} {'bounds (us/check)':>18}")
+    for reports_per_event in args.reports:
+        events = []
+        for _ in range(args.events):
+            origin = Position(random.uniform(55, 69), random.uniform(11, 24), 0)
+            timestamp = int(time.time() * 1000)
+            # A burst of shots heard by clients up to MAX_DISTANCE away
+            reports = [GunshotReport(origin.shift(random.uniform(0, MAX_DISTANCE), theta=random.uniform(0, 360), phi=0),
+                                     timestamp + random.randrange(0, 3000), "AK-47", f"client-{j % 20}") for j in range(reports_per_event)]
+            event = GunshotEvent(reports[0])
+            for report in reports[1:]:
+                event.add_report(report)
+            events.append((event, origin, timestamp))
+        probes = [(event, GunshotReport(origin.shift(random.uniform(0, 4*MAX_DISTANCE), theta=random.uniform(0, 360), phi=0),
+                                        timestamp + random.uniform(-2*MAX_TIME_DIFF, 3000 + 2*MAX_TIME_DIFF), "AK-47", "probe"))
+                  for event, origin, timestamp in events for _ in range(args.probes)]
+
+        pairwise_start = time.perf_counter()
+        pairwise = [pairwise_fits(event, probe) for event, probe in probes]
+        pairwise_time = time.perf_counter() - pairwise_start
+
+        bounds_start = time.perf_counter()
+        bounds = [event.fits(probe) for event, probe in probes]
+        bounds_time = time.perf_counter() - bounds_start
+
+        assert pairwise == bounds
+        print(f"{reports_per_event:>14} {pairwise_time / len(probes) * 1e6:>20.1f} {bounds_time / len(probes) * 1e6:>18.1f}")
+
+def bench_memory(args):
+    """Memory per live report of the events, including the events themselves"""
+    print(f"{'reports/event':>14} {'bytes/report':>13}")
+    for reports_per_event in args.reports:
+        tracemalloc.start()
+        events = random_events(args.events, reports_per_event)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{reports_per_event:>14} {size / (args.events * reports_per_event):>13.0f}")
+        del events
+
+def simulated_events(amount, clients, timestamp_error, got, sector = 360):
+    """Simulate gunshots heard by clients using the local simulation of test_localization"""
+    simulations = []
+    while len(simulations) < amount:
+        test = Test(int(time.time() * 1000), local=True, max_timestamp_error=timestamp_error, client_amount=(clients, clients), got=got,
+                    client_bearing=(0, sector))
+        test.run(1)
+        first_reports = list(test.event._get_first_reports())
+        if len(first_reports) >= 4:
+            simulations.append((test.gunshot_pos, [r.position for r in first_reports], [r.timestamp for r in first_reports]))
+    return simulations
+
+def bench_localization(args):
+    """Wall time and error in meters of the TDOA solvers on simulated gunshots"""
+    simulations = simulated_events(args.simulations, args.clients, args.timestamp, args.got, args.sector)
+    solvers = [(method, method, True) for method in args.methods]
+    if "lm" in args.methods: # Also compare against starting from the midpoint
+        solvers.insert(args.methods.index("lm"), ("lm-midpoint", "lm", False))
+    print(f"{'method':>12} {'solved':>8} {'mean (ms)':>10} {'p95 (ms)':>10} {'evaluations':>12} {'median error (m)':>17} {'p95 error (m)':>14}")
+    for name, method, closed_form_guess in solvers:
+        times, errors, evaluations = [], [], []
+        for gunshot_pos, positions, timestamps in simulations:
+            stats = {}
+            start = time.perf_counter()
+            pos, _ = Position.tdoa(positions, timestamps, method=method, closed_form_guess=closed_form_guess, stats=stats)
+            times.append((time.perf_counter() - start) * 1000)
+            evaluations.append(stats["evaluations"])
+            if pos is not None:
+                errors.append(gunshot_pos.distance(pos))
+        errors.sort()
+        times.sort()
+        print(f"{name:>12} {len(errors):>8} {statistics.mean(times):>10.2f} {times[int(len(times) * 0.95)]:>10.2f} {statistics.mean(evaluations):>12.1f} "
+              f"{statistics.median(errors) if errors else float('nan'):>17.2f} {errors[int(len(errors) * 0.95)] if errors else float('nan'):>14.2f}")
+
+def synthetic_events(amount, clients = (4, 8), timestamp_error = 100, position_error = 15, seed = 0):
+    """Vectorized simulation of gunshots with the same parameters as test_localization, fast enough for large batches"""
+    rng = np.random.default_rng(seed)
+    events, gunshots = [], []
+    for _ in range(amount):
+        n = rng.integers(clients[0], clients[1] + 1)
+        gunshot = np.array([rng.uniform(54, 69), rng.uniform(10, 26), 0])
+        bearing, distance = rng.uniform(0, 2 * np.pi, n), rng.uniform(50, 500, n)
+        true_enu = np.column_stack((distance * np.sin(bearing), distance * np.cos(bearing), rng.uniform(-10, 10, n)))
+        gps_error = rng.uniform(0, position_error, n)
+        gps_bearing = rng.uniform(0, 2 * np.pi, n)
+        gps_enu = true_enu + np.column_stack((gps_error * np.sin(gps_bearing), gps_error * np.cos(gps_bearing), np.zeros(n)))
+        start_timestamp = int(time.time() * 1000)
+        times = start_timestamp + (np.linalg.norm(true_enu, axis=1) / SPEED_OF_SOUND_MS).astype(int) + rng.integers(0, timestamp_error, n)
+        events.append((enu_to_geodetic(gps_enu, gunshot), times.astype(float)))
+        gunshots.append(gunshot)
+    return events, np.array(gunshots)
+
+def bench_batch(args):
+    """Throughput of solving many events at once, one by one versus batched"""
+    events, gunshots = synthetic_events(args.events)
+    print(f"{'solver':>16} {'events/min':>12} {'solved':>8} {'median error (m)':>17}")
+
+    start = time.perf_counter()
+    single = [solve_tdoa(receivers, times)[0] for receivers, times in events[:args.single]]
+    elapsed = time.perf_counter() - start
+    solved = [i for i, position in enumerate(single) if position is not None]
+    errors = fast_distance(np.array([single[i] for i in solved]), gunshots[solved])
+    print(f"{'one by one':>16} {len(single) / elapsed * 60:>12.0f} {len(solved):>8} {np.median(errors):>17.2f}")
+
+    for processes in args.processes:
+        service = LocalizationService(processes)
+        start = time.perf_counter()
+        positions, _, converged = service.solve_batch(events)
+        elapsed = time.perf_counter() - start
+        service.close()
+        errors = fast_distance(positions[converged], gunshots[converged])
+        print(f"{f'batch ({processes} proc)':>16} {len(events) / elapsed * 60:>12.0f} {int(converged.sum()):>8} {np.median(errors):>17.2f}")
+
+class MemoryDB:
+    """Stand-in for PagdDB used by the observers, sending the gunshot report relations to a queue"""
+    def __init__(self, relations, counter, recent_reports = ()):
+        self.relations = relations
+        self.counter = counter
+        self.recent_reports = recent_reports
+
+    def get_recent_reports(self, time_from, limit):
+        return [row for row in self.recent_reports if row[1] >= time_from][-limit:]
+
+    def reserve_ids(self, name, amount):
+        with self.counter.get_lock():
+            self.counter.value += amount
+            return self.counter.value - amount
+
+    def add_temp_gunshot(self, gunshot_id, report_id, gun):
+        self.relations.put((gunshot_id, report_id))
+
+    def add_gunshot(self, gunshot_id, report_id, timestamp, coord_lat, coord_long, coord_alt, gun, shots_fired):
+        self.relations.put((gunshot_id, report_id))
+
+    def add_gunshot_report_relation(self, gunshot_id, report_id):
+        self.relations.put((gunshot_id, report_id))
+
+    def add_gunshot_report_relations(self, gunshot_id, report_ids):
+        for report_id in report_ids:
+            self.relations.put((gunshot_id, report_id))
+
+    def update_gunshot(self, gunshot_id, timestamp, coord_lat, coord_long, coord_alt, gun, shots_fired):
+        pass
+
+def quiet_observer(subject, db, **kwargs):
+    """Observer notifying a fake messaging backend instead of the devices. The reports are replayed with past
+    timestamps, so events are only expired by the reports rather than by the current time"""
+    kwargs.setdefault("expiry_interval", None)
+    return GunshotObserver(subject, db, notifier=NotificationDispatcher(FakeBackend()), **kwargs)
+
+def memory_observer(subject, relations, counter):
+    return quiet_observer(subject, MemoryDB(relations, counter), snapshot_path=None, recover=False)
+
+def scenario_reports(amount, clients, interval = 200):
+    """Reports of gunshots spread over Sweden and over time, in the order of their timestamps
+    @param interval: milliseconds between the gunshots"""
+    reports = []
+    start_timestamp = int(time.time() * 1000) - amount * interval
+    for i in range(amount):
+        gunshot = Position(random.uniform(55, 69), random.uniform(11, 24), 0)
+        timestamp = start_timestamp + i * interval
+        for j in range(clients):
+            position = gunshot.shift(random.uniform(50, 500), theta=random.uniform(0, 360), phi=0)
+            heard = timestamp + int(gunshot.distance(position) / SPEED_OF_SOUND_MS) + random.randrange(0, 100)
+            reports.append((len(reports) + 1, position.v, heard, "AK-47", f"{i}-{j}"))
+    return sorted(reports, key=lambda report: report[2])
+
+def send_reports(address, reports, batch_size, barrier, first_timestamp, speedup):
+    """API worker process sending its reports to the correlator, as they would arrive speedup times faster than in real time.
+    Workers can not run ahead of each other, which would make the correlator evict events before the reports of slower workers arrive"""
+    from correlator import CorrelatorClient
+    client = CorrelatorClient(address)
+    client.notify_batch([]) # Connect before starting
+    barrier.wait()
+    start_time = time.perf_counter()
+    for start in range(0, len(reports), batch_size):
+        batch = reports[start:start + batch_size]
+        time.sleep(max(0, (batch[-1][2] - first_timestamp) / 1000 / speedup - (time.perf_counter() - start_time)))
+        client.notify_batch(batch)
+    client.close()
+
+def collect_relations(relations, groups):
+    for gunshot_id, report_id in iter(relations.get, None):
+        groups.setdefault(gunshot_id, set()).add(report_id)
+
+def bench_correlator(args):
+    """Throughput of correlating reports in this process versus in a partitioned correlator fed by several API workers,
+    and whether the partitioned correlator groups the reports into the same gunshots"""
+    os.environ.setdefault("CORRELATOR_AUTHKEY", base64.b64encode(os.urandom(32)).decode("utf-8")) # inherited by the spawned workers
+    from correlator import Correlator
+    reports = scenario_reports(args.events, args.clients)
+    context = multiprocessing.get_context("spawn")
+    offered = len(reports) / ((reports[-1][2] - reports[0][2]) / 1000 / args.speedup)
+    print(f"API workers send {offered:.0f} reports/s, the single process correlates them as fast as it can")
+    print(f"{'correlator':>20} {'reports/s':>10} {'gunshots':>9} {'same as single':>15}")
+    baseline = None
+    for partitions in [0] + args.partitions:
+        relations, counter = context.Queue(), context.Value("q", 1)
+        groups = {}
+        collector = Thread(target=collect_relations, args=(relations, groups))
+        collector.start()
+        start = time.perf_counter()
+        if partitions == 0: # In the process of the API
+            subject = GunshotSubject()
+            memory_observer(subject, relations, counter)
+            for i in range(0, len(reports), args.batch):
+                subject.notify_batch(reports[i:i + args.batch])
+        else:
+            correlator = Correlator(("localhost", 0), partitions, memory_observer, (relations, counter))
+            Thread(target=correlator.serve_forever, daemon=True).start()
+            barrier = context.Barrier(args.workers + 1)
+            workers = [context.Process(target=send_reports, args=(correlator.address, reports[w::args.workers], args.batch, barrier,
+                                                                  reports[0][2], args.speedup))
+                       for w in range(args.workers)]
+            for worker in workers:
+                worker.start()
+            barrier.wait()
+            start = time.perf_counter() # Not counting the start of the processes
+            for worker in workers:
+                worker.join()
+            while sum(correlator.metrics()["routed"]) < len(reports):
+                time.sleep(0.01)
+            correlator.close()
+        elapsed = time.perf_counter() - start
+        relations.put(None)
+        collector.join()
+
+        gunshots = {frozenset(group) for group in groups.values()}
+        baseline = baseline or gunshots
+        name = "single" if partitions == 0 else f"{partitions} partitions"
+        print(f"{name:>20} {len(reports) / elapsed:>10.0f} {len(gunshots):>9} {len(gunshots & baseline) / len(baseline):>15.1%}")
+
+def bench_recovery(args):
+    """Time to save the live events and to recover them on start, from the snapshot or from the recent reports in the database"""
+    print(f"{'events':>8} {'reports':>8} {'snapshot (kB)':>14} {'save (ms)':>10} {'lock (ms)':>10} {'from snapshot (ms)':>19} {'from database (ms)':>19}")
+    for amount in args.events:
+        # Gunshots heard during the last second, so that every event is still live
+        reports = scenario_reports(amount, args.clients, interval=1000 / amount)
+        relations, counter = queue.Queue(), multiprocessing.Value("q", 1)
+        observer = quiet_observer(GunshotSubject(), MemoryDB(relations, counter), snapshot_path=None, recover=False)
+        observer.update_batch(reports)
+        gunshot_ids = {}
+        while not relations.empty():
+            gunshot_id, report_id = relations.get_nowait()
+            gunshot_ids[report_id] = gunshot_id
+        rows = [(report_id, timestamp, *position, gun, client_id, gunshot_ids.get(report_id))
+                for report_id, position, timestamp, gun, client_id in reports]
+
+        with tempfile.TemporaryDirectory() as directory:
+            observer.snapshot_path = os.path.join(directory, "events.snapshot")
+            observer.snapshot()
+            metrics = observer.metrics()
+            size = os.path.getsize(observer.snapshot_path)
+
+            # As if restarted right after the latest report, however long correlating the reports took here
+            restarted = reports[-1][2] + 1
+            from_snapshot = quiet_observer(GunshotSubject(), MemoryDB(relations, counter, rows), snapshot_path=observer.snapshot_path, recover=False)
+            from_snapshot.recover(restarted)
+            from_snapshot.stopped.set()
+        from_database = quiet_observer(GunshotSubject(), MemoryDB(relations, counter, rows), snapshot_path=None, recover=False)
+        from_database.recover(restarted)
+
+        assert len(from_snapshot.events) == len(from_database.events) == len(observer.events)
+        print(f"{amount:>8} {len(reports):>8} {size / 1000:>14.0f} {metrics['last_snapshot_ms']:>10.1f} {metrics['last_snapshot_lock_ms']:>10.1f} "
+              f"{from_snapshot.metrics()['recovery_ms']:>19.1f} {from_database.metrics()['recovery_ms']:>19.1f}")
+
+def bench_notifications(args):
+    """Messages and requests sent to a fake messaging backend for gunshots that are updated as clients join,
+    the latency from a notification until it is sent and the time the notifying thread is blocked"""
+    print(f"{'window (ms)':>12} {'notifications':>14} {'messages':>9} {'requests':>9} {'blocked (us)':>13} {'avg latency (ms)':>17} {'p95 latency (ms)':>17}")
+    for window in args.windows:
+        backend = FakeBackend(args.latency / 1000, args.message_latency / 1000)
+        dispatcher = NotificationDispatcher(backend, window / 1000)
+        # Gunshot i is stored and then updated every interval as more clients join
+        schedule = sorted((i * args.spacing + k * args.interval, i, k) for i in range(args.gunshots) for k in range(args.updates))
+        blocked = 0.0
+        start = time.perf_counter()
+        for at, i, k in schedule:
+            time.sleep(max(0, at / 1000 - (time.perf_counter() - start)))
+            notify_start = time.perf_counter()
+            dispatcher.notify({"gunshot_id": i, "coord_lat": 57.7, "coord_long": 12.0, "timestamp": k, "shots_fired": k + 1}, k > 0)
+            blocked += time.perf_counter() - notify_start
+        dispatcher.close()
+
+        metrics = dispatcher.metrics()
+        # Upper bound of the bucket holding the 95th percentile
+        counts, p95 = list(metrics["latency_ms"].values()), float("inf")
+        for bound, cumulative in zip(LATENCY_BUCKETS, np.cumsum(counts)):
+            if cumulative >= 0.95 * sum(counts):
+                p95 = bound
+                break
+        assert len({m.data["gunshot_id"] for m in backend.messages}) == args.gunshots # Every gunshot was notified about
+        print(f"{window:>12} {metrics['notifications']:>14} {len(backend.messages):>9} {backend.requests:>9} {blocked / len(schedule) * 1e6:>13.1f} "
+              f"{metrics['avg_latency_ms']:>17.1f} {'<=' + str(p95):>17}")
+
+async def subscribe(address, path, headers = ""):
+    """Open a stream of the push server, returning the reader and writer once the response headers are read"""
+    reader, writer = await asyncio.open_connection(*address)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n{headers}\r\n".encode("latin-1"))
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    return reader, writer
+
+async def next_event(reader):
+    """Read the next event of a stream, skipping keepalive comments
+    @return (dict): the fields of the event"""
+    fields = {}
+    while True:
+        line = (await reader.readline()).decode("utf-8").rstrip("\n")
+        if line == "" and fields:
+            return fields
+        if line and not line.startswith(":"):
+            name, _, value = line.partition(": ")
+            fields[name] = value
+
+def bench_push(args):
+    """Latency from publishing a gunshot until every idle subscriber of the push server has received it,
+    the threads needed to serve them, and resuming a stream from a cursor"""
+    secret_key = os.urandom(32)
+    feed = GunshotFeed()
+    server = PushServer(feed, secret_key, ("localhost", 0))
+    token = jwt.encode({"id": "benchmark", "exp": round(time.time() * 1000) + 3600_000}, secret_key, "HS256")
+    path = f"{STREAM_PATH}?token={token}"
+    threads_before = threading.active_count()
+
+    async def run():
+        streams = await asyncio.gather(*(subscribe(server.address, path) for _ in range(args.subscribers)))
+        while server.metrics()["subscribers"] < args.subscribers:
+            await asyncio.sleep(0.01)
+        threads = threading.active_count()
+
+        latencies = []
+        for i in range(args.gunshots):
+            await asyncio.sleep(args.interval / 1000) # Subscribers are idle between gunshots
+            published = time.perf_counter()
+            feed.publish({"gunshot_id": i + 1, "coord_lat": 57.7, "coord_long": 12.0, "timestamp": i, "shots_fired": 1})
+            events = await asyncio.gather(*(next_event(reader) for reader, _ in streams))
+            latencies.append(time.perf_counter() - published)
+            assert all(json.loads(event["data"])["gunshot_id"] == i + 1 for event in events)
+
+        # Resume after the middle of the history, as EventSource does when reconnecting
+        cursor = args.gunshots // 2
+        reader, writer = await subscribe(server.address, path, f"Last-Event-ID: {cursor}\r\n")
+        resume_start = time.perf_counter()
+        resumed = [int((await next_event(reader))["id"]) for _ in range(args.gunshots - cursor)]
+        resume_time = time.perf_counter() - resume_start
+        assert resumed == list(range(cursor + 1, args.gunshots + 1))
+        for _, stream_writer in streams + [(reader, writer)]:
+            stream_writer.close()
+        return threads, latencies, resume_time, len(resumed)
+
+    threads, latencies, resume_time, resumed = asyncio.run(run())
+    server.close()
+    latencies = sorted(latency * 1000 for latency in latencies)
+    print(f"{'subscribers':>12} {'threads':>8} {'gunshots':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'max (ms)':>9}")
+    print(f"{args.subscribers:>12} {threads - threads_before + 1:>8} {args.gunshots:>9} {statistics.median(latencies):>9.1f} "
+          f"{latencies[int(0.95 * (len(latencies) - 1))]:>9.1f} {latencies[-1]:>9.1f}")
+    print(f"Resumed {resumed} missed gunshots from a cursor in {resume_time * 1000:.1f} ms")
+
+def legacy_to_json(rows, columns, default = None):
+    """PagdDB.to_json before rows were mapped directly, encoding and decoding every result to unwrap single rows"""
+    row_dicts = []
+    for row in rows:
+        row_dict = {}
+        for i in range(len(row)):
+            try:
+                row_dict[columns[i]] = row[i]
+            except IndexError:
+                pass
+        row_dicts.append(row_dict)
+    json_str = json.dumps(row_dicts, default=default)
+    if len(row_dicts) == 1:
+        json_str = json_str[1:-1]
+    return json.loads(json_str)
+
+def bench_serialization(args):
+    """Time to turn the rows of a large query result into a response body, before and after mapping the rows directly"""
+    random.seed(0)
+    columns = ["gunshot_id", "timestamp", "coord_lat", "coord_long", "coord_alt", "gun", "shots_fired"]
+    db = PagdDB.__new__(PagdDB) # Only to_json is used, which needs no connection
+    print(f"{'rows':>8} {'legacy (ms)':>12} {'mapped (ms)':>12} {'speedup':>8}")
+    for amount in args.rows:
+        rows = [(i, 1700000000000 + i, 57.7 + random.random() / 10, 11.9 + random.random() / 10, random.randint(0, 500) / 10,
+                 random.choice(["Glock", "M16", "Ruger"]), random.randint(1, 5)) for i in range(amount)]
+        times = {}
+        for name, sort_keys, to_json in [("legacy", True, lambda: legacy_to_json(rows, columns, default=int)),
+                                         ("mapped", False, lambda: db.to_json(rows, columns))]:
+            app = Flask(name)
+            app.json.sort_keys = sort_keys
+            with app.app_context():
+                best = float("inf")
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    body = app.json.response(to_json()).get_data()
+                    best = min(best, time.perf_counter() - start)
+            times[name] = best
+            assert len(json.loads(body)) == amount
+        print(f"{amount:>8} {times['legacy'] * 1000:>12.1f} {times['mapped'] * 1000:>12.1f} {times['legacy'] / times['mapped']:>7.1f}x")
+
+class GeneratedRowsDB(PagdDB):
+    """PagdDB whose queries return generated report rows rather than rows from a database. Streamed rows are
+    generated as they are read, like from an unbuffered cursor, other results are generated all at once like fetchall"""
+    def __init__(self, amount):
+        self.amount = amount
+
+    def execute(self, query, values = None, stream = False):
+        columns = ["report_id", "timestamp", "coord_lat", "coord_long", "coord_alt", "gun", "client_id"]
+        after_id, limit = values[-2:] if "LIMIT" in query else (values[-1], self.amount)
+        rows = ((i, 1700000000000 + i, 57.7 + i * 1e-7, 11.9 + i * 1e-7, 12.5, "Glock", f"client-{i % 100}")
+                for i in range(after_id + 1, min(self.amount, after_id + limit) + 1))
+        return (rows, columns) if stream else (list(rows), columns)
+
+def bench_streaming(args):
+    """Peak memory and time of the API responding with every report in the database, read and sent all at once,
+    in pages, or streamed as newline delimited JSON"""
+    os.environ.setdefault("JWT_SECRET_KEY", base64.b64encode(os.urandom(32)).decode("utf-8"))
+    import app as api
+    print(f"{'reports':>8} {'mode':>8} {'requests':>9} {'peak memory (MB)':>17} {'time (ms)':>10}")
+    for amount in args.reports:
+        flask_app = Flask("streaming")
+        api.create_routes(flask_app, GeneratedRowsDB(amount), GunshotSubject())
+        client = flask_app.test_client()
+        headers = {"Authorization": jwt.encode({"id": "benchmark", "exp": round(time.time() * 1000) + 3600_000}, api.SECRET_KEY, "HS256")}
+
+        def all_at_once(): # Without after_id and limit, as requested by clients that do not page
+            return 1, len(json.loads(client.get("/api/reports", headers=headers).get_data()))
+
+        def paged():
+            requests, received, after_id = 0, 0, 0
+            while after_id is not None:
+                response = client.get(f"/api/reports?after_id={after_id}", headers=headers)
+                requests += 1
+                received += len(json.loads(response.get_data()))
+                after_id = response.headers.get("X-Next-After-Id")
+            return requests, received
+
+        def streamed():
+            response = client.get("/api/reports?stream=true", headers=headers, buffered=False)
+            received = sum(chunk.count(b"\n") for chunk in response.iter_encoded())
+            response.close()
+            return 1, received
+
+        for mode, respond in [("all", all_at_once), ("paged", paged), ("streamed", streamed)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            requests, received = respond()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert received == amount
+            print(f"{amount:>8} {mode:>8} {requests:>9} {peak / 1e6:>17.1f} {elapsed * 1000:>10.0f}")
+
+def bench_spatial(args):
+    """Time of finding the gunshots near a location in the PAGD database with the spatial index, versus reading every
+    gunshot and filtering them in the application, and the query plan of the spatial query"""
+    from getpass import getpass
+    import geopy.distance
+    db = PagdDB(args.host, args.user, getpass("Database password: "))
+    queries = []
+    execute = db.execute
+    def recording_execute(query, values = None, stream = False):
+        queries.append((query, values))
+        return execute(query, values, stream)
+    db.execute = recording_execute
+
+    start = time.perf_counter()
+    nearby = db.get_gunshots_by_radius(args.latitude, args.longitude, args.radius)
+    indexed_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    gunshots, after_id = [], 0
+    while True: # Every gunshot, a page at a time
+        page = db.get_all_gunshots(after_id, 10000)
+        gunshots += page
+        if len(page) < 10000:
+            break
+        after_id = page[-1]["gunshot_id"]
+    filtered = [gunshot for gunshot in gunshots if gunshot["coord_lat"] is not None and
+                geopy.distance.geodesic((args.latitude, args.longitude), (gunshot["coord_lat"], gunshot["coord_long"])).m <= args.radius]
+    scan_time = time.perf_counter() - start
+
+    assert sorted(g["gunshot_id"] for g in nearby) == sorted(g["gunshot_id"] for g in filtered)
+    print(f"{len(gunshots)} gunshots, {len(nearby)} within {args.radius} m")
+    print(f"{'spatial index (ms)':>19} {'read all (ms)':>14}")
+    print(f"{indexed_time * 1000:>19.1f} {scan_time * 1000:>14.1f}")
+
+    query, values = queries[0]
+    rows, columns = execute("EXPLAIN " + query, values)
+    print("\nEXPLAIN " + query)
+    print(" | ".join(columns))
+    for row in rows:
+        print(" | ".join(str(value) for value in row))
+
+def seed_database(conn, database, reports, clients, days, batch_size):
+    """Create a database from sql/tables.sql and fill it with reports of simulated gunshots heard by a number of clients"""
+    from migrate import split_statements
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE OR REPLACE DATABASE {database};")
+    for script in ("tables.sql", "inserts.sql"):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", script), encoding="utf-8") as file:
+            for statement in split_statements(file.read()):
+                if statement.upper().startswith("CREATE DATABASE"):
+                    continue
+                cursor.execute(f"USE {database}" if statement.upper().startswith("USE ") else statement)
+    conn.commit()
+    cursor.execute("SELECT name FROM Guns;")
+    guns = [name for name, in cursor.fetchall()]
+
+    random.seed(0)
+    end = 1700000000000
+    start = end - days * 24 * 3600 * 1000
+    gunshots = reports // clients
+    seed_start = time.perf_counter()
+    for first in range(0, gunshots, batch_size // clients):
+        report_rows, gunshot_rows, relation_rows = [], [], []
+        for gunshot_id in range(first + 1, min(first + batch_size // clients, gunshots) + 1):
+            timestamp = random.randint(start, end)
+            lat, long = 57.6 + random.random() * 0.2, 11.8 + random.random() * 0.3
+            gun = random.choice(guns)
+            gunshot_rows.append((gunshot_id, timestamp, lat, long, 10.0, gun, 1))
+            for k in range(clients):
+                report_id = (gunshot_id - 1) * clients + k + 1
+                report_rows.append((report_id, timestamp + random.randint(0, 3000), lat + random.uniform(-0.01, 0.01),
+                                    long + random.uniform(-0.01, 0.01), 10.0, gun, f"client-{random.randrange(10000)}"))
+                relation_rows.append((gunshot_id, report_id))
+        cursor.executemany("INSERT INTO Reports VALUES (%s, %s, POINT(%s, %s), %s, %s, %s);", report_rows)
+        cursor.executemany("INSERT INTO Gunshots VALUES (%s, %s, POINT(%s, %s), %s, %s, %s);", gunshot_rows)
+        cursor.executemany("INSERT INTO GunshotReports VALUES (%s, %s);", relation_rows)
+        conn.commit()
+        print(f"\rSeeded {min(first + batch_size // clients, gunshots) * clients} reports", end="", flush=True)
+    print(f" in {time.perf_counter() - seed_start:.0f}s")
+    cursor.close()
+    return start, end, gunshots
+
+def bench_indexes(args):
+    """Latency of the time range queries and gunshot event lookups in a MariaDB database seeded with millions of
+    rows, before and after applying the migrations in sql/migrations"""
+    from getpass import getpass
+    import mysql.connector
+    from migrate import migrate
+    password = getpass("Database password: ")
+    conn = mysql.connector.connect(host=args.host, user=args.user, password=password)
+    start, end, gunshots = seed_database(conn, args.database, args.reports, args.clients, args.days, args.batch)
+    conn.close()
+
+    db = PagdDB.__new__(PagdDB) # Connected to the benchmark database rather than pagd
+    Database.__init__(db, args.host, 3306, args.user, password, args.database, pool_size=1)
+    random.seed(1)
+    windows = [random.randint(start, end - 3600_000) for _ in range(args.queries)]
+    gunshot_ids = [random.randint(1, gunshots) for _ in range(args.queries)]
+    queries = {
+        "reports in 1 minute": (lambda i: db.get_report_range(windows[i], windows[i] + 60_000, limit=1000),
+                                "SELECT * FROM ReportsView WHERE timestamp >= %s AND timestamp < %s AND report_id > 0 ORDER BY report_id LIMIT 1000;",
+                                lambda i: (windows[i], windows[i] + 60_000)),
+        "gunshots in 1 hour": (lambda i: db.get_gunshots_by_timestamp(windows[i], windows[i] + 3600_000, limit=1000),
+                               "SELECT * FROM GunshotsView WHERE timestamp >= %s AND timestamp < %s AND gunshot_id > 0 ORDER BY gunshot_id LIMIT 1000;",
+                               lambda i: (windows[i], windows[i] + 3600_000)),
+        "recent reports": (lambda i: db.get_recent_reports(windows[i], 1000), None, None),
+        "reports of a gunshot": (lambda i: db.execute("SELECT COUNT(*) FROM GunshotEventsWithReports WHERE gunshot_id = %s;", (gunshot_ids[i],)),
+                                 "SELECT COUNT(*) FROM GunshotEventsWithReports WHERE gunshot_id = %s;", lambda i: (gunshot_ids[i],))
+    }
+
+    def measure():
+        latencies, plans = {}, {}
+        for name, (query, explained, values) in queries.items():
+            times = []
+            for i in range(args.queries):
+                query_start = time.perf_counter()
+                query(i)
+                times.append(time.perf_counter() - query_start)
+            latencies[name] = (statistics.median(times), max(times))
+            if explained is not None:
+                rows, columns = db.execute("EXPLAIN " + explained, values(0))
+                plans[name] = ", ".join(str(dict(zip(columns, row)).get("key")) for row in rows)
+        return latencies, plans
+
+    before, before_plans = measure()
+    migrate(db)
+    after, after_plans = measure()
+    print(f"{'query':>22} {'before p50 (ms)':>16} {'before max (ms)':>16} {'after p50 (ms)':>15} {'after max (ms)':>15}  index before -> after")
+    for name in queries:
+        print(f"{name:>22} {before[name][0] * 1000:>16.2f} {before[name][1] * 1000:>16.2f} {after[name][0] * 1000:>15.2f} "
+              f"{after[name][1] * 1000:>15.2f}  {before_plans.get(name, '-')} -> {after_plans.get(name, '-')}")
+
+class FakePool:
+    """Stand-in for MySQLConnectionPool, raising PoolError like it when every connection is taken"""
+    def __init__(self, size):
+        self.connections = queue.SimpleQueue()
+        for _ in range(size):
+            self.connections.put(FakeConnection(self))
+
+    def get_connection(self):
+        import mysql.connector
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            raise mysql.connector.errors.PoolError("Failed getting connection; pool exhausted")
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def close(self):
+        self.pool.connections.put(self)
+
+class FakePoolDatabase(Database):
+    """Database with a FakePool rather than connections to a server"""
+    def _create_pool(self, pool_size):
+        return FakePool(pool_size)
+
+def legacy_get_connection(db, sleep_timer = 0):
+    """Database._get_connection before connections were handed out in order, retrying after 1, 2, 3... seconds"""
+    import mysql.connector
+    try:
+        conn = db.pool.get_connection()
+    except mysql.connector.errors.PoolError:
+        if sleep_timer > 10:
+            return None
+        sleep_timer += 1
+        time.sleep(sleep_timer)
+        conn = legacy_get_connection(db, sleep_timer)
+    return conn
+
+def bench_pool(args):
+    """Time threads wait for a database connection when more threads than connections run queries at once, with the
+    connections handed out in order versus retrying after sleeping"""
+    print(f"{'acquisition':>12} {'threads':>8} {'queries':>8} {'p50 wait (ms)':>14} {'p99 wait (ms)':>14} {'max wait (ms)':>14} {'failed':>7} {'time (s)':>9}")
+    for mode in ("legacy", "fifo"):
+        db = FakePoolDatabase(None, None, None, None, None, args.pool_size, args.timeout)
+        waits, failed = [], [0]
+        def run_queries():
+            for _ in range(args.queries):
+                start = time.perf_counter()
+                if mode == "legacy":
+                    conn = legacy_get_connection(db)
+                else:
+                    conn = db._get_connection()
+                waits.append(time.perf_counter() - start)
+                if conn is None:
+                    failed[0] += 1
+                    continue
+                time.sleep(random.expovariate(1000 / args.query_time)) # Hold the connection while the query runs
+                if mode == "legacy":
+                    conn.close()
+                else:
+                    db._release_connection(conn)
+        threads = [Thread(target=run_queries) for _ in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        waits.sort()
+        print(f"{mode:>12} {args.threads:>8} {len(waits):>8} {waits[len(waits) // 2] * 1000:>14.1f} {waits[int(len(waits) * 0.99)] * 1000:>14.1f} "
+              f"{waits[-1] * 1000:>14.1f} {failed[0]:>7} {elapsed:>9.1f}")
+        if mode == "fifo":
+            print(db.metrics())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog = 'benchmark',
+                    description = 'Microbenchmarks of the gunshot correlation and localization')
+    subparsers = parser.add_subparsers(required=True)
+
+    matching = subparsers.add_parser('matching', help="cost of matching a report against a growing number of live events")
+    matching.add_argument('-e', '--events', default=[10, 100, 1000, 5000], type=int, nargs='+', help="amounts of live events")
+    matching.add_argument('-r', '--reports', default=200, type=int, help="amount of reports to match for each amount of events")
+    matching.set_defaults(func=bench_matching)
+
+    fits = subparsers.add_parser('fits', help="cost of checking whether a report fits an event with many reports")
+    fits.add_argument('-e', '--events', default=200, type=int, help="amount of events")
+    fits.add_argument('-p', '--probes', default=20, type=int, help="amount of reports to check against each event")
+    fits.add_argument('-r', '--reports', default=[50, 100, 200, 500], type=int, nargs='+', help="amounts of reports per event")
+    fits.set_defaults(func=bench_fits)
+
+    memory = subparsers.add_parser('memory', help="memory per live report of the events")
+    memory.add_argument('-e', '--events', default=1000, type=int, help="amount of live events")
+    memory.add_argument('-r', '--reports', default=[3, 10, 50], type=int, nargs='+', help="amounts of reports per event")
+    memory.set_defaults(func=bench_memory)
+
+    localization = subparsers.add_parser('localization', help="wall time and error of the TDOA solvers on simulated gunshots")
+    localization.add_argument('-s', '--simulations', default=200, type=int, help="amount of simulations to run")
+    localization.add_argument('-c', '--clients', default=8, type=int, help="amount of clients in simulation")
+    localization.add_argument('-t', '--timestamp', default=100, type=int, help="max timestamp error")
+    localization.add_argument('-g', '--got', action='store_true', help="set this if simulations only occur inside gothenburg")
+    localization.add_argument('-b', '--sector', default=360, type=float, help="clients are placed at bearings between 0 and this many degrees from the gunshot, below 180 puts the gunshot outside of their convex hull")
+    localization.add_argument('-m', '--methods', default=["nelder-mead", "lm"], nargs='+', help="solvers to compare")
+    localization.set_defaults(func=bench_localization)
+
+    batch = subparsers.add_parser('batch', help="throughput of solving many events one by one versus batched")
+    batch.add_argument('-e', '--events', default=20000, type=int, help="amount of events to solve in batch")
+    batch.add_argument('-s', '--single', default=2000, type=int, help="amount of events to solve one by one")
+    batch.add_argument('-p', '--processes', default=[0, 4], type=int, nargs='+', help="amounts of worker processes to batch solve with")
+    batch.set_defaults(func=bench_batch)
+
+    correlator = subparsers.add_parser('correlator', help="throughput of correlating in process versus in a partitioned correlator")
+    correlator.add_argument('-e', '--events', default=2000, type=int, help="amount of gunshots")
+    correlator.add_argument('-c', '--clients', default=6, type=int, help="amount of clients hearing each gunshot")
+    correlator.add_argument('-p', '--partitions', default=[1, 2, 4], type=int, nargs='+', help="amounts of partitions to correlate with")
+    correlator.add_argument('-w', '--workers', default=4, type=int, help="amount of API worker processes sending reports")
+    correlator.add_argument('-b', '--batch', default=10, type=int, help="amount of reports sent at a time")
+    correlator.add_argument('-s', '--speedup', default=100, type=float, help="how many times faster than real time the API workers send reports")
+    correlator.set_defaults(func=bench_correlator)
+
+    recovery = subparsers.add_parser('recovery', help="time to save the live events and to recover them on start")
+    recovery.add_argument('-e', '--events', default=[100, 1000, 5000], type=int, nargs='+', help="amounts of live events")
+    recovery.add_argument('-c', '--clients', default=6, type=int, help="amount of clients hearing each gunshot")
+    recovery.set_defaults(func=bench_recovery)
+
+    notifications = subparsers.add_parser('notifications', help="messages sent for gunshots updated as clients join, with and without coalescing")
+    notifications.add_argument('-w', '--windows', default=[0, 50, 200], type=int, nargs='+', help="coalescing windows in milliseconds")
+    notifications.add_argument('-g', '--gunshots', default=200, type=int, help="amount of gunshots")
+    notifications.add_argument('-u', '--updates', default=8, type=int, help="amount of notifications about each gunshot")
+    notifications.add_argument('-s', '--spacing', default=5, type=float, help="milliseconds between the first notification of each gunshot")
+    notifications.add_argument('-i', '--interval', default=30, type=float, help="milliseconds between the notifications about a gunshot")
+    notifications.add_argument('-l', '--latency', default=20, type=float, help="milliseconds each request to the backend takes")
+    notifications.add_argument('-m', '--message-latency', default=0.2, type=float, help="further milliseconds each message adds to a request")
+    notifications.set_defaults(func=bench_notifications)
+
+    push = subparsers.add_parser('push', help="latency of streaming gunshots to many idle subscribers, and resuming from a cursor")
+    push.add_argument('-s', '--subscribers', default=2000, type=int, help="amount of idle subscribers")
+    push.add_argument('-g', '--gunshots', default=50, type=int, help="amount of gunshots published")
+    push.add_argument('-i', '--interval', default=20, type=float, help="milliseconds between the gunshots")
+    push.set_defaults(func=bench_push)
+
+    serialization = subparsers.add_parser('serialization', help="time to turn the rows of a large query result into a response body")
+    serialization.add_argument('-r', '--rows', default=[1000, 10000, 100000], type=int, nargs='+', help="amounts of rows")
+    serialization.add_argument('-n', '--repeat', default=3, type=int, help="amount of runs, the fastest is reported")
+    serialization.set_defaults(func=bench_serialization)
+
+    streaming = subparsers.add_parser('streaming', help="peak memory of responding with every report, all at once, in pages or streamed")
+    streaming.add_argument('-r', '--reports', default=[10000, 100000, 300000], type=int, nargs='+', help="amounts of reports in the database")
+    streaming.set_defaults(func=bench_streaming)
+
+    spatial = subparsers.add_parser('spatial', help="time of finding gunshots near a location in the database, with and without the spatial index")
+    spatial.add_argument('--host', default="localhost", help="host of the PAGD database")
+    spatial.add_argument('--user', default="pagd", help="user of the PAGD database")
+    spatial.add_argument('--latitude', default=57.7, type=float, help="latitude of the center")
+    spatial.add_argument('--longitude', default=11.97, type=float, help="longitude of the center")
+    spatial.add_argument('-r', '--radius', default=1000, type=float, help="radius in meters")
+    spatial.set_defaults(func=bench_spatial)
+
+    indexes = subparsers.add_parser('indexes', help="latency of the time range queries in a seeded MariaDB database, before and after the migrations")
+    indexes.add_argument('--host', default="localhost", help="host of the MariaDB server")
+    indexes.add_argument('--user', default="pagd", help="user of the MariaDB server, allowed to create the benchmark database")
+    indexes.add_argument('--database', default="pagd_benchmark", help="name of the database to create, replacing it if it exists")
+    indexes.add_argument('-r', '--reports', default=3000000, type=int, help="amount of reports to seed")
+    indexes.add_argument('-c', '--clients', default=6, type=int, help="amount of reports of each gunshot")
+    indexes.add_argument('-d', '--days', default=365, type=int, help="days the reports are spread over")
+    indexes.add_argument('-b', '--batch', default=12000, type=int, help="amount of reports inserted at a time")
+    indexes.add_argument('-q', '--queries', default=50, type=int, help="amount of times each query is run")
+    indexes.set_defaults(func=bench_indexes)
+
+    pool = subparsers.add_parser('pool', help="time waiting for a database connection with more threads than connections")
+    pool.add_argument('-p', '--pool-size', default=8, type=int, help="amount of connections in the pool")
+    pool.add_argument('-t', '--threads', default=32, type=int, help="amount of threads running queries")
+    pool.add_argument('-q', '--queries', default=50, type=int, help="amount of queries run by each thread")
+    pool.add_argument('-d', '--query-time', default=5, type=float, help="average milliseconds a query holds its connection")
+    pool.add_argument('--timeout', default=10, type=float, help="seconds to wait for a connection before giving up")
+    pool.set_defaults(func=bench_pool)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,285 @@
+import os
+import time
+import heapq
+import argparse
+import multiprocessing
+from getpass import getpass
+from multiprocessing.connection import Listener, Client
+from threading import Thread, Lock
+
+from subject_interface import SubjectInterface
+from event_index import EventIndex
+from gunshot import MAX_TIME_DIFF
+
+# Settings
+CORRELATOR_ADDRESS = ("localhost", 6000) # address the correlator listens on for reports from the API workers
+CORRELATOR_AUTHKEY = os.environ["CORRELATOR_AUTHKEY"].encode("utf-8") # shared secret of the correlator and the API workers, required since received reports are unpickled
+PARTITIONS = 4 # processes correlating reports, each owning the events of a part of the map
+PARTITION_CELLS = 25 # width and height of the default region of a partition, in cells of the event index
+CLAIM_DURATION = 2*MAX_TIME_DIFF + 5000 # milliseconds a cell stays claimed by a partition after its latest report
+
+
+class Partitioner:
+    """
+    Decides which partition correlates a report. All reports of an event
+    must reach the same partition, and a report only fits an event with a
+    report in one of the neighbouring cells of the event index. Therefore a
+    cell is claimed by the partition of the latest report in it, and a
+    report goes to the partition claiming its own cell, otherwise to one
+    claiming a neighbouring cell, otherwise to the partition of its region.
+    Reports could only be split from their event if events of different
+    partitions are live within two cells of each other, which only happens
+    at the border of two regions.
+    """
+
+    def __init__(self, partitions, partition_cells = PARTITION_CELLS, claim_duration = CLAIM_DURATION):
+        """
+        @param partitions (int): number of partitions
+        @param partition_cells (int): width and height of the region of a partition, in cells
+        @param claim_duration (float): milliseconds a cell stays claimed after its latest report
+        """
+        self.partitions = partitions
+        self.partition_cells = partition_cells
+        self.claim_duration = claim_duration
+        self.grid = EventIndex()
+        self.claims = {} # (row, column) -> (partition, expiry timestamp)
+        self.expiry_heap = [] # (expiry timestamp, cell) of every claim
+        self.watermark = 0
+
+    def route(self, latitude, longitude, timestamp) -> int:
+        """
+        Return the partition of a report and claim its cell for it
+        @param latitude (float): latitude of the report
+        @param longitude (float): longitude of the report
+        @param timestamp (int): timestamp of the report in milliseconds
+        @return (int): index of the partition
+        """
+        self.watermark = max(self.watermark, min(timestamp, time.time() * 1000)) # A future-dated report must not expire every claim
+        self._expire_claims()
+
+        neighbours = self.grid.neighbours(latitude, longitude)
+        cell = self.grid._cell(latitude, longitude)
+        claim = self.claims.get(cell)
+        if claim is None: # The most recently active neighbour, if any
+            claim = max((self.claims[c] for c in neighbours if c in self.claims), key=lambda claim: claim[1], default=None)
+        partition = claim[0] if claim is not None else self._region(*cell)
+
+        expiry = timestamp + self.claim_duration
+        previous = self.claims.get(cell)
+        if previous is None or expiry > previous[1]:
+            self.claims[cell] = (partition, expiry)
+            heapq.heappush(self.expiry_heap, (expiry, cell))
+        return partition
+
+    def _region(self, row, column):
+        # Tuples of integers hash the same in every process
+        return hash((row // self.partition_cells, column // self.partition_cells)) % self.partitions
+
+    def _expire_claims(self):
+        while self.expiry_heap and self.expiry_heap[0][0] <= self.watermark:
+            expiry, cell = heapq.heappop(self.expiry_heap)
+            claim = self.claims.get(cell)
+            if claim is not None and claim[1] == expiry: # Not extended since it was pushed
+                del self.claims[cell]
+
+
+def create_observer(subject, host, user, password):
+    """Default observer of a partition, correlating reports into gunshots in the PAGD database"""
+    from pagdDB import PagdDB
+    from gunshot_observer import GunshotObserver
+    # Recovering would correlate the recent reports of the whole map again in every partition, so partitions start empty
+    return GunshotObserver(subject, PagdDB(host, user, password), snapshot_path=None, recover=False)
+
+
+def _run_partition(reports, observer_factory, factory_args):
+    """Main loop of a partition process, passing the reports routed to it to its own observer"""
+    from gunshot_subject import GunshotSubject
+    subject = GunshotSubject()
+    observer = observer_factory(subject, *factory_args)
+    try:
+        while True:
+            batch = reports.get()
+            if batch is None: # Stop signal from Correlator.close()
+                break
+            try:
+                subject.notify_batch(batch)
+            except Exception as e:
+                print(f"ERROR: Partition failed to correlate {len(batch)} reports.\n\t{str(e)}")
+    finally:
+        # Finalize the live events, apply their pending effects and send the waiting notifications
+        subject.close()
+        observer.close()
+
+
+class Correlator:
+    """
+    Standalone service correlating the reports of any number of API worker
+    processes. Reports are received over local connections, see
+    CorrelatorClient, and routed to partition processes by a Partitioner.
+    Each partition keeps the events of its part of the map in its own
+    observer, so correlation is not limited to the process serving requests.
+    """
+
+    def __init__(self, address = CORRELATOR_ADDRESS, partitions = PARTITIONS, observer_factory = create_observer, factory_args = (),
+                 authkey = CORRELATOR_AUTHKEY):
+        """
+        @param address (tuple): host and port to listen on
+        @param partitions (int): number of partition processes
+        @param observer_factory (function): called with a subject and factory_args in each partition process to create its
+        observer. Must be a module level function, since the partitions are spawned
+        @param factory_args (tuple): further arguments to observer_factory
+        @param authkey (bytes): shared secret that clients must authenticate with
+        """
+        self.partitioner = Partitioner(partitions)
+        self.lock = Lock()
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue() for _ in range(partitions)]
+        self.processes = [context.Process(target=_run_partition, args=(queue, observer_factory, factory_args), daemon=True)
+                          for queue in self.queues]
+        for process in self.processes:
+            process.start()
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.routed = [0] * partitions
+
+    def serve_forever(self):
+        """Accept connections from API workers, handling each on its own thread, until the listener is closed"""
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError: # Closed by close()
+                break
+            except Exception as e:
+                print(f"ERROR: Failed to accept a connection.\n\t{str(e)}")
+                continue
+            Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def submit(self, reports):
+        """
+        Route reports to their partitions, keeping the order of the reports of each partition
+        @param reports (list[tuple]): (report_id, (lat, long, alt), timestamp, gun, client_id) tuples
+        """
+        batches = {}
+        with self.lock:
+            for report in reports:
+                (latitude, longitude, _), timestamp = report[1], report[2]
+                partition = self.partitioner.route(latitude, longitude, timestamp)
+                batches.setdefault(partition, []).append(report)
+                self.routed[partition] += 1
+            for partition, batch in batches.items(): # Put while holding the lock, so batches are queued in the order they were routed
+                self.queues[partition].put(batch)
+
+    def close(self):
+        """Stop accepting reports and stop the partitions once they have correlated the queued reports"""
+        self.listener.close()
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+
+    def metrics(self):
+        """Return routing statistics
+        @return (dict): number of reports routed to each partition and live cell claims
+        """
+        with self.lock:
+            return {
+                "partitions": len(self.processes),
+                "routed": list(self.routed),
+                "claimed_cells": len(self.partitioner.claims)
+            }
+
+    def _receive(self, conn):
+        with conn:
+            while True:
+                try:
+                    reports = conn.recv()
+                except (EOFError, OSError): # Client disconnected
+                    break
+                try:
+                    self.submit(reports)
+                except Exception as e:
+                    print(f"ERROR: Failed to route {len(reports)} reports.\n\t{str(e)}")
+
+
+class CorrelatorClient(SubjectInterface):
+    """
+    Subject of the API workers when correlating in a Correlator process. Reports are sent to the correlator
+    rather than to local observers, reconnecting if the connection is lost.
+    """
+
+    def __init__(self, address = CORRELATOR_ADDRESS, authkey = CORRELATOR_AUTHKEY):
+        """
+        @param address (tuple): host and port of the correlator
+        @param authkey (bytes): shared secret of the correlator
+        """
+        self.address = address
+        self.authkey = authkey
+        self.conn = None
+        self.lock = Lock()
+        self.sent = 0
+        self.errors = 0
+
+    def attach(self, observer):
+        raise NotImplementedError("observers run in the correlator process")
+
+    def detach(self, observer):
+        raise NotImplementedError("observers run in the correlator process")
+
+    def notify(self, report):
+        self.notify_batch([report])
+
+    def notify_batch(self, reports):
+        """
+        Send reports to the correlator, reconnecting and sending them again once if the connection was lost
+        @raise ConnectionError: If the reports could not be sent
+        """
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.conn is None:
+                        self.conn = Client(self.address, authkey=self.authkey)
+                    self.conn.send(list(reports))
+                    self.sent += len(reports)
+                    return
+                except Exception as e:
+                    print(f"ERROR: Failed to send {len(reports)} reports to the correlator.\n\t{str(e)}")
+                    self.errors += 1
+                    if self.conn is not None:
+                        self.conn.close()
+                        self.conn = None
+                    error = e
+            raise ConnectionError(f"failed to send {len(reports)} reports to the correlator") from error
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def metrics(self):
+        """Return statistics of the reports sent to the correlator
+        @return (dict): number of reports sent and failed sends
+        """
+        with self.lock:
+            return {
+                "connected": self.conn is not None,
+                "sent": self.sent,
+                "errors": self.errors
+            }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog = 'correlator',
+                    description = 'Correlates the gunshot reports of the API workers into gunshots')
+    parser.add_argument('-p', '--partitions', default=PARTITIONS, type=int, help="amount of partition processes")
+    parser.add_argument('--port', default=CORRELATOR_ADDRESS[1], type=int, help="port to listen on")
+    args = parser.parse_args()
+
+    correlator = Correlator((CORRELATOR_ADDRESS[0], args.port), args.partitions,
+                            factory_args=("localhost", "pagd", getpass("Database password: ")))
+    print(f"Correlating with {args.partitions} partitions on {correlator.address[0]}:{correlator.address[1]}")
+    try:
+        correlator.serve_forever()
+    except KeyboardInterrupt:
+        correlator.close()
@@ -1,14 +1,39 @@
 import mysql.connector.pooling
 import time
+from collections import deque
+from threading import Lock, Event
+
+# Settings
+STREAM_BATCH_SIZE = 1000 # rows read from the server at a time when streaming a query result
+POOL_SIZE = 32 # connections in the pool, at most mysql.connector.pooling.CNX_POOL_MAXSIZE
+ACQUIRE_TIMEOUT = 10 # seconds to wait for a connection when the pool is exhausted before giving up
+MAX_WAITERS = 256 # threads allowed to wait for a connection at a time, further requests give up immediately
 
 class Database:
-    def __init__(self, host, port, user, password, database, pool_size = 32):
+    def __init__(self, host, port, user, password, database, pool_size = POOL_SIZE, acquire_timeout = ACQUIRE_TIMEOUT,
+                 max_waiters = MAX_WAITERS):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.database = database
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.max_waiters = max_waiters
         self.pool = self._create_pool(pool_size)
+
+        # Connections are handed out in the order they were requested. A released connection goes to the longest
+        # waiting thread, rather than to whichever thread happens to ask the pool first
+        self.lock = Lock()
+        self.available = pool_size # connections that no thread holds or has been handed
+        self.waiters = deque() # an Event per waiting thread, set when a connection is handed to it
+
+        self.acquisitions = 0
+        self.waited = 0 # acquisitions that found the pool exhausted and had to wait
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.rejected = 0
     
     def _create_pool(self, pool_size):
         pool = mysql.connector.pooling.MySQLConnectionPool(
@@ -22,31 +47,97 @@ class Database:
             database = self.database)
         return pool
 
-    def _get_connection(self, sleep_timer = 0):
-        try:
-            conn = self.pool.get_connection()
-        except mysql.connector.errors.PoolError:
-            if sleep_timer > 10:
+    def _get_connection(self):
+        """Take a connection from the pool, waiting in line for up to acquire_timeout seconds if the pool is exhausted
+        @return (PooledMySQLConnection): the connection, or None if none became available in time or too many threads are waiting
+        """
+        start = time.perf_counter()
+        with self.lock:
+            if self.available > 0 and not self.waiters:
+                self.available -= 1
+                waiter = None
+            elif len(self.waiters) >= self.max_waiters:
+                self.rejected += 1
+                print(f"ERROR: Failed to get a database connection.\n\tThe pool is exhausted and {len(self.waiters)} requests are already waiting")
                 return None
-            sleep_timer += 1
-            print(f"Failed getting connection; pool exhausted. Trying again in {sleep_timer}s...")
-            time.sleep(sleep_timer)
-            conn = self._get_connection(sleep_timer)
-        if conn is None:
-            print(f"Failed to get a connection after {sleep_timer} tries. Giving up...")
-        return conn
+            else:
+                waiter = Event()
+                self.waiters.append(waiter)
+                self.waited += 1
+
+        if waiter is not None and not waiter.wait(self.acquire_timeout):
+            with self.lock:
+                if not waiter.is_set(): # Not handed a connection while timing out
+                    self.waiters.remove(waiter)
+                    self.timeouts += 1
+                    print(f"ERROR: Failed to get a database connection.\n\tThe pool was exhausted for {self.acquire_timeout}s")
+                    return None
+
+        wait = time.perf_counter() - start
+        with self.lock:
+            self.acquisitions += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        try:
+            return self.pool.get_connection()
+        except Exception as e:
+            self._release_slot()
+            raise e
+
+    def _release_connection(self, conn):
+        """Return a connection to the pool and hand it to the longest waiting thread, if any"""
+        try:
+            conn.close()
+        finally:
+            self._release_slot()
 
-    def execute(self, query, values = None):
+    def _release_slot(self):
+        with self.lock:
+            if self.waiters:
+                self.waiters.popleft().set()
+            else:
+                self.available += 1
+
+    def metrics(self):
+        """Return statistics of the connection pool
+        @return (dict): connections in use, threads waiting, how many acquisitions had to wait and how long, and how many gave up
+        """
+        with self.lock:
+            return {
+                "pool_size": self.pool_size,
+                "in_use": self.pool_size - self.available,
+                "waiting": len(self.waiters),
+                "acquisitions": self.acquisitions,
+                "exhausted": self.waited,
+                "avg_wait_ms": self.wait_total / self.acquisitions * 1000 if self.acquisitions else 0.0,
+                "max_wait_ms": self.wait_max * 1000,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected
+            }
+
+    def execute(self, query, values = None, stream = False):
         """Execute an SQL query
         @param query (string): the SQL query to be executed. Use %s for parameters
         @param values (tuple, optional): the parameter values for each %s in the query
-        @return list: the query result
+        @param stream (bool, optional): read the rows of a SELECT query as they are iterated rather than all at once
+        @return list: the query result. If streaming, the rows are an iterator that holds on to its connection until it
+        is exhausted or closed
         """
         conn = self._get_connection()
         if conn is None:
             return ([], [])
         cursor = conn.cursor()
 
+        if stream:
+            try:
+                cursor.execute(query, values)
+                columns = self._extract_columns(cursor.description)
+            except Exception as e:
+                cursor.close()
+                self._release_connection(conn)
+                raise e
+            return (self._stream_rows(conn, cursor), columns)
+
         try:
             if type(values) is list: # Execute query in bulk
                 cursor.executemany(query, values)
@@ -65,13 +156,49 @@ class Database:
             raise e
         finally:
             cursor.close()
-            conn.close()  # release the connection back to the pool
+            self._release_connection(conn)
 
         columns = self._extract_columns(desc)
         return (result, columns)
     
+    def _stream_rows(self, conn, cursor):
+        """Yield the rows of an executed query from the unbuffered cursor, so only STREAM_BATCH_SIZE rows are in memory
+        at a time, then release the connection back to the pool"""
+        exhausted = False
+        try:
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    exhausted = True
+                    break
+                yield from rows
+        finally:
+            if exhausted:
+                cursor.close()
+                self._release_connection(conn)
+            else: # Closed early, e.g. by a disconnected client
+                self._discard_connection(conn, cursor)
+
+    def _discard_connection(self, conn, cursor):
+        """Close the socket of a connection with unread rows and return it to the pool, rather than reading the rest of
+        the rows, which may be a whole table, before it can be reused. The server aborts the query once it can no
+        longer send rows, and the pool reconnects the connection when it is taken again"""
+        conn.shutdown()
+        try:
+            cursor.close()
+        except Exception:
+            pass # The unread rows can not be read from the closed socket
+        try:
+            conn.close()
+        except Exception:
+            pass # Resetting the session fails since it is disconnected, it is returned to the pool regardless
+        finally:
+            self._release_slot()
+
     def _extract_columns(self, description):
         columns = []
+        if description is None: # The query did not return rows, e.g. CREATE INDEX
+            return columns
         for desc in description:
             columns.append(desc[0])
         return columns
@@ -108,7 +235,7 @@ class Database:
             raise e
         finally:
             cursor.close()
-            conn.close()  # release the connection back to the pool
+            self._release_connection(conn)
 
         columns = self._extract_columns(desc)
         return (result, columns)
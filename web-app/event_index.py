@@ -0,0 +1,113 @@
+import math
+
+from gunshot import GunshotEvent, GunshotReport, MAX_DISTANCE, MAX_TIME_DIFF
+
+CELL_SIZE = 2*MAX_DISTANCE
+"""Minimum width of a grid cell in meters. Reports further apart than this can not belong to the same event"""
+METERS_PER_LATITUDE = 110000
+"""Lower bound of the length of one degree of latitude in meters"""
+LATITUDE_STEP = CELL_SIZE / METERS_PER_LATITUDE
+"""Height of a grid cell in degrees of latitude"""
+TIME_BUCKET = MAX_TIME_DIFF
+"""Width of a time bucket in milliseconds"""
+
+
+class EventIndex:
+    """
+    Spatio-temporal index of gunshot events. Every report of an event is
+    placed in a grid cell at least CELL_SIZE meters wide and a time bucket
+    of TIME_BUCKET milliseconds. Since a report only fits an event if it is
+    within range of all of the event's reports and within time margin of
+    at least one of them, any fitting event must have a report in one of
+    the 3x3 neighbouring cells and 3 neighbouring time buckets.
+    """
+
+    def __init__(self):
+        self.cells = {}
+        """Maps (row, column, bucket) to the set of events with a report there"""
+        self.keys = {}
+        """Maps an event to the set of keys it is indexed under"""
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, event: GunshotEvent, report: GunshotReport):
+        """
+        Index an event under the cell and time bucket of one of its reports
+
+        @param event: The event the report was added to
+        @param report: The report that was added
+        """
+        row, col = self._cell(report.position.latitude, report.position.longitude)
+        key = (row, col, self._bucket(report.timestamp))
+        self.cells.setdefault(key, set()).add(event)
+        self.keys.setdefault(event, set()).add(key)
+
+    def remove(self, event: GunshotEvent):
+        """
+        Remove an event and all of its reports from the index
+
+        @param event: The event to remove
+        """
+        for key in self.keys.pop(event, ()):
+            events = self.cells[key]
+            events.discard(event)
+            if not events:
+                del self.cells[key]
+
+    def candidates(self, report: GunshotReport) -> list[GunshotEvent]:
+        """
+        Return the events that the report may fit, ordered by event ID.
+        Events that are not returned are guaranteed not to fit.
+
+        @param report: The report to find candidate events for
+        @return: List of candidate events
+        """
+        bucket = self._bucket(report.timestamp)
+        found = set()
+        for r, c in self.neighbours(report.position.latitude, report.position.longitude):
+            for b in (bucket - 1, bucket, bucket + 1):
+                events = self.cells.get((r, c, b))
+                if events:
+                    found.update(events)
+        return sorted(found, key=lambda event: event.event_id)
+
+    def neighbours(self, latitude, longitude) -> list[tuple[int, int]]:
+        """
+        Return the (row, column) of the grid cell of a position and of the
+        cells around it. Any position within CELL_SIZE meters is in one of them.
+
+        @param latitude: Latitude of the position
+        @param longitude: Longitude of the position
+        @return: List of up to 9 cells
+        """
+        row, _ = self._cell(latitude, longitude)
+        cells = []
+        for r in (row - 1, row, row + 1):
+            columns = self._columns(r)
+            col = self._column(longitude, columns)
+            cells.extend((r, c) for c in {(col - 1) % columns, col, (col + 1) % columns})
+        return cells
+
+    def _cell(self, latitude, longitude):
+        row = math.floor(latitude / LATITUDE_STEP)
+        return row, self._column(longitude, self._columns(row))
+
+    @staticmethod
+    def _column(longitude, columns):
+        return math.floor((longitude + 180) / 360 * columns) % columns
+
+    @staticmethod
+    def _columns(row):
+        """
+        Number of columns in a row of the grid. Columns are made wide enough
+        for the latitude of the row next to it on the side closest to the
+        pole, since a degree of longitude is shortest there.
+        """
+        latitude = min(90, (abs(row + 0.5) + 1.5) * LATITUDE_STEP)
+        width = CELL_SIZE / (METERS_PER_LATITUDE * max(math.cos(math.radians(latitude)), 1e-9))
+        return max(1, math.floor(360 / width))
+
+    @staticmethod
+    def _bucket(timestamp):
+        return math.floor(timestamp / TIME_BUCKET)
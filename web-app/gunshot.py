@@ -6,6 +6,7 @@ import sys
 import os.path
 import os
 import scipy.optimize
+import numpy as np
 
 MAX_DISTANCE = 1000
 """Maximum distance in meters a gunshot can be picked up from"""
@@ -14,8 +15,136 @@ SPEED_OF_SOUND_MS = 343/1000
 MAX_TIME_DIFF = MAX_DISTANCE/SPEED_OF_SOUND_MS
 """Maximum difference of time in milliseconds between when two different clients pick up a gunshot"""
 
+WGS84_A = 6378137.0
+"""Semi-major axis of the WGS-84 ellipsoid in meters"""
+WGS84_E2 = (1/298.257223563) * (2 - 1/298.257223563)
+"""Squared eccentricity of the WGS-84 ellipsoid"""
+FAST_DISTANCE_MAX_LATITUDE = 85
+"""Latitude in degrees beyond which fast_distance is not accurate enough and geodesic distance is used"""
+FAST_DISTANCE_ERROR = 0.01
+"""Upper bound in meters of the error of fast_distance compared to geodesic distance, for distances up to
+2*MAX_DISTANCE within FAST_DISTANCE_MAX_LATITUDE. The measured maximum is about 0.2 mm at MAX_DISTANCE and
+1 mm at 2*MAX_DISTANCE, the bound leaves a margin for the altitude term and rounding"""
+BOUNDS_MARGIN = 10
+"""Meters of margin when comparing against the bounding box of an event. The scale of a degree of longitude varies
+across a box 2*MAX_DISTANCE high, by up to 7 m over 2*MAX_DISTANCE at FAST_DISTANCE_MAX_LATITUDE"""
+COLUMNS_MIN_REPORTS = 3
+"""Reports an event needs before they are kept in arrays. Smaller events, most of them, keep their reports as they are,
+since arrays take more memory than a couple of reports"""
+BOUNDS_MIN_REPORTS = 4
+"""Reports an event needs before its bounding box is kept. Smaller events, most of them, are compared against each
+report, which is as fast for a handful of reports and does not cost memory"""
+
+
+def fast_distance(a, b):
+    """
+    Vectorized distance in meters between positions given as arrays of
+    latitude, longitude and altitude along the last axis, broadcasting
+    like NumPy. Uses a local tangent plane at the mean latitude with the
+    meridian and prime vertical radii of curvature of the WGS-84
+    ellipsoid, which is accurate to within FAST_DISTANCE_ERROR for the
+    short distances between a gunshot and the clients that heard it.
+    Use Position.distance for long distances or near the poles.
+
+    @param a: Array of shape (..., 3) of positions
+    @param b: Array of shape (..., 3) of positions
+    @return: Array of distances in meters
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    latitude = np.radians((a[..., 0] + b[..., 0]) / 2)
+    sin_latitude = np.sin(latitude)
+    w = np.sqrt(1 - WGS84_E2 * sin_latitude**2)
+    meridian_radius = WGS84_A * (1 - WGS84_E2) / w**3
+    normal_radius = WGS84_A / w
+    north = np.radians(b[..., 0] - a[..., 0]) * meridian_radius
+    east = np.radians((b[..., 1] - a[..., 1] + 180) % 360 - 180) * normal_radius * np.cos(latitude)
+    up = b[..., 2] - a[..., 2]
+    return np.sqrt(north**2 + east**2 + up**2)
+
+
+def _fast_distance_scalar(a, b):
+    """fast_distance between two single positions, without the overhead of NumPy"""
+    latitude = math.radians((a[0] + b[0]) / 2)
+    sin_latitude = math.sin(latitude)
+    w = math.sqrt(1 - WGS84_E2 * sin_latitude**2)
+    north = math.radians(b[0] - a[0]) * WGS84_A * (1 - WGS84_E2) / w**3
+    east = math.radians((b[1] - a[1] + 180) % 360 - 180) * WGS84_A / w * math.cos(latitude)
+    return math.sqrt(north**2 + east**2 + (b[2] - a[2])**2)
+
+
+def geodetic_to_ecef(positions):
+    """
+    Convert positions to Earth-centered, Earth-fixed coordinates
+
+    @param positions: Array of shape (..., 3) of latitude, longitude
+    in degrees and altitude in meters
+    @return: Array of shape (..., 3) of x, y, z in meters
+    """
+    positions = np.asarray(positions, dtype=float)
+    latitude = np.radians(positions[..., 0])
+    longitude = np.radians(positions[..., 1])
+    altitude = positions[..., 2]
+    normal_radius = WGS84_A / np.sqrt(1 - WGS84_E2 * np.sin(latitude)**2)
+    return np.stack(((normal_radius + altitude) * np.cos(latitude) * np.cos(longitude),
+                     (normal_radius + altitude) * np.cos(latitude) * np.sin(longitude),
+                     (normal_radius * (1 - WGS84_E2) + altitude) * np.sin(latitude)), axis=-1)
+
+def ecef_to_geodetic(ecef, iterations = 5):
+    """
+    Convert Earth-centered, Earth-fixed coordinates to positions.
+    Latitude is found by fixed-point iteration, which converges to well
+    below a millimeter within a few iterations near the surface
+
+    @param ecef: Array of shape (..., 3) of x, y, z in meters
+    @return: Array of shape (..., 3) of latitude, longitude in degrees
+    and altitude in meters
+    """
+    ecef = np.asarray(ecef, dtype=float)
+    x, y, z = ecef[..., 0], ecef[..., 1], ecef[..., 2]
+    p = np.hypot(x, y)
+    latitude = np.arctan2(z, p * (1 - WGS84_E2))
+    for _ in range(iterations):
+        normal_radius = WGS84_A / np.sqrt(1 - WGS84_E2 * np.sin(latitude)**2)
+        altitude = p * np.cos(latitude) + z * np.sin(latitude) - WGS84_A**2 / normal_radius
+        latitude = np.arctan2(z, p * (1 - WGS84_E2 * normal_radius / (normal_radius + altitude)))
+    normal_radius = WGS84_A / np.sqrt(1 - WGS84_E2 * np.sin(latitude)**2)
+    altitude = p * np.cos(latitude) + z * np.sin(latitude) - WGS84_A**2 / normal_radius
+    return np.stack((np.degrees(latitude), np.degrees(np.arctan2(y, x)), altitude), axis=-1)
+
+def _enu_rotation(origin):
+    latitude, longitude = np.radians(origin[0]), np.radians(origin[1])
+    return np.array([[-np.sin(longitude), np.cos(longitude), 0],
+                     [-np.sin(latitude) * np.cos(longitude), -np.sin(latitude) * np.sin(longitude), np.cos(latitude)],
+                     [np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude), np.sin(latitude)]])
+
+def geodetic_to_enu(positions, origin):
+    """
+    Convert positions to a local East-North-Up frame in meters
+
+    @param positions: Array of shape (..., 3) of positions
+    @param origin: Latitude, longitude and altitude of the origin of the frame
+    @return: Array of shape (..., 3) of east, north, up in meters
+    """
+    origin = np.asarray(origin, dtype=float)
+    return (geodetic_to_ecef(positions) - geodetic_to_ecef(origin)) @ _enu_rotation(origin).T
+
+def enu_to_geodetic(enu, origin):
+    """
+    Convert positions in a local East-North-Up frame back to latitude,
+    longitude and altitude
+
+    @param enu: Array of shape (..., 3) of east, north, up in meters
+    @param origin: Latitude, longitude and altitude of the origin of the frame
+    @return: Array of shape (..., 3) of positions
+    """
+    origin = np.asarray(origin, dtype=float)
+    return ecef_to_geodetic(np.asarray(enu, dtype=float) @ _enu_rotation(origin) + geodetic_to_ecef(origin))
+
 
 class Position:
+    __slots__ = ("v",)
+
     def __init__(self, latitude, longitude, altitude):
         """
         @param latitude: latitude in degrees between -90 and 90
@@ -62,6 +191,16 @@ class Position:
         # to earth's curvature but will work for these purposes
         # with (relatively) short distances
         return math.sqrt(geodesic**2 + (self.altitude - position.altitude)**2)
+
+    def fast_distance(self, position: Position) -> float:
+        """
+        Returns an approximation of the distance in meters from calling
+        position object to given position object, see fast_distance
+
+        @param position: Position from which to calculate distance to
+        @return: Distance in meters to specified position
+        """
+        return float(fast_distance(self.v, position.v))
     
     def shift(self, magnitude : float, theta: float, phi: float):
         new_altitude = self.altitude + math.sin(phi) * magnitude
@@ -83,7 +222,8 @@ class Position:
                         sum(p.longitude for p in positions) / n,
                         sum(p.altitude for p in positions) / n)
 
-    def tdoa(positions: list[Position], timestamps: list[int]) -> tuple[Position, int]:
+    def tdoa(positions: list[Position], timestamps: list[int], method: str = "lm",
+             closed_form_guess: bool = True, initial_guess: tuple[Position, int] = None, stats: dict = None) -> tuple[Position, int]:
         """
         Given a list of positions of sound recievers and when these
         recievers picked up a sound, it uses TDOA
@@ -100,15 +240,88 @@ class Position:
         @param positions: List of positions of sound recievers
         @param timestamps: List of timestamps in milliseconds when
         the sound recievers 'heard' the sound
+        @param method: "lm" to solve with Levenberg-Marquardt in a local
+        Cartesian frame, "nelder-mead" for the original solver
+        @param closed_form_guess: Start "lm" from the closed-form
+        estimate of tdoa_closed_form instead of the midpoint
+        @param initial_guess: Optional position and timestamp to warm
+        start "lm" from, e.g. the previous estimate of the same event
+        @param stats: Optional dictionary which is filled with the
+        number of objective function evaluations of the solver and
+        the sum of squared errors of the solution
         @return: Estimated position and timestamp of sound source
         """
-        n = len(positions)
+        if method == "nelder-mead":
+            return Position._tdoa_nelder_mead(positions, timestamps, stats)
+        return Position._tdoa_lm(positions, timestamps, closed_form_guess, initial_guess, stats)
 
-        def error(x, i):
-            return d(x, i) - SPEED_OF_SOUND_MS*(timestamps[i]-x[3])
-        
-        def d(x, i):
-            return positions[i].distance(Position(*x[:3]))
+    def tdoa_closed_form(local: np.ndarray, local_times: np.ndarray) -> np.ndarray:
+        """
+        Closed-form estimate of the sound source in a local frame, by
+        spherical intersection. Squaring |x - p_i| = c*(t_i - t_x) and
+        subtracting the equation of the first receiver cancels |x|^2
+        and t_x^2, leaving equations linear in x and t_x:
+        2(p_i - p_0)·x - 2c^2(t_i - t_0)t_x = |p_i|^2 - |p_0|^2 - c^2(t_i^2 - t_0^2)
+        Receivers are mostly at the same height, which leaves the
+        altitude poorly determined, so the source is assumed to be at
+        the mean altitude of the receivers and the equations are solved
+        for east, north and t_x in the least squares sense.
+
+        @param local: Array of shape (n, 3) of receivers in a local
+        East-North-Up frame centered on the receivers
+        @param local_times: Array of n timestamps in milliseconds
+        relative to the earliest report
+        @return: Array of east, north, up and t_x, or None if no
+        plausible estimate could be made
+        """
+        if len(local) < 4:
+            return None
+        c2 = SPEED_OF_SOUND_MS**2
+        up = local[:, 2].mean()
+        p, t = local - (0, 0, up), local_times
+        a = np.column_stack((2*(p[1:, :2] - p[0, :2]), -2*c2*(t[1:] - t[0])))
+        b = np.sum(p[1:]**2, axis=1) - np.sum(p[0]**2) - c2*(t[1:]**2 - t[0]**2)
+        try:
+            (east, north, t_x), _, rank, _ = np.linalg.lstsq(a, b, rcond=None)
+        except np.linalg.LinAlgError:
+            return None
+        # The source can not be far away from the receivers or fire after it was heard
+        if rank < 3 or not np.all(np.isfinite((east, north, t_x))) or math.hypot(east, north) > 2*MAX_DISTANCE or t_x > t.min():
+            return None
+        return np.array((east, north, up, t_x))
+
+    def _tdoa_lm(positions: list[Position], timestamps: list[int], closed_form_guess: bool = True,
+                 initial_guess: tuple[Position, int] = None, stats: dict = None) -> tuple[Position, int]:
+        """
+        Solves TDOA with Levenberg-Marquardt, see solve_tdoa
+        """
+        receivers = np.array([p.v for p in positions], dtype=float)
+        times = np.array(timestamps, dtype=float)
+        guess = None
+        if initial_guess is not None and initial_guess[0] is not None:
+            guess = np.append(initial_guess[0].v, initial_guess[1])
+        position, timestamp, cost, evaluations = solve_tdoa(receivers, times, closed_form_guess, guess)
+        if stats is not None:
+            stats["evaluations"] = evaluations
+            stats["cost"] = cost
+
+        if position is None:
+            return None, None
+        return Position(*position), timestamp
+
+    def _tdoa_nelder_mead(positions: list[Position], timestamps: list[int], stats: dict = None) -> tuple[Position, int]:
+        """
+        The original solver, minimizing the sum of squared errors with
+        Nelder-Mead directly over latitude, longitude, altitude and time
+        """
+        receivers = np.array([p.v for p in positions], dtype=float)
+        times = np.array(timestamps, dtype=float)
+
+        def errors(x):
+            return d(x) - SPEED_OF_SOUND_MS*(times-x[3])
+
+        def d(x):
+            return fast_distance(receivers, x[:3])
         
         # The objective functions to minimize using Nelder-Mead algorithm
         # It is a summation of errors squared e_0^2 + e_1^2 + ... + e_n^2
@@ -120,21 +333,214 @@ class Position:
         # transmission and and receiver since position can only be determined on a line
         # in 3d space
         def objective(x):
-            return sum(error(x, i)**2 for i in range(n))
+            return np.sum(errors(x)**2)
         # Starting guess P_0 is midpoint of positions and T_0 earliest gunshot report timestamp
         x0 = Position.midpoint(positions).v + (min(timestamps),)
         # Bounds on latitude and longitude
         bounds = ((-90, 90), (-180, 180), (None, None), (None, None))
         # Minimize using scipy's optimization library
-        sol = scipy.optimize.minimize(objective, x0=x0, method="Nelder-Mead", bounds=bounds, tol=10^-4).x
+        # Note: 10^-4 is XOR and evaluates to -8, so this runs until the iteration limit. Kept as is for comparison
+        result = scipy.optimize.minimize(objective, x0=x0, method="Nelder-Mead", bounds=bounds, tol=10^-4)
+        sol = result.x
+        if stats is not None:
+            stats["evaluations"] = result.nfev
+            stats["cost"] = objective(sol)
 
         # print("Minimization solution:",sol,"Objective value:",objective(sol))
 
-        if objective(sol) > 10000 or any(d(sol, i) > MAX_DISTANCE for i in range(n)):
+        if objective(sol) > 10000 or np.any(d(sol) > MAX_DISTANCE):
             return None, None
         return Position(*sol[:3]), int(sol[3])
 
+def solve_tdoa(receivers: np.ndarray, times: np.ndarray, closed_form_guess: bool = True,
+               initial_guess: np.ndarray = None) -> tuple[np.ndarray, int, float, int]:
+    """
+    Solves TDOA with Levenberg-Marquardt in a local East-North-Up
+    frame centered on the receivers, where all unknowns are in meters
+    and milliseconds relative to the earliest report, and the
+    Jacobian of the residuals is known analytically:
+    e_i = |x - p_i| - c*(t_i - t_x)
+    de_i/dx = (x - p_i) / |x - p_i|
+    de_i/dt_x = c
+    Works on plain arrays, so it can be sent to another process cheaply.
+
+    @param receivers: Array of shape (n, 3) of latitude, longitude
+    and altitude of the sound receivers
+    @param times: Array of n timestamps in milliseconds
+    @param closed_form_guess: Also consider the closed-form estimate
+    of Position.tdoa_closed_form as starting guess
+    @param initial_guess: Optional latitude, longitude, altitude and
+    timestamp to consider as starting guess
+    @return: Tuple of estimated latitude, longitude and altitude (or
+    None if no plausible estimate was found), timestamp (or None),
+    sum of squared errors and number of function evaluations
+    """
+    receivers = np.asarray(receivers, dtype=float)
+    times = np.asarray(times, dtype=float)
+    origin = receivers.mean(axis=0)
+    local = geodetic_to_enu(receivers, origin)
+    t_ref = times.min()
+    local_times = times - t_ref
+
+    def errors(x):
+        return np.linalg.norm(x[:3] - local, axis=1) - SPEED_OF_SOUND_MS*(local_times - x[3])
+
+    def jacobian(x):
+        diff = x[:3] - local
+        d = np.maximum(np.linalg.norm(diff, axis=1), 1e-9)[:, None] # Avoid dividing by zero on top of a receiver
+        return np.hstack((diff / d, np.full((len(local), 1), SPEED_OF_SOUND_MS)))
+
+    # Starting guess is whichever of the midpoint of positions and earliest gunshot report timestamp,
+    # the closed-form estimate and the given initial guess has the lowest error
+    guesses = [np.zeros(4)]
+    if closed_form_guess:
+        guesses.append(Position.tdoa_closed_form(local, local_times))
+    if initial_guess is not None:
+        guesses.append(np.append(geodetic_to_enu(initial_guess[:3], origin), initial_guess[3] - t_ref))
+    x0 = min((guess for guess in guesses if guess is not None), key=lambda guess: np.sum(errors(guess)**2))
+    # Levenberg-Marquardt needs at least as many residuals as unknowns
+    method = "lm" if len(local) >= 4 else "trf"
+    result = scipy.optimize.least_squares(errors, x0, jac=jacobian, method=method, xtol=1e-6, ftol=1e-6)
+    sol = result.x
+    cost = float(np.sum(errors(sol)**2))
+
+    if cost > 10000 or np.any(np.linalg.norm(sol[:3] - local, axis=1) > MAX_DISTANCE):
+        return None, None, cost, result.nfev
+    return enu_to_geodetic(sol[:3], origin), int(sol[3] + t_ref), cost, result.nfev
+
+def pad_events(events: list[tuple[np.ndarray, np.ndarray]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pack a ragged list of events into padded arrays for solve_tdoa_batch
+
+    @param events: List of (receivers, times) per event, where receivers
+    is an array of shape (n, 3) and times an array of n timestamps
+    @return: Tuple of receivers of shape (events, max n, 3), times of
+    shape (events, max n) and a boolean mask of the same shape telling
+    which entries are receivers and which are padding
+    """
+    size = max((len(times) for _, times in events), default=0)
+    receivers = np.zeros((len(events), size, 3))
+    times = np.zeros((len(events), size))
+    mask = np.zeros((len(events), size), dtype=bool)
+    for i, (r, t) in enumerate(events):
+        receivers[i, :len(t)] = r
+        times[i, :len(t)] = t
+        mask[i, :len(t)] = True
+    return receivers, times, mask
+
+def solve_tdoa_batch(receivers: np.ndarray, times: np.ndarray, mask: np.ndarray,
+                     iterations: int = 50, tolerance: float = 1e-6) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Solves TDOA for many events at once with the same method as
+    solve_tdoa, Levenberg-Marquardt in a local East-North-Up frame per
+    event with analytic Jacobian, but with the residuals, Jacobians and
+    damped normal equations of all events evaluated as batched array
+    operations. Each event starts from whichever of the midpoint and
+    the closed-form estimate has the lowest error, and stops updating
+    once it has converged.
+
+    @param receivers: Array of shape (events, n, 3) of latitude,
+    longitude and altitude, padded where the mask is False
+    @param times: Array of shape (events, n) of timestamps in milliseconds
+    @param mask: Boolean array of shape (events, n), True for receivers
+    @param iterations: Maximum number of iterations
+    @param tolerance: Relative step size or decrease of the error considered converged
+    @return: Tuple of estimated positions of shape (events, 3),
+    timestamps of shape (events,) and convergence flags of shape
+    (events,). Flags are False, and positions and timestamps NaN, for
+    events that did not converge to a plausible estimate by the same
+    criteria as solve_tdoa
+    """
+    receivers = np.asarray(receivers, dtype=float)
+    times = np.asarray(times, dtype=float)
+    mask = np.asarray(mask, dtype=bool)
+    weights = mask.astype(float)
+    counts = mask.sum(axis=1)
+    events = len(receivers)
+
+    # Local frame per event, centered on the mean of its receivers and its earliest report
+    origin = np.einsum('en,enk->ek', weights, receivers) / np.maximum(counts, 1)[:, None]
+    latitude, longitude = np.radians(origin[:, 0]), np.radians(origin[:, 1])
+    rotation = np.stack((np.stack((-np.sin(longitude), np.cos(longitude), np.zeros(events)), axis=-1),
+                         np.stack((-np.sin(latitude) * np.cos(longitude), -np.sin(latitude) * np.sin(longitude), np.cos(latitude)), axis=-1),
+                         np.stack((np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude), np.sin(latitude)), axis=-1)), axis=1)
+    local = np.einsum('eij,enj->eni', rotation, geodetic_to_ecef(receivers) - geodetic_to_ecef(origin)[:, None]) * weights[..., None]
+    t_ref = np.where(mask, times, np.inf).min(axis=1)
+    t_ref = np.where(np.isfinite(t_ref), t_ref, 0)
+    local_times = (times - t_ref[:, None]) * weights
+
+    def residuals(x):
+        return (np.linalg.norm(x[:, None, :3] - local, axis=2) - SPEED_OF_SOUND_MS*(local_times - x[:, None, 3])) * weights
+
+    def cost(x):
+        return np.sum(residuals(x)**2, axis=1)
+
+    # Closed-form estimate by spherical intersection, see Position.tdoa_closed_form, as batched normal equations
+    c2 = SPEED_OF_SOUND_MS**2
+    up = np.einsum('en,en->e', weights, local[..., 2]) / np.maximum(counts, 1)
+    p = (local - np.stack((np.zeros(events), np.zeros(events), up), axis=-1)[:, None]) * weights[..., None]
+    first = p[:, :1]
+    a = np.concatenate((2*(p[:, 1:, :2] - first[..., :2]), (-2*c2*(local_times[:, 1:] - local_times[:, :1]))[..., None]), axis=2) * weights[:, 1:, None]
+    b = (np.sum(p[:, 1:]**2, axis=2) - np.sum(first**2, axis=2) - c2*(local_times[:, 1:]**2 - local_times[:, :1]**2)) * weights[:, 1:]
+    ata = np.einsum('eni,enj->eij', a, a)
+    solvable = (counts >= 4) & (np.abs(np.linalg.det(ata)) > 1e-9)
+    ata[~solvable] = np.eye(3)
+    estimate = np.linalg.solve(ata, np.einsum('eni,en->ei', a, b)[..., None])[..., 0]
+    guess = np.column_stack((estimate[:, :2], up, estimate[:, 2]))
+    plausible = solvable & np.all(np.isfinite(guess), axis=1) & (np.hypot(guess[:, 0], guess[:, 1]) <= 2*MAX_DISTANCE) & (guess[:, 3] <= 0)
+    x = np.zeros((events, 4))
+    better = plausible & (cost(guess) < cost(x))
+    x[better] = guess[better]
+
+    # Levenberg-Marquardt with a damping factor per event, updated by the ratio of actual to predicted decrease (Nielsen)
+    damping = np.full(events, 1e-3)
+    growth = np.full(events, 2.0)
+    current = cost(x)
+    converged = np.zeros(events, dtype=bool)
+    for _ in range(iterations):
+        active = ~converged
+        if not np.any(active):
+            break
+        diff = x[:, None, :3] - local
+        distance = np.maximum(np.linalg.norm(diff, axis=2), 1e-9)
+        jacobian = np.concatenate((diff / distance[..., None], np.full((events, local.shape[1], 1), SPEED_OF_SOUND_MS)), axis=2) * weights[..., None]
+        r = residuals(x)
+        jtj = np.einsum('eni,enj->eij', jacobian, jacobian)
+        jtr = np.einsum('eni,en->ei', jacobian, r)
+        diagonal = np.einsum('eii->ei', jtj)
+        # Damp all unknowns equally rather than scaled by the diagonal (Marquardt), since receivers at the same height
+        # leave the altitude column of the Jacobian close to zero. The small constant keeps it invertible
+        scale = diagonal.max(axis=1)
+        damped = jtj + (damping * scale + 1e-9)[:, None, None] * np.eye(4)
+        step = -np.linalg.solve(damped, jtr[..., None])[..., 0]
+        candidate = x + step
+        candidate_cost = cost(candidate)
+        predicted = current - np.sum((r + np.einsum('eni,ei->en', jacobian, step))**2, axis=1)
+        ratio = (current - candidate_cost) / np.maximum(predicted, 1e-300)
+        accept = active & (candidate_cost < current)
+        # Converged like scipy's xtol and ftol, when the step or the relative decrease of the cost is small,
+        # or when no step improves the cost even with heavy damping
+        small_step = np.linalg.norm(step, axis=1) < tolerance * (tolerance + np.linalg.norm(x, axis=1))
+        small_decrease = current - candidate_cost < tolerance * current
+        converged |= (accept & (small_step | small_decrease)) | (active & ~accept & (damping >= 1e10))
+        x[accept] = candidate[accept]
+        current[accept] = candidate_cost[accept]
+        damping = np.where(accept, damping * np.maximum(1/3, 1 - (2*np.clip(ratio, 0, 1) - 1)**3), np.minimum(damping * growth, 1e10))
+        damping = np.maximum(damping, 1e-12)
+        growth = np.where(accept, 2.0, growth * 2)
+
+    distance = np.linalg.norm(x[:, None, :3] - local, axis=2)
+    valid = converged & (counts >= 4) & (current <= 10000) & ~np.any(mask & (distance > MAX_DISTANCE), axis=1)
+
+    ecef = np.einsum('eji,ej->ei', rotation, x[:, :3]) + geodetic_to_ecef(origin)
+    positions = ecef_to_geodetic(ecef)
+    positions[~valid] = np.nan
+    timestamps = np.where(valid, x[:, 3] + t_ref, np.nan)
+    return positions, timestamps, valid
+
 class GunshotReport:
+    __slots__ = ("position", "timestamp", "weapontype", "clientid")
+
     def __init__(self, position: Position, timestamp: int, weapontype: str, clientid: str):
         """
         @param position: Position of the client that heard the gunshot
@@ -173,6 +579,8 @@ class GunshotReport:
 
 class GunshotEvent:
     MIN_CLIENTS = 3
+    INITIAL_CAPACITY = 4
+    """Rows allocated when the columns are built, once an event has COLUMNS_MIN_REPORTS reports, doubled when full"""
 
     def __init__(self, gunshot: GunshotReport):
         """
@@ -180,9 +588,55 @@ class GunshotEvent:
         used to group together with other gunshot reports that are
         believed to be related to the same shooting
         """
-        self.gunshots = [gunshot]
-        self.clients = {gunshot.clientid}
         self.weapontype = gunshot.weapontype
+        self.size = 1
+        """Number of reports in this event"""
+        self.reports = (gunshot,)
+        """The reports of an event with fewer than COLUMNS_MIN_REPORTS reports, None once the columns below are built.
+        The columns are None until then"""
+        self.coordinates = None
+        """Latitude, longitude and altitude of each report, only the first size rows are used"""
+        self.timestamps = None
+        """Timestamp of each report, only the first size entries are used"""
+        self.client_indices = None
+        """Index into client_ids of the client of each report"""
+        self.clients = None
+        """Maps each client ID to its index"""
+        self.client_ids = None
+        self.client_counts = None
+        """Number of reports of each client"""
+        self.first_rows = None
+        """Row of the earliest report of each client, i.e. of the first gunshot fired in this event"""
+        self.max_count = 1
+        self.first_timestamp = gunshot.timestamp
+        self.last_timestamp = gunshot.timestamp
+        self.reference_longitude = gunshot.position.longitude
+        """Longitudes of the bounding box are relative to this, so that the box does not break at the antimeridian"""
+        self.lower = None
+        """Smallest latitude, relative longitude and altitude of the reports, once there are BOUNDS_MIN_REPORTS"""
+        self.upper = None
+        """Largest latitude, relative longitude and altitude of the reports, once there are BOUNDS_MIN_REPORTS"""
+        self.extremes = None
+        """Rows of the reports at the lower and upper bound of each axis, once there are BOUNDS_MIN_REPORTS"""
+        self.position, self.timestamp = None, None
+        self.cost = None
+        """Sum of squared errors of the latest estimate"""
+        self.estimate = None
+        """The latest successful estimate of position and timestamp, used to warm start the next estimate"""
+        self.version = 1
+        """Incremented whenever the first reports change and a new estimate is needed"""
+        self.solved_version = None
+        self.localization = None
+        """Optional LocalizationService to solve in, otherwise solved in the calling thread"""
+
+    @property
+    def gunshots(self) -> list[GunshotReport]:
+        """
+        The reports of this event, built on demand from the arrays
+        """
+        if self.reports is not None:
+            return list(self.reports)
+        return [self._report(row) for row in range(self.size)]
 
     def fits(self, report: GunshotReport):
         '''
@@ -196,8 +650,8 @@ class GunshotEvent:
         otherwise False
         '''
         return (report.weapontype == self.weapontype and
-                self._inside_range(report) and
-                self._within_time_margin(report))
+                self._within_time_margin(report) and
+                self._inside_range(report))
 
     def client_has_added(self, report: GunshotReport):
         '''
@@ -208,7 +662,17 @@ class GunshotEvent:
         @return: True if client reporting has previosly reported to
         this event, otherwise False
         '''
+        if self.reports is not None:
+            return any(added.clientid == report.clientid for added in self.reports)
         return report.clientid in self.clients
+
+    def total_clients(self) -> int:
+        """
+        Return the amount of clients that reported to this event
+        """
+        if self.reports is not None:
+            return len({report.clientid for report in self.reports})
+        return len(self.clients)
     
     def add_report(self, report: GunshotReport):
         '''
@@ -216,8 +680,79 @@ class GunshotEvent:
 
         @param report: The gunshot report to add to event
         '''
-        self.gunshots.append(report)
-        self.clients.add(report.clientid)
+        if self.reports is not None:
+            self._add_to_reports(report)
+            if self.size == COLUMNS_MIN_REPORTS:
+                self._build_columns()
+            return
+        if self.size == len(self.timestamps): # Double the capacity of the arrays
+            # Concatenated rather than np.resize, which returns a view and so keeps two array objects per column
+            self.coordinates = np.concatenate((self.coordinates, np.empty_like(self.coordinates)))
+            self.timestamps = np.concatenate((self.timestamps, np.empty_like(self.timestamps)))
+            self.client_indices = np.concatenate((self.client_indices, np.empty_like(self.client_indices)))
+        row = self.size
+        self.coordinates[row] = report.position.v
+        self.timestamps[row] = report.timestamp
+        self.size += 1
+        self.first_timestamp = min(self.first_timestamp, report.timestamp)
+        self.last_timestamp = max(self.last_timestamp, report.timestamp)
+        if self.lower is not None:
+            self._extend_bounds(row, report.position.v)
+        elif self.size == BOUNDS_MIN_REPORTS:
+            self.lower, self.upper, self.extremes = [math.inf] * 3, [-math.inf] * 3, [0] * 6
+            for previous_row, position in enumerate(self.coordinates[:self.size].tolist()):
+                self._extend_bounds(previous_row, position)
+
+        client = self.clients.get(report.clientid)
+        if client is None: # First report of this client
+            client = self.clients[report.clientid] = len(self.client_ids)
+            self.client_ids.append(report.clientid)
+            self.client_counts.append(0)
+            self.first_rows.append(row)
+            self.version += 1
+        elif report.timestamp < self.timestamps[self.first_rows[client]]: # Reports may arrive out of order
+            self.first_rows[client] = row
+            self.version += 1
+        self.client_indices[row] = client
+        self.client_counts[client] += 1
+        self.max_count = max(self.max_count, self.client_counts[client])
+
+    def _add_to_reports(self, report: GunshotReport):
+        earliest = min((added.timestamp for added in self.reports if added.clientid == report.clientid), default=None)
+        if earliest is None or report.timestamp < earliest: # New client, or an earlier first report of the client
+            self.version += 1
+        self.reports += (report,) # A tuple, which is smaller than a list
+        self.size += 1
+        self.first_timestamp = min(self.first_timestamp, report.timestamp)
+        self.last_timestamp = max(self.last_timestamp, report.timestamp)
+        self.max_count = max(self.max_count, sum(added.clientid == report.clientid for added in self.reports))
+
+    def _build_columns(self):
+        """Move the reports into the columns, adding them again in the same order"""
+        reports, version = self.reports, self.version
+        self.reports = None
+        self.size, self.max_count = 0, 0
+        self.coordinates = np.empty((GunshotEvent.INITIAL_CAPACITY, 3))
+        self.timestamps = np.empty(GunshotEvent.INITIAL_CAPACITY)
+        self.client_indices = np.empty(GunshotEvent.INITIAL_CAPACITY, dtype=np.int32)
+        self.clients, self.client_ids, self.client_counts, self.first_rows = {}, [], [], []
+        for report in reports:
+            self.add_report(report)
+        self.version = version # The first reports did not change
+
+    def _extend_bounds(self, row, position):
+        local = self._local(position)
+        for axis in range(3):
+            if local[axis] < self.lower[axis]:
+                self.lower[axis] = local[axis]
+                self.extremes[2*axis] = row
+            if local[axis] > self.upper[axis]:
+                self.upper[axis] = local[axis]
+                self.extremes[2*axis + 1] = row
+
+    def _report(self, row) -> GunshotReport:
+        return GunshotReport(Position(*self.coordinates[row].tolist()), self.timestamps[row].item(), self.weapontype,
+                             self.client_ids[self.client_indices[row]])
 
     def _inside_range(self, report: GunshotReport):
         """
@@ -229,6 +764,35 @@ class GunshotEvent:
         @return: True if gunshot report was in event range, otherwise
         False
         """
+        if abs(report.position.latitude) > FAST_DISTANCE_MAX_LATITUDE:
+            return all(report.position.distance(gs.position) < MAX_DISTANCE*2 for gs in self.gunshots)
+
+        if self.lower is None: # Few reports, compare against each of them in plain Python
+            positions = [gs.position.v for gs in self.reports] if self.reports is not None else self.coordinates[:self.size].tolist()
+            distances = [_fast_distance_scalar(position, report.position.v) for position in positions]
+            if all(distance < MAX_DISTANCE*2 - FAST_DISTANCE_ERROR for distance in distances):
+                return True
+            if any(distance >= MAX_DISTANCE*2 + FAST_DISTANCE_ERROR for distance in distances):
+                return False
+            return all(report.position.distance(gs.position) < MAX_DISTANCE*2 for gs in self.gunshots)
+
+        # Compare against the nearest and farthest point of the bounding box and the reports at its edges first
+        # in plain Python, since NumPy has more overhead than work for a handful of points
+        local = self._local(report.position.v)
+        nearest = [min(max(x, low), high) for x, low, high in zip(local, self.lower, self.upper)]
+        farthest = [low if x - low > high - x else high for x, low, high in zip(local, self.lower, self.upper)]
+        if _fast_distance_scalar(farthest, local) < MAX_DISTANCE*2 - BOUNDS_MARGIN:
+            return True
+        if (_fast_distance_scalar(nearest, local) >= MAX_DISTANCE*2 + BOUNDS_MARGIN or
+                any(_fast_distance_scalar(extreme, report.position.v) >= MAX_DISTANCE*2 + FAST_DISTANCE_ERROR for extreme in self.coordinates[self.extremes].tolist())):
+            return False
+
+        distances = fast_distance(self.coordinates[:self.size], report.position.v)
+        if np.all(distances < MAX_DISTANCE*2 - FAST_DISTANCE_ERROR):
+            return True
+        if np.any(distances >= MAX_DISTANCE*2 + FAST_DISTANCE_ERROR):
+            return False
+        # Too close to the limit to tell from the approximation
         return all(report.position.distance(gs.position) < MAX_DISTANCE*2 for gs in self.gunshots)
     
     def _within_time_margin(self, report: GunshotReport):
@@ -240,7 +804,18 @@ class GunshotEvent:
         @return: True if gunshot report was within time margin otherwise
         returns False
         """
-        return any(abs(report.timestamp - gs.timestamp) < MAX_TIME_DIFF for gs in self.gunshots)
+        if report.timestamp <= self.first_timestamp - MAX_TIME_DIFF or report.timestamp >= self.last_timestamp + MAX_TIME_DIFF:
+            return False
+        if report.timestamp < self.first_timestamp + MAX_TIME_DIFF or report.timestamp > self.last_timestamp - MAX_TIME_DIFF:
+            return True
+        # Between the first and last report with a gap around it, there may be no report close enough
+        if self.reports is not None:
+            return any(abs(gs.timestamp - report.timestamp) < MAX_TIME_DIFF for gs in self.reports)
+        return bool(np.any(np.abs(self.timestamps[:self.size] - report.timestamp) < MAX_TIME_DIFF))
+
+    def _local(self, position):
+        """Position with the longitude relative to the reference longitude of the bounding box"""
+        return (position[0], (position[1] - self.reference_longitude + 180) % 360 - 180, position[2])
 
     def _get_first_reports(self) -> iter[Position]:
         """
@@ -251,12 +826,13 @@ class GunshotEvent:
         @return: Iterable of gunshot reports of the first gunshot
         in this event
         """
-        clients = set()
-        sorted_gunshots = sorted(self.gunshots, key=lambda gunshot: gunshot.timestamp)
-        for gunshot in sorted_gunshots:
-            if gunshot.clientid not in clients:
-                yield gunshot
-                clients.add(gunshot.clientid)
+        if self.reports is not None:
+            first = {} # Ordered by the first report of each client, like the columns
+            for report in self.reports:
+                if report.clientid not in first or report.timestamp < first[report.clientid].timestamp:
+                    first[report.clientid] = report
+            return iter(first.values())
+        return (self._report(row) for row in self.first_rows)
 
     def total_firings(self) -> int:
         """
@@ -264,20 +840,83 @@ class GunshotEvent:
 
         @return: Integer of amount of gunshots fired
         """
-        return max(sum(1 for report in self.gunshots if report.clientid == clientid) for clientid in self.clients)
+        return self.max_count
     
     def approximations(self) -> tuple[Position, int]:
         """
         Tries to estimate the position where the gun was fired and
         what time instance the first shot was fired using TDOA.
-        If unable to make an estimation, returns (None,None)
+        If unable to make an estimation, returns (None,None).
+        The estimate is only recomputed if the first reports changed
+        since the last call, warm started from the previous estimate.
 
         @return: Tuple of position, timestamp if estimate was
         possible, otherwise None,None
         """
-        first_reports = list(self._get_first_reports()) # Only the report of the first gunshot heard, not following gunshots
-        if len(first_reports) < 4:
+        inputs = self.localization_inputs()
+        if inputs is not None:
+            self.set_estimate(inputs, self.solve_position(inputs))
+        return self.position, self.timestamp
+
+    def localization_inputs(self):
+        """
+        Return what is needed to estimate the position again, copied so
+        that the estimate can be solved while reports are being added,
+        e.g. outside the lock of the observer. Events with fewer than
+        four clients are marked as solved without a position.
+
+        @return: Tuple of version, receivers, times and initial guess,
+        or None if the cached estimate is up to date
+        """
+        if self.solved_version == self.version:
+            return None
+        if self.total_clients() < 4:
             self.position, self.timestamp = None, None
-        else:
-            self.position, self.timestamp = Position.tdoa([r.position for r in first_reports], [r.timestamp for r in first_reports])
-        return self.position, self.timestamp
\ No newline at end of file
+            self.solved_version = self.version
+            return None
+        first_rows = np.array(self.first_rows) # Only the report of the first gunshot heard, not following gunshots
+        guess = np.append(self.estimate[0].v, self.estimate[1]) if self.estimate is not None else None
+        return self.version, self.coordinates[first_rows], self.timestamps[first_rows], guess
+
+    def solve_position(self, inputs):
+        """
+        Solve TDOA for the inputs returned by localization_inputs, in
+        the LocalizationService of the event if it has one. Does not
+        read or change the event.
+
+        @param inputs: The tuple returned by localization_inputs
+        @return: Tuple of position (or None), timestamp and sum of
+        squared errors, or None if the solve timed out
+        """
+        _, receivers, times, guess = inputs
+        try:
+            if self.localization is None:
+                position, timestamp, cost, _ = solve_tdoa(receivers, times, initial_guess=guess)
+            else: # Solve in another process, without holding the GIL of this one
+                position, timestamp, cost, _ = self.localization.solve(receivers, times, guess)
+        except TimeoutError:
+            print(f"WARNING: Timed out estimating the position of an event with {len(times)} clients")
+            return None
+        return position, timestamp, cost
+
+    def set_estimate(self, inputs, result):
+        """
+        Cache the result of solve_position. If clients joined since the
+        inputs were taken the estimate is only kept to warm start the
+        next solve, and the event stays unsolved.
+
+        @param inputs: The tuple returned by localization_inputs
+        @param result: The tuple returned by solve_position
+        """
+        version = inputs[0]
+        if result is None: # Timed out, leave the estimate as not solved so it is tried again on the next call
+            if version == self.version:
+                self.position, self.timestamp = None, None
+            return
+        position, timestamp, cost = result
+        position = Position(*position) if position is not None else None
+        if position is not None:
+            self.estimate = (position, timestamp)
+        if version == self.version:
+            self.position, self.timestamp, self.cost = position, timestamp, cost
+            self.solved_version = version
@@ -1,80 +1,481 @@
 import os
-from threading import Lock
-import firebase_admin
-from firebase_admin import credentials, messaging
+import time
+import heapq
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Event, Lock, Timer
 
 from observer_interface import ObserverInterface
 from subject_interface import SubjectInterface
 from pagdDB_interface import PagdDBInterface
-from gunshot import GunshotReport, GunshotEvent
+from gunshot import GunshotReport, GunshotEvent, MAX_TIME_DIFF
+from event_index import EventIndex
+from id_allocator import IdAllocator
+from snapshot import capture_events, snapshot_arrays, save_snapshot, load_snapshot
+from notifications import NotificationDispatcher
+
+# Settings
+GRACE_PERIOD = 5000 # milliseconds an event is kept after MAX_TIME_DIFF has passed since its latest report, allowing for late reports
+RESOLVE_DEBOUNCE = 0 # seconds to wait for more clients joining an event before estimating its position again, 0 estimates on every join
+EAGER_PERSISTENCE = False # persist every new event as a temporary gunshot, e.g. for auditing, rather than only events reaching MIN_CLIENTS
+SNAPSHOT_PATH = "gunshot_events.snapshot" # file the live events are periodically saved to and recovered from on start, None disables snapshots
+SNAPSHOT_INTERVAL = 5 # seconds between snapshots
+EXPIRY_INTERVAL = 1 # seconds between sweeps finalizing the expired events also when no reports arrive, None disables them
+LATE_REPORT_WINDOW = 60000 # milliseconds behind the current time that sweeps expire events at, since reports may be uploaded late, e.g. in batches buffered by phones, or heard by phones whose clocks run behind
+RECOVERY_MAX_REPORTS = 100000 # maximum number of recent reports read from the database when recovering on start
 
 class GunshotObserver(ObserverInterface):
-    def __init__(self, subject: SubjectInterface, db: PagdDBInterface):
+    def __init__(self, subject: SubjectInterface, db: PagdDBInterface, resolve_debounce = RESOLVE_DEBOUNCE, localization = None,
+                 eager_persistence = EAGER_PERSISTENCE, id_allocator = None, snapshot_path = SNAPSHOT_PATH, recover = True,
+                 notifier = None, feed = None, expiry_interval = EXPIRY_INTERVAL):
         self.subject = subject
         self.subject.attach(self)
         self.db = db
         self.events = set()
+        self.index = EventIndex()
+        self.expiry_heap = [] # (expiry timestamp, event ID, event) of every live event
+        self.watermark = 0 # the latest report timestamp seen, or LATE_REPORT_WINDOW before the latest sweep, never ahead of the current time
         self.gunshot_report = None
         self.lock = Lock()
+        self.id_allocator = id_allocator or IdAllocator(db) # shared by every observer and process persisting to db
+        self.snapshot_path = snapshot_path
+        self.notifier = notifier or NotificationDispatcher() # sends the notifications to the devices from its own thread
+        self.feed = feed # GunshotFeed streaming the stored and updated gunshots to subscribers, if any
+        self.stopped = Event()
+        self.resolve_debounce = resolve_debounce
+        self.localization = localization # LocalizationService to estimate positions in, None estimates in the calling thread
+        self.eager_persistence = eager_persistence
+        self.expiry_interval = expiry_interval
+
+        self.metrics_lock = Lock()
+        self.lock_acquisitions = 0
+        self.lock_wait_total = 0.0
+        self.lock_wait_max = 0.0
+        self.lock_hold_total = 0.0
+        self.lock_hold_max = 0.0
+        self.effects_applied = 0
+        self.effects_total = 0.0
+        self.effect_errors = 0
+        self.expired_events = 0
+        self.unpersisted_events = 0
+        self.snapshots = 0
+        self.snapshot_time = 0.0
+        self.snapshot_hold_time = 0.0
+        self.recovery_time = 0.0
+        self.recovered_events = 0
+        self.recovered_reports = 0
 
-        self._init_firebase()
+        if recover:
+            self.recover()
+        if self.snapshot_path is not None:
+            self.snapshot_thread = Thread(target=self._snapshot_periodically, daemon=True)
+            self.snapshot_thread.start()
+        if self.expiry_interval is not None:
+            self.expiry_thread = Thread(target=self._expire_periodically, daemon=True)
+            self.expiry_thread.start()
 
     def update(self, report):
+        self._add_gunshots([self._to_gunshot_report(report)])
+
+    def update_batch(self, reports):
+        self._add_gunshots([self._to_gunshot_report(report) for report in reports])
+
+    def detach(self):
+        self.subject.detach(self)
+
+    def close(self):
+        """Stop the sweeps and snapshots, finalize the expired events and write the latest state of the live ones, take
+        a final snapshot so the live events are recovered on restart, and send the waiting notifications"""
+        self.stopped.set()
+        if self.expiry_interval is not None:
+            self.expiry_thread.join()
+        if self.snapshot_path is not None:
+            self.snapshot_thread.join()
+
+        with self._timed_lock():
+            self.watermark = max(self.watermark, time.time() * 1000 - LATE_REPORT_WINDOW)
+            expired = self._expire_events()
+            live = [event for event in self.events if event.total_clients() >= GunshotEvent.MIN_CLIENTS]
+            for event in live:
+                self._defer_changes(event)
+        for event in expired + live:
+            self._apply_effects(event)
+
+        if self.snapshot_path is not None:
+            self.snapshot()
+        self.notifier.close()
+
+    def expire(self):
+        """Finalize and evict the events that expired LATE_REPORT_WINDOW before the current time. Reports advance the
+        watermark to their timestamps as they arrive, this also expires the events when none do, e.g. on a quiet server.
+        Sweeping by the current time itself would evict events that late reports may still be heard for, which would
+        then start new events
+        """
+        with self._timed_lock():
+            self.watermark = max(self.watermark, time.time() * 1000 - LATE_REPORT_WINDOW)
+            expired = self._expire_events()
+        for event in expired:
+            self._apply_effects(event)
+
+    def snapshot(self):
+        """Save the live events to the snapshot file. The state is copied while holding the lock and written after
+        releasing it.
+        """
+        start = time.perf_counter()
+        with self._timed_lock():
+            states, watermark = capture_events(self.events), self.watermark
+        hold_time = time.perf_counter() - start
+        save_snapshot(self.snapshot_path, snapshot_arrays(states, watermark))
+        with self.metrics_lock:
+            self.snapshots += 1
+            self.snapshot_time = time.perf_counter() - start
+            self.snapshot_hold_time = hold_time
+
+    def recover(self, now = None):
+        """Rebuild the live events after a restart. The events are loaded from the snapshot if it is recent enough,
+        and the reports received after the snapshot was taken are read from the database. Reports that were already
+        related to a gunshot are added to the event of that gunshot without writing anything, while the other reports
+        are correlated again. The amount of work is bounded by RECOVERY_MAX_REPORTS and by only considering reports
+        recent enough to belong to a live event.
+        @param now (float, optional): the current UNIX timestamp in milliseconds, defaults to the time of the system
+        """
+        start = time.perf_counter()
+        now = now or time.time() * 1000
+        window_start = now - (LATE_REPORT_WINDOW + MAX_TIME_DIFF + GRACE_PERIOD) # Events the sweeps would still keep live
+        events, watermark = [], 0
+        if self.snapshot_path is not None and os.path.exists(self.snapshot_path):
+            try:
+                events, watermark = load_snapshot(self.snapshot_path)
+            except Exception as e:
+                print(f"ERROR: Failed to load the snapshot {self.snapshot_path}, recovering from the database.\n\t{str(e)}")
+        if watermark < window_start: # Every event in the snapshot has expired
+            events, watermark = [], 0
+
+        try:
+            rows = self.db.get_recent_reports(window_start - MAX_TIME_DIFF, RECOVERY_MAX_REPORTS)
+        except Exception as e:
+            print(f"ERROR: Failed to read recent reports, recovering only from the snapshot.\n\t{str(e)}")
+            rows = []
+
+        with self._timed_lock():
+            self.watermark = watermark
+            by_id = {}
+            for event in events:
+                self._track_event(event)
+                by_id[event.event_id] = event
+            known = {report_id for event in events for report_id in event.report_ids}
+            unrelated = []
+            for report_id, timestamp, lat, long, alt, gun, client_id, gunshot_id in rows:
+                if gunshot_id in by_id: # The gunshot of the event may have been stored after the snapshot was taken
+                    by_id[gunshot_id].pending_reports = None
+                if report_id in known:
+                    continue
+                report = GunshotReport.from_coordinates((lat, long, alt), timestamp, gun, client_id)
+                if gunshot_id is None:
+                    unrelated.append((report_id, report))
+                    continue
+                event = by_id.get(gunshot_id)
+                if event is None: # Persisted after the snapshot was taken
+                    event = by_id[gunshot_id] = self._new_event(gunshot_id, report_id, report)
+                    event.pending_reports = None
+                else:
+                    self._add_to_event(event, report_id, report)
+                self.watermark = max(self.watermark, min(timestamp, now))
+            recovered_reports = sum(event.size for event in by_id.values())
+
+        self._add_gunshots(unrelated) # Correlate the rest again, which also expires the events that ended while down
+
+        with self.metrics_lock:
+            self.recovery_time = time.perf_counter() - start
+            self.recovered_events = len(by_id)
+            self.recovered_reports = recovered_reports
+        if by_id or unrelated:
+            print(f"Recovered {len(by_id)} events from {len(events)} snapshotted events and {len(rows)} recent reports "
+                  f"in {self.recovery_time * 1000:.0f} ms")
+
+    def metrics(self):
+        """Return statistics on how long the correlation lock is held and how long the deferred effects take
+        @return (dict): number of lock acquisitions, total/average/max wait and hold times, and effect times
+        """
+        with self.metrics_lock:
+            return {
+                "live_events": len(self.events),
+                "expired_events": self.expired_events,
+                "unpersisted_events": self.unpersisted_events,
+                "lock_acquisitions": self.lock_acquisitions,
+                "avg_lock_wait_ms": self.lock_wait_total / self.lock_acquisitions * 1000 if self.lock_acquisitions else 0.0,
+                "max_lock_wait_ms": self.lock_wait_max * 1000,
+                "avg_lock_hold_ms": self.lock_hold_total / self.lock_acquisitions * 1000 if self.lock_acquisitions else 0.0,
+                "max_lock_hold_ms": self.lock_hold_max * 1000,
+                "effects_applied": self.effects_applied,
+                "avg_effect_ms": self.effects_total / self.effects_applied * 1000 if self.effects_applied else 0.0,
+                "effect_errors": self.effect_errors,
+                "snapshots": self.snapshots,
+                "last_snapshot_ms": self.snapshot_time * 1000,
+                "last_snapshot_lock_ms": self.snapshot_hold_time * 1000,
+                "recovery_ms": self.recovery_time * 1000,
+                "recovered_events": self.recovered_events,
+                "recovered_reports": self.recovered_reports
+            }
+
+    def _to_gunshot_report(self, report):
         report_id = report[0]
         position = report[1]
         timestamp = report[2]
         weapontype = report[3]
         clientid = report[4]
 
-        gunshot_report = GunshotReport.from_coordinates(position, timestamp, weapontype, clientid)
-        self._add_gunshot(report_id, gunshot_report)
+        return report_id, GunshotReport.from_coordinates(position, timestamp, weapontype, clientid)
 
-    def detach(self):
-        self.subject.detach(self)
+    def _add_gunshots(self, reports):
+        """Correlate reports with events in two phases. The in-memory decisions are made while holding the lock,
+        while the resulting DB writes and notifications are deferred to each event and applied after releasing it.
+        @param reports (list[tuple]): a list of (report_id, GunshotReport) in the order they should be processed
+        """
+        events = []
+        with self._timed_lock():
+            for report_id, report in reports:
+                events.append(self._match_gunshot(report_id, report))
+                self.watermark = max(self.watermark, min(report.timestamp, time.time() * 1000))
+            events.extend(self._expire_events())
+
+        for event in dict.fromkeys(events): # Unique events in the order they were touched
+            self._apply_effects(event)
+
+    def _match_gunshot(self, report_id, report):
+        """Decision phase, must be called while holding the lock. Adds the report to a fitting event or creates a new
+        event, and defers the effects of the decision to the event.
+        @return (GunshotEvent): the event that the report was added to
+        """
+        candidates = [event for event in self.index.candidates(report) if event.fits(report)] # Only nearby events may fit
+        for event in candidates: # Try to find an event that fits with a report from the same client
+            if event.client_has_added(report):
+                self._add_to_event(event, report_id, report)
+                self._add_relation(event, report_id)
+                return event # Since it has found an event
+
+        for event in candidates: # Try to find an event that fits
+            if not event.client_has_added(report):
+                self._add_to_event(event, report_id, report)
+                num_of_clients = event.total_clients()
+                if num_of_clients > GunshotEvent.MIN_CLIENTS and self.resolve_debounce > 0:
+                    # Wait for more clients to join before estimating again, so a burst of joins results in one estimate
+                    self._add_relation(event, report_id)
+                    if not event.resolve_pending:
+                        event.resolve_pending = True
+                        timer = Timer(self.resolve_debounce, self._resolve, (event,))
+                        timer.daemon = True
+                        timer.start()
+                    return event
+
+                if num_of_clients == GunshotEvent.MIN_CLIENTS:
+                    pending_reports, event.pending_reports = event.pending_reports or [], None
+                    self._defer(event, self._estimate_and_persist, event, report_id, True, pending_reports)
+                elif num_of_clients > GunshotEvent.MIN_CLIENTS:
+                    self._defer(event, self._estimate_and_persist, event, report_id)
+                else:
+                    self._add_relation(event, report_id)
+                return event # Since it has found an event
 
-    def _add_gunshot(self, report_id, report):
+        # Create new event
+        event = self._new_event(self._next_event_id(), report_id, report)
+        if self.eager_persistence:
+            event.pending_reports = None
+            self._defer(event, self.db.add_temp_gunshot, event.event_id, report_id, event.weapontype)
+        else: # Most events never reach MIN_CLIENTS, keep them in memory until they do
+            event.pending_reports = [report_id]
+        return event
+
+    def _new_event(self, event_id, report_id, report):
+        """Create and track a new event with a single report. Must be called while holding the lock."""
+        event = GunshotEvent(report)
+        event.event_id = event_id
+        event.report_ids = [report_id]
+        event.persisted = None
+        self._track_event(event)
+        return event
+
+    def _track_event(self, event):
+        """Make an event live. Must be called while holding the lock."""
+        event.effects = deque()
+        event.effects_lock = Lock()
+        event.resolve_pending = False
+        event.localization = self.localization
+        self.events.add(event)
+        for report in event.gunshots:
+            self.index.add(event, report)
+        heapq.heappush(self.expiry_heap, (self._expiry(event), event.event_id, event))
+
+    def _add_to_event(self, event, report_id, report):
+        """Add a report to a live event. Must be called while holding the lock."""
+        event.add_report(report)
+        event.report_ids.append(report_id)
+        self.index.add(event, report)
+
+    def _add_relation(self, event, report_id):
+        """Relate a report to the gunshot of an event, or hold on to it until the gunshot is stored"""
+        if event.pending_reports is not None:
+            event.pending_reports.append(report_id)
+        else:
+            self._defer(event, self.db.add_gunshot_report_relation, event.event_id, report_id)
+
+    def _expiry(self, event):
+        return event.last_timestamp + MAX_TIME_DIFF + GRACE_PERIOD
+
+    def _expire_events(self):
+        """Finalize and evict the events that can no longer receive reports, i.e. whose latest report is older than
+        MAX_TIME_DIFF plus GRACE_PERIOD compared to the watermark. Must be called while holding the lock.
+        Events are popped from a heap ordered by expiry, so only expired events are visited. An event that received
+        reports after being pushed is pushed again with its new expiry.
+        @return (list[GunshotEvent]): the finalized events, which may have pending effects
+        """
+        expired = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= self.watermark:
+            _, event_id, event = heapq.heappop(self.expiry_heap)
+            expiry = self._expiry(event)
+            if expiry > self.watermark: # Received more reports since it was pushed
+                heapq.heappush(self.expiry_heap, (expiry, event_id, event))
+                continue
+
+            self.events.discard(event)
+            self.index.remove(event)
+            self._finalize(event)
+            expired.append(event)
+
+        with self.metrics_lock:
+            self.expired_events += len(expired)
+        return expired
+
+    def _finalize(self, event):
+        """Persist the final state of an event once, if it changed since it was last written. Reports from clients
+        that already reported to the event only add a relation, so e.g. the number of shots fired may be outdated.
+        Events that never reached MIN_CLIENTS are dropped, and were never written unless persisting eagerly.
+        """
+        if event.total_clients() < GunshotEvent.MIN_CLIENTS:
+            if event.pending_reports is not None:
+                with self.metrics_lock:
+                    self.unpersisted_events += 1
+            return
+        self._defer_changes(event)
+
+    def _resolve(self, event):
+        """Estimate the position of an event again after the debounce period, called from a timer"""
+        with self._timed_lock():
+            event.resolve_pending = False
+            if event not in self.events: # Already finalized
+                return
+            self._defer_changes(event)
+        self._apply_effects(event)
+
+    def _defer_changes(self, event):
+        """Defer an estimate of the position of an event, which is cached unless clients joined, and an update of the
+        gunshot if it changed since it was last written. Must be called while holding the lock.
+        """
+        self._defer(event, self._estimate_and_persist, event, None, False, (), True)
+
+    def _next_event_id(self):
+        """Allocate the ID of a new event from a block reserved in the database, unique across processes"""
+        return self.id_allocator.next()
+
+    def _defer(self, event, effect, *args):
+        event.effects.append((effect, args))
+
+    def _apply_effects(self, event):
+        """Effects phase. Applies the pending effects of an event in the order they were decided. Whichever thread
+        holds the effect lock of the event applies all of its pending effects, including those deferred by other threads.
+        """
+        with event.effects_lock:
+            while event.effects:
+                effect, args = event.effects.popleft()
+                start = time.perf_counter()
+                try:
+                    effect(*args)
+                except Exception as e:
+                    print(f"ERROR: Failed to apply the effect of gunshot {event.event_id}.\n\t{str(e)}")
+                    with self.metrics_lock:
+                        self.effect_errors += 1
+                with self.metrics_lock:
+                    self.effects_applied += 1
+                    self.effects_total += time.perf_counter() - start
+
+    def _estimate_and_persist(self, event, report_id, store = False, pending_reports = (), only_changes = False):
+        """Effect estimating the position of an event and storing or updating its gunshot. The inputs are copied and
+        the result applied while holding the lock, but the estimate is solved without it, so matching other reports
+        does not wait for the solver. Effects of the event are applied in order, so its estimates are too.
+        @param report_id (int): the report that joined the event, if any, to relate to the gunshot
+        @param store (bool): store the gunshot, which the event just reached MIN_CLIENTS for, rather than update it
+        @param pending_reports (list[int]): the reports received before the gunshot was stored
+        @param only_changes (bool): skip the update if the gunshot did not change since it was last written
+        """
+        with self._timed_lock():
+            inputs = event.localization_inputs()
+        result = event.solve_position(inputs) if inputs is not None else None
+
+        with self._timed_lock():
+            if inputs is not None:
+                event.set_estimate(inputs, result)
+            p, timestamp = event.position, event.timestamp # May be None if clients < 4 or position could not be determined
+            lat, long, alt = p.v if p is not None else (None, None, None)
+            shots_fired = event.total_firings()
+            if only_changes and (timestamp, lat, long, alt, shots_fired) == event.persisted:
+                return
+            event.persisted = (timestamp, lat, long, alt, shots_fired)
+
+        if store:
+            self._store_gunshot(event.event_id, report_id, timestamp, lat, long, alt, event.weapontype, shots_fired, p is not None,
+                                pending_reports)
+        else:
+            self._update_gunshot(event.event_id, report_id, timestamp, lat, long, alt, event.weapontype, shots_fired, p is not None)
+
+    def _store_gunshot(self, gunshot_id, report_id, timestamp, lat, long, alt, weapontype, shots_fired, notify, pending_reports = ()):
+        gunshot = self.db.add_gunshot(gunshot_id, report_id, timestamp, lat, long, alt, weapontype, shots_fired)
+        if pending_reports: # The reports received before the gunshot was stored
+            self.db.add_gunshot_report_relations(gunshot_id, pending_reports)
+        if notify and gunshot is not None: # Notify devices if the position could be determined
+            self._notify_devices(gunshot)
+
+    def _update_gunshot(self, gunshot_id, report_id, timestamp, lat, long, alt, weapontype, shots_fired, notify):
+        if report_id is not None:
+            self.db.add_gunshot_report_relation(gunshot_id, report_id)
+        gunshot = self.db.update_gunshot(gunshot_id, timestamp, lat, long, alt, weapontype, shots_fired)
+        if notify and gunshot is not None: # Notify devices if the position could be determined
+            self._notify_devices(gunshot, True)
+
+    def _expire_periodically(self):
+        while not self.stopped.wait(self.expiry_interval):
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"ERROR: Failed to expire the live events.\n\t{str(e)}")
+
+    def _snapshot_periodically(self):
+        while not self.stopped.wait(SNAPSHOT_INTERVAL):
+            try:
+                self.snapshot()
+            except Exception as e:
+                print(f"ERROR: Failed to save the snapshot {self.snapshot_path}.\n\t{str(e)}")
+
+    @contextmanager
+    def _timed_lock(self):
+        """Hold the lock while measuring how long it took to acquire and how long it was held"""
+        wait_start = time.perf_counter()
         with self.lock:
-            for event in self.events: # Try to find an event that fits with a report from the same client
-                if event.fits(report) and event.client_has_added(report):
-                    event.add_report(report)
-                    self.db.add_gunshot_report_relation(event.event_id, report_id)
-                    break # Since it has found an event
-            else: # Try to find an event that fits
-                for event in self.events:
-                    if event.fits(report) and not event.client_has_added(report):
-                        event.add_report(report)
-                        p, timestamp = event.approximations() # May be None if clients < 3 or position could not be determined
-                        num_of_clients = len(event.clients)
-                        if p is not None:
-                            lat, long, alt = p.v
-                        else:
-                            lat, long, alt = None, None, None
-
-                        if num_of_clients == GunshotEvent.MIN_CLIENTS:
-                            gunshot = self.db.add_gunshot(event.event_id, report_id, timestamp, lat, long, alt, event.weapontype, event.total_firings())
-                            if p is not None: # Notify devices if the position could be determined
-                                self._notify_devices(gunshot)
-                        elif num_of_clients > GunshotEvent.MIN_CLIENTS:
-                            self.db.add_gunshot_report_relation(event.event_id, report_id)
-                            gunshot = self.db.update_gunshot(event.event_id, timestamp, lat, long, alt, event.weapontype, event.total_firings())
-                            if p is not None: # Notify devices if the position could be determined
-                                self._notify_devices(gunshot, True)
-                        else:
-                            self.db.add_gunshot_report_relation(event.event_id, report_id)
-                        break # Since it has found an event
-                else: # Create new event
-                    event = GunshotEvent(report)
-                    event.event_id = self.db.get_latest_gunshot_id() + 1
-                    self.events.add(event)
-                    self.db.add_temp_gunshot(event.event_id, report_id, event.weapontype)
-
-    def _init_firebase(self):
-        cred = credentials.Certificate(os.environ["FIREBASE_CREDENTIALS"])
-        firebase_admin.initialize_app(cred)
-    
-    def _notify_devices(self, data, is_update = False):
-        for k, v in data.items():
-            data[k] = str(v)
-        data["update"] = "1" if is_update else "0"
-        message = messaging.Message(data, topic="all")
-        messaging.send(message)
\ No newline at end of file
+            hold_start = time.perf_counter()
+            try:
+                yield
+            finally:
+                hold_end = time.perf_counter()
+        self._record_lock_times(hold_start - wait_start, hold_end - hold_start)
+
+    def _record_lock_times(self, wait, hold):
+        with self.metrics_lock:
+            self.lock_acquisitions += 1
+            self.lock_wait_total += wait
+            self.lock_wait_max = max(self.lock_wait_max, wait)
+            self.lock_hold_total += hold
+            self.lock_hold_max = max(self.lock_hold_max, hold)
+
+    def _notify_devices(self, gunshot, is_update = False):
+        self.notifier.notify(gunshot, is_update)
+        if self.feed is not None:
+            self.feed.publish(gunshot)
\ No newline at end of file
@@ -1,9 +1,37 @@
+import time
+import queue
+from threading import Thread, Lock
+
 from subject_interface import SubjectInterface
 
 class GunshotSubject(SubjectInterface):
-    def __init__(self):
+    def __init__(self, workers = 0, queue_size = 1024, put_timeout = None):
+        """
+        @param workers (int): number of worker threads dispatching reports to the observers. With 0 workers the
+        observers are notified synchronously on the calling thread. Reports are only guaranteed to be
+        processed in the order they arrived when using a single worker
+        @param queue_size (int): maximum number of pending notifications before notify starts blocking
+        @param put_timeout (float, optional): seconds to wait for a free slot in a full queue before the calling
+        thread notifies the observers itself instead. None, the default, blocks until a slot is free (backpressure),
+        since a notification run by the calling thread overtakes those still in the queue and breaks the order
+        """
         self.observers = []
-    
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=queue_size) if workers > 0 else None
+        self.workers = [Thread(target=self._dispatch, daemon=True) for _ in range(workers)]
+
+        self.metrics_lock = Lock()
+        self.enqueued = 0
+        self.dispatched = 0
+        self.caller_runs = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+        for worker in self.workers:
+            worker.start()
+
     def attach(self, observer):
         self.observers.append(observer)
 
@@ -11,5 +39,76 @@ class GunshotSubject(SubjectInterface):
         self.observers.remove(observer)
 
     def notify(self, report):
+        self._submit(self._notify_observers, report)
+
+    def notify_batch(self, reports):
+        self._submit(self._notify_observers_batch, reports)
+
+    def close(self):
+        """Stop the worker threads after the pending notifications have been dispatched"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def metrics(self):
+        """Return dispatch and backpressure statistics
+        @return (dict): queue depth, number of enqueued, dispatched and caller-run notifications, errors and time spent in the queue
+        """
+        with self.metrics_lock:
+            return {
+                "workers": len(self.workers),
+                "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "queue_capacity": self.queue.maxsize if self.queue is not None else 0,
+                "max_queue_depth": self.max_queue_depth,
+                "enqueued": self.enqueued,
+                "dispatched": self.dispatched,
+                "caller_runs": self.caller_runs,
+                "errors": self.errors,
+                "avg_queue_wait_ms": self.total_queue_wait / self.dispatched * 1000 if self.dispatched else 0.0,
+                "max_queue_wait_ms": self.max_queue_wait * 1000
+            }
+
+    def _notify_observers(self, report):
         for observer in self.observers:
             observer.update(report)
+
+    def _notify_observers_batch(self, reports):
+        for observer in self.observers:
+            observer.update_batch(reports)
+
+    def _submit(self, target, data):
+        if self.queue is None:
+            target(data)
+            return
+
+        try:
+            self.queue.put((target, data, time.monotonic()), timeout=self.put_timeout)
+        except queue.Full: # The workers can not keep up, process the notification on the calling thread
+            with self.metrics_lock:
+                self.caller_runs += 1
+            target(data)
+            return
+
+        with self.metrics_lock:
+            self.enqueued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def _dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is None: # Stop signal from close()
+                break
+            target, data, enqueued_at = item
+            wait = time.monotonic() - enqueued_at
+            try:
+                target(data)
+            except Exception as e:
+                print(f"ERROR: Observer failed to process a notification.\n\t{str(e)}")
+                with self.metrics_lock:
+                    self.errors += 1
+            with self.metrics_lock:
+                self.dispatched += 1
+                self.total_queue_wait += wait
+                self.max_queue_wait = max(self.max_queue_wait, wait)
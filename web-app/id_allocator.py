@@ -0,0 +1,48 @@
+from threading import Lock
+
+from pagdDB_interface import PagdDBInterface
+
+ID_BLOCK_SIZE = 100
+"""Number of IDs reserved from the database at a time"""
+
+
+class IdAllocator:
+    """
+    Hands out unique IDs from blocks reserved in the database. Each block
+    is reserved by atomically incrementing a counter row, so any number of
+    allocators, in this or other processes, can hand out IDs at the same
+    time without collisions and with one round trip per block. IDs left in
+    a block when the process exits are never used.
+    """
+
+    def __init__(self, db: PagdDBInterface, name = "gunshot", block_size = ID_BLOCK_SIZE):
+        """
+        @param db: Database to reserve the blocks in
+        @param name: Name of the counter row to reserve from
+        @param block_size: Number of IDs to reserve at a time
+        """
+        self.db = db
+        self.name = name
+        self.block_size = block_size
+        self.lock = Lock()
+        self.next_id = 0
+        self.end_id = 0
+        """The first ID after the reserved block"""
+        self.reserved_blocks = 0
+
+    def next(self) -> int:
+        """
+        Return a new unique ID, reserving a new block if the current one is used up
+
+        @return: The ID
+        @raise RuntimeError: If a new block could not be reserved
+        """
+        with self.lock:
+            if self.next_id >= self.end_id:
+                first_id = self.db.reserve_ids(self.name, self.block_size)
+                if first_id is None:
+                    raise RuntimeError(f"could not reserve {self.block_size} IDs from the {self.name} counter")
+                self.next_id, self.end_id = first_id, first_id + self.block_size
+                self.reserved_blocks += 1
+            self.next_id += 1
+            return self.next_id - 1
@@ -0,0 +1,127 @@
+import time
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+import numpy as np
+
+from gunshot import solve_tdoa, solve_tdoa_batch, pad_events
+
+SOLVE_TIMEOUT = 2
+"""Seconds to wait for a solve in a worker process before giving up on it"""
+BATCH_CHUNK = 2000
+"""Number of events solved together in one batch by solve_batch"""
+
+
+class LocalizationService:
+    """
+    Solves TDOA for gunshot events in a pool of worker processes, so that
+    the optimization does not hold the GIL of the process serving
+    requests. With 0 processes the solves run in the calling thread.
+    """
+
+    def __init__(self, processes = 0, timeout = SOLVE_TIMEOUT):
+        """
+        @param processes: Number of worker processes, 0 solves in the calling thread
+        @param timeout: Seconds to wait for a solve before giving up on it
+        """
+        self.processes = processes
+        self.timeout = timeout
+        # Spawn rather than fork, since the server process is multi-threaded
+        self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) if processes > 0 else None
+        self.lock = Lock()
+        self.solves = 0
+        self.timeouts = 0
+        self.solve_total = 0.0
+        self.solve_max = 0.0
+
+        if self.executor is not None: # Start the workers and import the solver in them before the first real solve
+            receivers = np.array([[0, 0, 0], [0, 0.001, 0], [0.001, 0, 0], [0.001, 0.001, 0]], dtype=float)
+            concurrent.futures.wait([self.executor.submit(solve_tdoa, receivers, np.zeros(4)) for _ in range(processes)])
+
+    def solve(self, receivers: np.ndarray, times: np.ndarray, initial_guess: np.ndarray = None):
+        """
+        Solve TDOA for the given receivers, see gunshot.solve_tdoa.
+        Waits for the result, so callers should not hold locks that
+        others need while solving.
+
+        @param receivers: Array of shape (n, 3) of latitude, longitude and altitude
+        @param times: Array of n timestamps in milliseconds
+        @param initial_guess: Optional latitude, longitude, altitude and timestamp to warm start from
+        @return: Tuple of estimated position (or None), timestamp (or None), sum of squared errors and number of evaluations
+        @raise TimeoutError: If the solve did not finish within the timeout
+        """
+        start = time.perf_counter()
+        if self.executor is None:
+            result = solve_tdoa(receivers, times, initial_guess=initial_guess)
+            self._record(time.perf_counter() - start)
+            return result
+
+        # Float arrays are pickled as compact buffers
+        future = self.executor.submit(solve_tdoa, np.ascontiguousarray(receivers, dtype=float),
+                                      np.ascontiguousarray(times, dtype=float), True, initial_guess)
+        try:
+            result = future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.timeouts += 1
+            raise TimeoutError(f"solve did not finish within {self.timeout} seconds")
+        self._record(time.perf_counter() - start)
+        return result
+
+    def solve_batch(self, events: list[tuple[np.ndarray, np.ndarray]]):
+        """
+        Solve TDOA for many events at once, e.g. when re-localizing after
+        a widespread incident or re-running historical data. Events are
+        padded into chunks of BATCH_CHUNK solved with solve_tdoa_batch,
+        spread over the worker processes if there are any.
+
+        @param events: List of (receivers, times) per event, see gunshot.pad_events
+        @return: Tuple of positions of shape (events, 3), timestamps of shape (events,) and convergence flags, see gunshot.solve_tdoa_batch
+        """
+        # Sort by number of receivers so that each chunk needs little padding
+        order = sorted(range(len(events)), key=lambda i: len(events[i][1]))
+        chunks = [[events[i] for i in order[start:start + BATCH_CHUNK]] for start in range(0, len(order), BATCH_CHUNK)]
+        if self.executor is None:
+            results = [solve_tdoa_batch(*pad_events(chunk)) for chunk in chunks]
+        else:
+            results = list(self.executor.map(solve_tdoa_batch, *zip(*(pad_events(chunk) for chunk in chunks))))
+
+        positions = np.full((len(events), 3), np.nan)
+        timestamps = np.full(len(events), np.nan)
+        converged = np.zeros(len(events), dtype=bool)
+        indices = np.array(order, dtype=int)
+        offset = 0
+        for chunk_positions, chunk_timestamps, chunk_converged in results:
+            chunk_indices = indices[offset:offset + len(chunk_timestamps)]
+            positions[chunk_indices] = chunk_positions
+            timestamps[chunk_indices] = chunk_timestamps
+            converged[chunk_indices] = chunk_converged
+            offset += len(chunk_timestamps)
+        return positions, timestamps, converged
+
+    def close(self):
+        """Shut down the worker processes, cancelling solves that have not started"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def metrics(self):
+        """Return statistics of the solves
+        @return (dict): number of processes and solves, timeouts and solve times
+        """
+        with self.lock:
+            return {
+                "processes": self.processes,
+                "solves": self.solves,
+                "timeouts": self.timeouts,
+                "avg_solve_ms": self.solve_total / self.solves * 1000 if self.solves else 0.0,
+                "max_solve_ms": self.solve_max * 1000
+            }
+
+    def _record(self, duration):
+        with self.lock:
+            self.solves += 1
+            self.solve_total += duration
+            self.solve_max = max(self.solve_max, duration)
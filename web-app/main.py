@@ -1,25 +1,60 @@
 from getpass import getpass
 from flask import Flask
-from app import create_routes
+from app import create_routes, SECRET_KEY
 
 from pagdDB import PagdDB
 from gunshot_subject import GunshotSubject
 from gunshot_observer import GunshotObserver
+from localization import LocalizationService
+from push import GunshotFeed, PushServer, PUSH_ADDRESS
+
+# Settings
+DB_POOL_SIZE = 32 # database connections shared by the request threads, the report writer and the observer, at most 32
+DISPATCH_WORKERS = 1 # threads notifying the observers of new reports, 0 notifies them on the request thread
+DISPATCH_QUEUE_SIZE = 1024 # maximum number of reports waiting to be processed by the observers
+LOCALIZATION_PROCESSES = 2 # worker processes estimating gunshot positions, 0 estimates them in the server process
+USE_CORRELATOR = False # send reports to a separately started correlator (python correlator.py) rather than correlating them in this process. The push server streaming gunshots to subscribers is then not started, since the gunshots are stored by the correlator
 
 def main():
     # Database
-    db = PagdDB("localhost", "pagd", getpass("Database password: "))
+    db = PagdDB("localhost", "pagd", getpass("Database password: "), DB_POOL_SIZE)
 
     # API server
     app = Flask(__name__)
 
     # Watch the API server for updates
-    gunshot_subject = GunshotSubject()
-    gunshot_observer = GunshotObserver(gunshot_subject, db)
+    if USE_CORRELATOR:
+        from correlator import CorrelatorClient, CORRELATOR_ADDRESS # requires CORRELATOR_AUTHKEY in the environment
+        gunshot_subject = CorrelatorClient(CORRELATOR_ADDRESS)
+        metrics = {
+            "database": db.metrics,
+            "correlator": gunshot_subject.metrics
+        }
+    else:
+        gunshot_subject = GunshotSubject(DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE)
+        localization = LocalizationService(LOCALIZATION_PROCESSES)
+        feed = GunshotFeed()
+        gunshot_observer = GunshotObserver(gunshot_subject, db, localization=localization, feed=feed)
+        push_server = PushServer(feed, SECRET_KEY, PUSH_ADDRESS) # streams new and updated gunshots to subscribers
+        metrics = {
+            "database": db.metrics,
+            "dispatch": gunshot_subject.metrics,
+            "correlation": gunshot_observer.metrics,
+            "notifications": gunshot_observer.notifier.metrics,
+            "localization": localization.metrics,
+            "push": push_server.metrics
+        }
 
     # Set up the API server routes
-    create_routes(app, db, gunshot_subject)
-    app.run(debug=False, threaded=True)
+    create_routes(app, db, gunshot_subject, metrics)
+    try:
+        app.run(debug=False, threaded=True)
+    finally:
+        gunshot_subject.close() # Dispatch the queued reports before the observer is closed
+        if not USE_CORRELATOR:
+            gunshot_observer.close() # Take a final snapshot of the live events
+            localization.close()
+            push_server.close()
 
     
 if __name__ == "__main__":
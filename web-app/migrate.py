@@ -0,0 +1,113 @@
+import os
+import re
+import time
+import argparse
+from getpass import getpass
+
+from database import Database
+
+# Settings
+MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "migrations") # directory of the migration scripts
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$") # name of a migration script, e.g. 0001_timestamp_indexes.sql
+
+
+def split_statements(script):
+    """Split an SQL script into statements, following DELIMITER directives like the mysql client does
+    @param script (string): the SQL script
+    @return (list[string]): the statements without their delimiters
+    """
+    statements = []
+    lines = []
+    delimiter = ";"
+    for line in script.splitlines():
+        stripped = line.strip()
+        if stripped.upper().startswith("DELIMITER "):
+            delimiter = stripped.split()[1]
+            continue
+        if not stripped or stripped.startswith("--"): # Comments may end with the delimiter
+            continue
+        lines.append(line)
+        if stripped.endswith(delimiter):
+            statements.append("\n".join(lines).rstrip()[:-len(delimiter)].strip())
+            lines = []
+    if lines:
+        statements.append("\n".join(lines).strip())
+    return statements
+
+
+def list_migrations(path = MIGRATIONS_PATH):
+    """Return the migration scripts in order of their version, the number their name starts with
+    @param path (string): directory of the migration scripts
+    @return (list[tuple]): (version, name, file path) tuples
+    """
+    migrations = []
+    for file_name in os.listdir(path):
+        match = MIGRATION_FILE.match(file_name)
+        if match is not None:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(path, file_name)))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"migration versions in {path} are not unique")
+    return migrations
+
+
+def applied_migrations(db: Database):
+    """Return the versions of the migrations applied to the database, creating the table recording them if needed
+    @param db (Database): the database
+    @return (set[int]): the applied versions
+    """
+    db.execute("""CREATE TABLE IF NOT EXISTS SchemaMigrations(
+                    version    INT PRIMARY KEY,
+                    name       VARCHAR(255) NOT NULL,
+                    applied_at BIGINT NOT NULL
+                );""")
+    result, _ = db.execute("SELECT version FROM SchemaMigrations;")
+    return {version for version, in result}
+
+
+def migrate(db: Database, path = MIGRATIONS_PATH, target = None):
+    """Apply the migrations that are not yet applied to the database, in order of their version. Each migration is
+    recorded once all its statements succeeded. MariaDB commits every schema change immediately, so a failed migration
+    is not rolled back and must be fixed by hand, which is why the statements of migrations should be idempotent
+    (IF NOT EXISTS, CREATE OR REPLACE)
+    @param db (Database): the database, created with sql/tables.sql
+    @param path (string, optional): directory of the migration scripts
+    @param target (int, optional): the version to migrate up to, all if not given
+    @return (list[int]): the versions that were applied
+    """
+    applied = applied_migrations(db)
+    newly_applied = []
+    for version, name, file_path in list_migrations(path):
+        if version in applied or (target is not None and version > target):
+            continue
+        with open(file_path, encoding="utf-8") as file:
+            statements = split_statements(file.read())
+        start = time.perf_counter()
+        for statement in statements:
+            db.execute(statement)
+        db.execute("INSERT INTO SchemaMigrations VALUES (%s, %s, %s);", (version, name, round(time.time() * 1000)))
+        print(f"Applied migration {version} {name} in {time.perf_counter() - start:.1f}s")
+        newly_applied.append(version)
+    return newly_applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog = 'migrate',
+                    description = 'Applies the migrations in sql/migrations to the PAGD database')
+    parser.add_argument('--host', default="localhost", help="host of the database")
+    parser.add_argument('--user', default="pagd", help="user of the database")
+    parser.add_argument('--database', default="pagd", help="name of the database")
+    parser.add_argument('-t', '--target', type=int, help="version to migrate up to, all by default")
+    parser.add_argument('-l', '--list', action='store_true', help="only list the migrations and whether they are applied")
+    args = parser.parse_args()
+
+    db = Database(args.host, 3306, args.user, getpass("Database password: "), args.database, pool_size=1)
+    if args.list:
+        applied = applied_migrations(db)
+        for version, name, _ in list_migrations():
+            print(f"{version:>4} {name:<40} {'applied' if version in applied else 'pending'}")
+    else:
+        applied = migrate(db, target=args.target)
+        print(f"Applied {len(applied)} migrations" if applied else "The database is up to date")
@@ -0,0 +1,178 @@
+import os
+import time
+import bisect
+from threading import Thread, Condition
+import firebase_admin
+from firebase_admin import credentials, messaging
+
+# Settings
+COALESCE_WINDOW = 0.2 # seconds a notification waits for newer updates of the same gunshot, which replace it
+MAX_BATCH = 500 # maximum number of messages sent in one request, the limit of Firebase Cloud Messaging
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000] # upper bounds in milliseconds of the latency histogram
+
+
+class FirebaseBackend:
+    """Sends messages with Firebase Cloud Messaging, using the credentials in the FIREBASE_CREDENTIALS environment variable"""
+
+    def __init__(self):
+        try:
+            firebase_admin.get_app()
+        except ValueError: # Not initialized yet in this process
+            cred = credentials.Certificate(os.environ["FIREBASE_CREDENTIALS"])
+            firebase_admin.initialize_app(cred)
+
+    def send_each(self, messages):
+        """
+        @param messages (list[messaging.Message]): the messages to send
+        @return (list[Exception]): None for each message that was sent, otherwise the reason it failed
+        """
+        response = messaging.send_each(messages)
+        return [None if r.success else r.exception for r in response.responses]
+
+
+class FakeBackend:
+    """Local stand-in for FirebaseBackend that records the messages instead of sending them"""
+
+    def __init__(self, latency = 0.0, per_message_latency = 0.0, failures = ()):
+        """
+        @param latency (float): seconds each request takes
+        @param per_message_latency (float): further seconds each message adds to a request
+        @param failures (set): gunshot IDs whose messages fail
+        """
+        self.latency = latency
+        self.per_message_latency = per_message_latency
+        self.failures = set(failures)
+        self.requests = 0
+        self.messages = []
+
+    def send_each(self, messages):
+        time.sleep(self.latency + self.per_message_latency * len(messages))
+        self.requests += 1
+        self.messages.extend(messages)
+        return [ValueError("failed by FakeBackend") if message.data.get("gunshot_id") in self.failures else None for message in messages]
+
+
+class NotificationDispatcher:
+    """
+    Sends gunshot notifications to the devices from a worker thread. A
+    notification waits up to COALESCE_WINDOW seconds, and a newer update of
+    the same gunshot replaces it rather than being sent as well. The waiting
+    notifications are then sent together in requests of up to MAX_BATCH.
+    """
+
+    def __init__(self, backend = None, window = COALESCE_WINDOW, max_batch = MAX_BATCH):
+        """
+        @param backend: sends the messages, defaults to FirebaseBackend
+        @param window (float): seconds to wait for newer updates of a gunshot, 0 sends as soon as possible
+        @param max_batch (int): maximum number of messages per request
+        """
+        self.backend = backend or FirebaseBackend()
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {} # gunshot ID -> [data, is update, time of the oldest notification], in the order they arrived
+        self.condition = Condition()
+        self.stopped = False
+
+        self.notifications = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.requests = 0
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.0
+
+        self.worker = Thread(target=self._dispatch, daemon=True)
+        self.worker.start()
+
+    def notify(self, gunshot, is_update = False):
+        """
+        Queue a notification about a new or updated gunshot
+        @param gunshot (dict): the gunshot as returned by the database
+        @param is_update (bool): whether devices were already notified about the gunshot
+        """
+        data = {k: str(v) for k, v in gunshot.items()}
+        with self.condition:
+            self.notifications += 1
+            pending = self.pending.get(data["gunshot_id"])
+            if pending is not None: # Replace the waiting notification, which is new unless both are updates
+                pending[0] = data
+                pending[1] = pending[1] and is_update
+                self.coalesced += 1
+                return
+            self.pending[data["gunshot_id"]] = [data, is_update, time.monotonic()]
+            self.condition.notify()
+
+    def close(self):
+        """Send the waiting notifications and stop the worker"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.worker.join()
+
+    def metrics(self):
+        """Return statistics of the notifications
+        @return (dict): number of notifications, how many were coalesced, sent and failed, and a histogram of the
+        milliseconds from the oldest coalesced notification until it was sent
+        """
+        with self.condition:
+            histogram = {f"<={bound}": count for bound, count in zip(LATENCY_BUCKETS, self.latencies)}
+            histogram[f">{LATENCY_BUCKETS[-1]}"] = self.latencies[-1]
+            delivered = self.sent + self.failed
+            return {
+                "notifications": self.notifications,
+                "pending": len(self.pending),
+                "coalesced": self.coalesced,
+                "sent": self.sent,
+                "failed": self.failed,
+                "requests": self.requests,
+                "avg_latency_ms": self.latency_total / delivered * 1000 if delivered else 0.0,
+                "latency_ms": histogram
+            }
+
+    def _next_batch(self):
+        """Wait until the oldest notification has waited the window, there is a full batch, or the dispatcher is stopped"""
+        with self.condition:
+            while True:
+                if self.pending:
+                    oldest = next(iter(self.pending.values()))[2]
+                    remaining = oldest + self.window - time.monotonic()
+                    if remaining <= 0 or len(self.pending) >= self.max_batch or self.stopped:
+                        break
+                    self.condition.wait(remaining)
+                elif self.stopped:
+                    return None
+                else:
+                    self.condition.wait()
+            batch = []
+            for gunshot_id in list(self.pending)[:self.max_batch]:
+                batch.append(self.pending.pop(gunshot_id))
+            return batch
+
+    def _dispatch(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            messages = []
+            for data, is_update, _ in batch:
+                data["update"] = "1" if is_update else "0"
+                messages.append(messaging.Message(data, topic="all"))
+            try:
+                errors = self.backend.send_each(messages)
+            except Exception as e:
+                errors = [e] * len(messages)
+            self._record(batch, errors)
+
+    def _record(self, batch, errors):
+        now = time.monotonic()
+        with self.condition:
+            self.requests += 1
+            for (data, _, enqueued_at), error in zip(batch, errors):
+                if error is None:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                    print(f"ERROR: Failed to notify devices about gunshot {data['gunshot_id']}.\n\t{str(error)}")
+                latency = now - enqueued_at
+                self.latency_total += latency
+                self.latencies[bisect.bisect_left(LATENCY_BUCKETS, latency * 1000)] += 1
@@ -4,3 +4,7 @@ class ObserverInterface(ABC):
     @abstractmethod
     def update(self, subject):
         pass
+
+    def update_batch(self, subjects):
+        for subject in subjects:
+            self.update(subject)
@@ -1,12 +1,18 @@
 import sys
-import json
-from database import Database
+import math
+import geopy.distance
+from database import Database, POOL_SIZE
 from pagdDB_interface import PagdDBInterface
 
+# Settings
+EQUATORIAL_RADIUS = 6378137.0 # meters, of the WGS-84 ellipsoid
+MIN_MERIDIAN_RADIUS = 6335439.0 # meters, the smallest radius of curvature of a meridian of the WGS-84 ellipsoid, at the equator
+BOUNDING_BOX_MARGIN = 1.01 # factor the bounding box of a radius search is widened by, so rounding never excludes a gunshot
+
 class PagdDB(Database, PagdDBInterface):
-    def __init__(self, host, user, password):
+    def __init__(self, host, user, password, pool_size = POOL_SIZE):
         try:
-            super().__init__(host, 3306, user, password, "pagd")
+            super().__init__(host, 3306, user, password, "pagd", pool_size)
         except Exception: # hack-fix... should be done properly
             print("Incorrect password")
             sys.exit(1)
@@ -23,12 +29,12 @@ class PagdDB(Database, PagdDBInterface):
         except:
             return None
         
-        return self.to_json(*result)
+        return self.to_json(*result, single=True)
 
     def get_gun(self, gun_name):
         """Search for a gun
         @param gun_name (string): the name of the gun
-        @return (json): a JSON object with the result
+        @return (json): a list with a JSON object per matching row
         """
         if gun_name is not None:
             query = "SELECT * FROM Guns WHERE name = %s LIMIT 1;"
@@ -54,9 +60,13 @@ class PagdDB(Database, PagdDBInterface):
         result = self.execute(query, (timestamp, coord_lat, coord_long, coord_alt, gun, client_id))
         # except Exception as e:
         #     return None
-        return self.to_json(*result, default=str)
+        return self.to_json(*result, single=True)
     
     def add_reports(self, values):
+        """Add multiple reports in bulk
+        @param values (list[tuple]): a list of (timestamp, coord_lat, coord_long, coord_alt, gun, client_id) tuples
+        @return (json): a JSON object with the newly added reports, in the same order as the given values
+        """
         query = """INSERT INTO Reports (timestamp, coord, altitude, gun, client_id) VALUES (%s, POINT(%s, %s), %s, %s, %s)
                 RETURNING report_id;"""
         # try:
@@ -67,31 +77,34 @@ class PagdDB(Database, PagdDBInterface):
         #     return None
 
         column_names = ["report_id", "timestamp", "coord_lat", "coord_long", "coord_alt", "gun", "client_id"]
-        return self.to_json(result, column_names, default=str)
+        return self.to_json(result, column_names)
 
-    def get_report(self, report_id):
-        """Search for a report
-        @param report_id (int): the report ID
-        @return (json): a JSON object with the result
+    def get_report(self, report_id, after_id = 0, limit = None, stream = False):
+        """Search for a report, or page through all reports in order of report ID
+        @param report_id (int): the report ID, or None for all reports
+        @param after_id (int, optional): only return reports with a greater report ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of reports to return
+        @param stream (bool, optional): return an iterator reading the rows from the database as it is iterated
+        @return (json): a list with a JSON object per matching row
         """
         if report_id is not None:
             query = "SELECT * FROM ReportsView WHERE report_id = %s;"
             result = self.execute(query, (report_id,)) # must create a tuple
-        else:
-            query = "SELECT * FROM ReportsView;"
-            result = self.execute(query)
+            return self.to_json(*result)
 
-        return self.to_json(*result, default=int)
+        return self._select_page("ReportsView", "report_id", [], (), after_id, limit, stream)
     
-    def get_report_range(self, time_from, time_to):
-        """Search for reports within a given range
+    def get_report_range(self, time_from, time_to, after_id = 0, limit = None, stream = False):
+        """Search for reports within a given range, in order of report ID
         @param time_from (int): UNIX timestamp of the start of the range
         @param time_to (int): UNIX timestamp of the beginning of the range
-        @return (json): a JSON object with the result
+        @param after_id (int, optional): only return reports with a greater report ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of reports to return
+        @param stream (bool, optional): return an iterator reading the rows from the database as it is iterated
+        @return (json): a list with a JSON object per matching row
         """
-        query = "SELECT * FROM ReportsView WHERE timestamp >= %s AND timestamp < %s;"
-        result = self.execute(query, (time_from, time_to))
-        return self.to_json(*result, default=int)
+        return self._select_page("ReportsView", "report_id", ["timestamp >= %s", "timestamp < %s"], (time_from, time_to),
+                                 after_id, limit, stream)
 
     def add_gunshot(self, gunshot_id, report_id, timestamp, coord_lat, coord_long, coord_alt, gun, shots_fired):
         """Add record of a determined gunshot event based on the given report
@@ -124,7 +137,7 @@ class PagdDB(Database, PagdDBInterface):
             return None
         
         # Return the gunshot which is the first element
-        return self.to_json(result[0], columns, default=str) or None
+        return self.to_json(result[0], columns, single=True)
         
     
     def add_temp_gunshot(self, gunshot_id, report_id, gun):
@@ -150,7 +163,7 @@ class PagdDB(Database, PagdDBInterface):
         except:
             return None
         # Return the gunshot which is the first element
-        return self.to_json(result[0], columns, default=str) or None
+        return self.to_json(result[0], columns, single=True)
     
     def add_gunshot_report_relation(self, gunshot_id, report_id):
         """Add a gunshot report relation
@@ -163,6 +176,19 @@ class PagdDB(Database, PagdDBInterface):
             result = self.execute(query, (gunshot_id, report_id))
         except:
             return None
+        return self.to_json(*result, single=True)
+    
+    def add_gunshot_report_relations(self, gunshot_id, report_ids):
+        """Add gunshot report relations in bulk
+        @param gunshot_id (int): the gunshot ID
+        @param report_ids (list[int]): the report IDs
+        @return json: a JSON object with the inserted values
+        """
+        query = "INSERT INTO GunshotReports VALUES (%s, %s) RETURNING *;"
+        try:
+            result = self.execute(query, [(gunshot_id, report_id) for report_id in report_ids])
+        except:
+            return None
         return self.to_json(*result)
     
     def update_gunshot(self, gunshot_id, timestamp, coord_lat, coord_long, coord_alt, gun, shots_fired):
@@ -190,36 +216,120 @@ class PagdDB(Database, PagdDBInterface):
         except:
             return None
         # Return the gunshot which is the second element
-        return self.to_json(result[1], columns, default=str) or None
+        return self.to_json(result[1], columns, single=True)
     
     def get_gunshot_by_id(self, gunshot_id):
         """Search for gunshots based on time or location (or both)
         @param gunshot_id (int): the gunshot ID
-        @return (json): a JSON object with the result
+        @return (json): a list with a JSON object per matching row
         """
         query = "SELECT * FROM GunshotsView WHERE gunshot_id = %s;"
         result = self.execute(query, (gunshot_id,)) # must create a tuple
-        return self.to_json(*result, default=int)
+        return self.to_json(*result)
     
-    def get_gunshots_by_timestamp(self, time_from, time_to):
-        """Search for gunshots within the given time range
+    def get_gunshots_by_timestamp(self, time_from, time_to, after_id = 0, limit = None, stream = False):
+        """Search for gunshots within the given time range, in order of gunshot ID
         @param time_from (int): UNIX timestamp of the start of the range
         @param time_to (int):   UNIX timestamp of the start of the range
-        @return (json): a JSON object with the result
+        @param after_id (int, optional): only return gunshots with a greater gunshot ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of gunshots to return
+        @param stream (bool, optional): return an iterator reading the rows from the database as it is iterated
+        @return (json): a list with a JSON object per matching row
         """
-        query = "SELECT * FROM GunshotsView WHERE timestamp >= %s AND timestamp < %s;"
-        result = self.execute(query, (time_from, time_to))
-        return self.to_json(*result, default=int)
+        return self._select_page("GunshotsView", "gunshot_id", ["timestamp >= %s", "timestamp < %s"], (time_from, time_to),
+                                 after_id, limit, stream)
     
-    def get_all_gunshots(self):
-        """Retrieve all gunshots
-        @return (json): a JSON object with the result
+    def get_all_gunshots(self, after_id = 0, limit = None, stream = False):
+        """Retrieve all gunshots, in order of gunshot ID
+        @param after_id (int, optional): only return gunshots with a greater gunshot ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of gunshots to return
+        @param stream (bool, optional): return an iterator reading the rows from the database as it is iterated
+        @return (json): a list with a JSON object per matching row
         """
-        query = "SELECT * FROM GunshotsView;"
-        result = self.execute(query)
-        return self.to_json(*result, default=int)
+        return self._select_page("GunshotsView", "gunshot_id", [], (), after_id, limit, stream)
+
+    def get_recent_reports(self, time_from, limit):
+        """Retrieve the most recent reports together with the gunshot they are related to, if any
+        @param time_from (int): UNIX timestamp of the oldest report to retrieve
+        @param limit (int): the maximum number of reports to retrieve
+        @return (list[tuple]): (report_id, timestamp, coord_lat, coord_long, coord_alt, gun, client_id, gunshot_id) tuples in order of timestamp
+        """
+        # Keep the most recent reports if there are more than the limit
+        query = """SELECT * FROM (
+                    SELECT R.report_id, R.timestamp, R.coord_lat, R.coord_long, R.coord_alt, R.gun, R.client_id, GR.gunshot_id
+                    FROM ReportsView AS R LEFT JOIN GunshotReports AS GR ON GR.report_id = R.report_id
+                    WHERE R.timestamp >= %s ORDER BY R.timestamp DESC LIMIT %s
+                ) AS Recent ORDER BY timestamp;"""
+        result, _ = self.execute(query, (time_from, limit))
+        return result
+
+    def get_gunshots_by_bounding_box(self, min_lat, min_long, max_lat, max_long, time_from = None, time_to = None, after_id = 0,
+                                     limit = None, stream = False):
+        """Search for gunshots within a range of latitudes and longitudes, optionally within a time range, in order of gunshot ID
+        @param min_lat (float): the southern latitude of the box
+        @param min_long (float): the western longitude of the box
+        @param max_lat (float): the northern latitude of the box
+        @param max_long (float): the eastern longitude of the box
+        @param time_from (int, optional): UNIX timestamp of the start of the range
+        @param time_to (int, optional): UNIX timestamp of the end of the range
+        @param after_id (int, optional): only return gunshots with a greater gunshot ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of gunshots to return
+        @param stream (bool, optional): return an iterator reading the rows from the database as it is iterated
+        @return (json): a list with a JSON object per matching row
+        """
+        # The box is a rectangle in the plane of latitudes and longitudes like the stored points, so the spatial index
+        # finds exactly the gunshots within it
+        box = f"POLYGON(({min_lat} {min_long}, {max_lat} {min_long}, {max_lat} {max_long}, {min_lat} {max_long}, {min_lat} {min_long}))"
+        conditions = ["ST_Intersects(L.coord, ST_GeomFromText(%s))"]
+        values = (box,)
+        if time_from is not None:
+            conditions.append("timestamp >= %s")
+            values += (time_from,)
+        if time_to is not None:
+            conditions.append("timestamp < %s")
+            values += (time_to,)
+        # Gunshots.coord is NULL until the position is determined, so the indexed points are kept in GunshotLocations
+        return self._select_page("GunshotLocations AS L FORCE INDEX (coord) JOIN GunshotsView AS G USING (gunshot_id)", "gunshot_id",
+                                 conditions, values, after_id, limit, stream, columns="G.*")
+
+    def get_gunshots_by_radius(self, coord_lat, coord_long, radius, time_from = None, time_to = None, after_id = 0, limit = None,
+                               stream = False):
+        """Search for gunshots within a distance of a location, optionally within a time range, in order of gunshot ID.
+        The spatial index finds the gunshots in a bounding box around the circle, which are then filtered by their
+        geodesic distance
+        @param coord_lat (float): the latitude coordinate of the center
+        @param coord_long (float): the longitude coordinate of the center
+        @param radius (float): the distance in meters
+        @param time_from (int, optional): UNIX timestamp of the start of the range
+        @param time_to (int, optional): UNIX timestamp of the end of the range
+        @param after_id (int, optional): only return gunshots with a greater gunshot ID, the last ID of the previous page
+        @param limit (int, optional): the maximum number of gunshots to return
+        @param stream (bool, optional): return an iterator reading the rows from the database as it is iterated
+        @return (json): a list with a JSON object per matching row
+        """
+        box = self._bounding_box(coord_lat, coord_long, radius)
+        center = (coord_lat, coord_long)
+        def within(gunshot):
+            return geopy.distance.geodesic(center, (gunshot["coord_lat"], gunshot["coord_long"])).m <= radius
+
+        if stream or limit is None:
+            result = self.get_gunshots_by_bounding_box(*box, time_from, time_to, after_id, limit, stream)
+            return self._filter_rows(result, within) if stream else [gunshot for gunshot in result if within(gunshot)]
 
-    # TODO: def get_gunshot_by_radius(self, midpoint_coord, radius):
+        # Keep reading pages of the box until the page of gunshots within the circle is full, so that the last gunshot
+        # of a full page is the start of the next page
+        gunshots = []
+        while len(gunshots) < limit:
+            page = self.get_gunshots_by_bounding_box(*box, time_from, time_to, after_id, limit)
+            for gunshot in page:
+                if within(gunshot):
+                    gunshots.append(gunshot)
+                    if len(gunshots) == limit:
+                        break
+            if len(page) < limit:
+                break
+            after_id = page[-1]["gunshot_id"]
+        return gunshots
     
     def get_latest_gunshot_id(self):
         """Get the most recent gunshot ID
@@ -229,30 +339,103 @@ class PagdDB(Database, PagdDBInterface):
         result = self.execute(query)
         return result[0][0][0] or 0
 
-    def to_json(self, rows, columns, default = None):
-        """Convert database results to a JSON object
-        @param rows (list): a list of tuples containing the query result
-        @param default (type): the type to cast to by default if unable to determine data type
-        @return (json): a JSON object with the query result
+    def reserve_ids(self, name, amount):
+        """Reserve a block of consecutive IDs from a counter. The counter is incremented atomically, so concurrent
+        reservations, also from other processes, never get overlapping blocks
+        @param name (string): the name of the counter, e.g. "gunshot"
+        @param amount (int): the number of IDs to reserve
+        @return (int): the first ID of the block, or None if the block could not be reserved
         """
-        # convert the list of tuples to a list of dictionaries
-        row_dicts = []
-        for row in rows:
-            row_dict = {}
-            for i in range(len(row)):
-                try:
-                    # get the name of the column and set its value in the dictionary
-                    row_dict[columns[i]] = row[i]
-                except IndexError:
-                    pass
-            row_dicts.append(row_dict)
-        json_str = json.dumps(row_dicts, default=default)
+        queries = []
+        values = []
 
-        # remove the wrapping array for single results
-        if len(row_dicts) == 1:
-            json_str = json_str[1:-1]
+        # LAST_INSERT_ID(expr) remembers the new value for this connection, so it can be read back without a race
+        queries.append("UPDATE IdCounters SET next_id = LAST_INSERT_ID(next_id + %s) WHERE name = %s;")
+        values.append((amount, name))
 
-        json_obj = json.loads(json_str)
-        
-        # convert the list of dictionaries to a JSON object
-        return json_obj
\ No newline at end of file
+        # ROW_COUNT() is 0 if the counter row does not exist, in which case LAST_INSERT_ID() is not the new value
+        queries.append("SELECT ROW_COUNT(), LAST_INSERT_ID() - %s;")
+        values.append((amount,))
+
+        try:
+            result, _ = self.execute_transaction(queries, values)
+            updated, first_id = result[1][0]
+        except:
+            return None
+        if updated != 1:
+            print(f"ERROR: Unable to reserve IDs.\n\tThe counter {name} does not exist in IdCounters, see sql/migrations")
+            return None
+        return first_id
+
+    def _bounding_box(self, coord_lat, coord_long, radius):
+        """Return a box of latitudes and longitudes containing every location within a distance of the center
+        @param coord_lat (float): the latitude coordinate of the center
+        @param coord_long (float): the longitude coordinate of the center
+        @param radius (float): the distance in meters
+        @return (tuple): the minimum latitude, minimum longitude, maximum latitude and maximum longitude
+        """
+        # Degrees per meter are largest where the meridian's radius of curvature is smallest, at the equator
+        lat_delta = math.degrees(radius / MIN_MERIDIAN_RADIUS) * BOUNDING_BOX_MARGIN
+        min_lat, max_lat = max(coord_lat - lat_delta, -90), min(coord_lat + lat_delta, 90)
+        # A parallel is shortest at the latitude of the box furthest from the equator
+        parallel_radius = EQUATORIAL_RADIUS * math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+        if parallel_radius <= 0 or radius / parallel_radius >= math.pi:
+            return (min_lat, -180, max_lat, 180)
+        long_delta = math.degrees(radius / parallel_radius) * BOUNDING_BOX_MARGIN
+        if coord_long - long_delta < -180 or coord_long + long_delta > 180: # Crosses the antimeridian
+            return (min_lat, -180, max_lat, 180)
+        return (min_lat, coord_long - long_delta, max_lat, coord_long + long_delta)
+
+    def _filter_rows(self, rows, keep):
+        """Filter an iterator of rows, closing the rows when it is closed"""
+        try:
+            for row in rows:
+                if keep(row):
+                    yield row
+        finally:
+            rows.close()
+
+    def _select_page(self, view, key, conditions, values, after_id, limit, stream, columns = "*"):
+        """Select the rows of a view matching the conditions, ordered by a unique key and starting after the given key
+        (keyset pagination), so each page is read from the index of the key rather than skipping the previous pages
+        @param view (string): the view to select from
+        @param key (string): the unique column to order and page by
+        @param conditions (list[string]): the conditions the rows must match. Use %s for parameters
+        @param values (tuple): the parameter values of the conditions
+        @param after_id (int): only select rows with a greater key
+        @param limit (int): the maximum number of rows to select, None for all
+        @param stream (bool): return an iterator reading the rows from the database as it is iterated
+        @param columns (string, optional): the columns to select
+        @return (json): a list with a JSON object per selected row, or an iterator of them if streaming
+        """
+        query = f"SELECT {columns} FROM {view} WHERE {' AND '.join(conditions + [f'{key} > %s'])} ORDER BY {key}"
+        values = values + (after_id,)
+        if limit is not None:
+            query += " LIMIT %s"
+            values += (limit,)
+        result = self.execute(query + ";", values, stream=stream)
+        return self.iter_json(*result) if stream else self.to_json(*result)
+
+    def iter_json(self, rows, columns):
+        """Convert database results to JSON serializable objects one row at a time, e.g. for rows streamed from the database
+        @param rows (iterable): the tuples containing the query result
+        @param columns (list): the name of each column
+        @return (iterator): a JSON object per row. Closing it closes the rows
+        """
+        try:
+            for row in rows:
+                yield dict(zip(columns, row))
+        finally:
+            if hasattr(rows, "close"):
+                rows.close()
+
+    def to_json(self, rows, columns, single = False):
+        """Convert database results to JSON serializable objects, built directly from the rows of the cursor
+        @param rows (list): a list of tuples containing the query result
+        @param columns (list): the name of each column
+        @param single (bool): return only the first row, for queries returning one row such as inserts
+        @return (json): a list with a JSON object per row, or the first row (None if there are no rows) if single is set
+        """
+        if single:
+            return dict(zip(columns, rows[0])) if rows else None
+        return [dict(zip(columns, row)) for row in rows]
@@ -14,11 +14,11 @@ class PagdDBInterface(ABC):
         pass
     
     @abstractmethod
-    def get_report(self, report_id):
+    def get_report(self, report_id, after_id = 0, limit = None, stream = False):
         pass
     
     @abstractmethod
-    def get_report_range(self, time_from, time_to):
+    def get_report_range(self, time_from, time_to, after_id = 0, limit = None, stream = False):
         pass
     
     @abstractmethod
@@ -29,6 +29,10 @@ class PagdDBInterface(ABC):
     def add_temp_gunshot(self, gunshot_id, report_id, gun):
         pass
     
+    @abstractmethod
+    def add_gunshot_report_relations(self, gunshot_id, report_ids):
+        pass
+    
     @abstractmethod
     def update_gunshot(self, gunshot_id, timestamp, coord_lat, coord_long, coord_alt, gun, shots_fired):
         pass
@@ -38,13 +42,31 @@ class PagdDBInterface(ABC):
         pass
     
     @abstractmethod
-    def get_gunshots_by_timestamp(self, time_from, time_to):
+    def get_gunshots_by_timestamp(self, time_from, time_to, after_id = 0, limit = None, stream = False):
+        pass
+    
+    @abstractmethod
+    def get_all_gunshots(self, after_id = 0, limit = None, stream = False):
         pass
     
     @abstractmethod
-    def get_all_gunshots(self):
+    def get_gunshots_by_bounding_box(self, min_lat, min_long, max_lat, max_long, time_from = None, time_to = None, after_id = 0,
+                                     limit = None, stream = False):
+        pass
+    
+    @abstractmethod
+    def get_gunshots_by_radius(self, coord_lat, coord_long, radius, time_from = None, time_to = None, after_id = 0, limit = None,
+                               stream = False):
+        pass
+    
+    @abstractmethod
+    def get_recent_reports(self, time_from, limit):
         pass
     
     @abstractmethod
     def get_latest_gunshot_id(self):
         pass
+    
+    @abstractmethod
+    def reserve_ids(self, name, amount):
+        pass
@@ -0,0 +1,255 @@
+import json
+import time
+import asyncio
+import urllib.parse as url_parser
+from collections import deque
+from threading import Thread, Lock
+import jwt
+
+# Settings
+PUSH_ADDRESS = ("localhost", 5001) # address of the push server streaming gunshots to subscribers
+FEED_HISTORY = 10000 # number of recent gunshot changes kept for subscribers resuming from a cursor
+KEEPALIVE = 15 # seconds between comments sent to idle subscribers, so that proxies do not close the connection
+HEADER_TIMEOUT = 10 # seconds a client has to send the request line and headers before it is disconnected
+MAX_HEADERS = 64 # header lines accepted in a request
+MAX_HEADER_SIZE = 8192 # bytes accepted in the request line and headers together
+STREAM_PATH = "/api/gunshots/stream"
+
+
+class GunshotFeed:
+    """
+    Recent changes of gunshots, published by the observer as gunshots are
+    stored or updated. Every change gets a sequence number, which
+    subscribers use as cursor to resume from.
+    """
+
+    def __init__(self, history = FEED_HISTORY):
+        """
+        @param history (int): number of recent changes kept
+        """
+        self.changes = deque(maxlen=history) # (sequence, gunshot ID, the change encoded as a Server-Sent Event)
+        self.sequence = 0
+        self.lock = Lock()
+        self.listeners = [] # called without arguments after every change, from the publishing thread
+
+    def publish(self, gunshot):
+        """
+        Add a change of a gunshot to the feed
+        @param gunshot (dict): the gunshot as returned by the database
+        """
+        data = json.dumps(gunshot, default=str)
+        with self.lock:
+            self.sequence += 1
+            # Encoded once here rather than for every subscriber
+            message = f"id: {self.sequence}\nevent: gunshot\ndata: {data}\n\n".encode("utf-8")
+            self.changes.append((self.sequence, int(gunshot["gunshot_id"]), message))
+        for listener in self.listeners:
+            listener()
+
+    def since(self, sequence = None, gunshot_id = None):
+        """
+        Return the changes after a cursor
+        @param sequence (int, optional): return the changes after this sequence number
+        @param gunshot_id (int, optional): return the latest change of each gunshot with a greater ID, if no sequence is given
+        @return (tuple): list of (sequence, gunshot ID, encoded event) and whether changes after the cursor were dropped from the
+        history, or the cursor is unknown, in which case the whole history is returned
+        """
+        with self.lock:
+            oldest = self.changes[0][0] if self.changes else self.sequence + 1
+            if sequence is not None:
+                if sequence > self.sequence: # A cursor from before the server restarted, when the sequence started over
+                    return list(self.changes), True
+                start = max(0, sequence + 1 - oldest)
+                return [self.changes[i] for i in range(start, len(self.changes))], sequence + 1 < oldest
+            if gunshot_id is not None:
+                latest = {change[1]: change for change in self.changes if change[1] > gunshot_id}
+                return sorted(latest.values()), False
+            return [], False
+
+    @property
+    def latest(self):
+        with self.lock:
+            return self.sequence
+
+
+class PushServer:
+    """
+    Streams gunshot changes to subscribers with Server-Sent Events, at
+    GET /api/gunshots/stream. All subscribers are served by an asyncio loop
+    on a single thread, waiting on one shared future that is completed on
+    every change or keepalive, so idle subscribers only cost an open socket.
+
+    A subscriber receives the changes after its cursor and then every new
+    change. The cursor is the Last-Event-ID header that EventSource sends
+    when reconnecting, or the query parameter last_event_id. Alternatively
+    after_id=<gunshot ID> sends the latest state of the newer gunshots in
+    the history first. If the history no longer reaches back to the cursor,
+    or the cursor is from before the server restarted, a "reset" event is
+    sent, after which the subscriber should fetch the gunshots from
+    GET /api/gunshots. As with the API, a JWT is required in the
+    Authorization header or, since EventSource can not set headers, in the
+    query parameter token.
+    """
+
+    def __init__(self, feed: GunshotFeed, secret_key, address = PUSH_ADDRESS, keepalive = KEEPALIVE):
+        """
+        @param feed (GunshotFeed): the feed to stream
+        @param secret_key (bytes): key the JWTs are signed with
+        @param address (tuple): host and port to listen on, port 0 picks a free port
+        @param keepalive (float): seconds between comments sent to idle subscribers
+        """
+        self.feed = feed
+        self.secret_key = secret_key
+        self.keepalive = keepalive
+        self.loop = asyncio.new_event_loop()
+        self.changed = None # completed and replaced on every change and keepalive
+        self.subscribers = 0
+        self.connections = 0
+        self.rejected = 0
+        self.sent = 0
+
+        # A line longer than the buffer limit makes readline raise ValueError rather than buffer it
+        self.server = self.loop.run_until_complete(asyncio.start_server(self._serve, *address, limit=MAX_HEADER_SIZE))
+        self.address = self.server.sockets[0].getsockname()[:2]
+        self.loop.call_later(self.keepalive, self._keepalive)
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        feed.listeners.append(self._on_change)
+
+    def close(self):
+        """Close the server and every subscription"""
+        self.feed.listeners.remove(self._on_change)
+        async def shutdown():
+            self.server.close()
+            subscriptions = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in subscriptions:
+                task.cancel()
+            await asyncio.gather(*subscriptions, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def metrics(self):
+        """Return statistics of the subscriptions
+        @return (dict): number of open subscriptions, accepted and rejected connections, and changes sent
+        """
+        return {
+            "subscribers": self.subscribers,
+            "connections": self.connections,
+            "rejected": self.rejected,
+            "sent": self.sent,
+            "latest_event_id": self.feed.latest
+        }
+
+    def _on_change(self):
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if self.changed is not None:
+            self.changed.set_result(None)
+            self.changed = None
+
+    def _keepalive(self):
+        # One timer for every subscriber rather than a timeout per subscriber
+        self._wake()
+        self.loop.call_later(self.keepalive, self._keepalive)
+
+    async def _wait_for_change(self):
+        if self.changed is None:
+            self.changed = self.loop.create_future()
+        await asyncio.shield(self.changed) # Cancelling one subscriber must not cancel the shared future
+
+    async def _serve(self, reader, writer):
+        try:
+            try:
+                request_line, headers = await asyncio.wait_for(self._read_request(reader), HEADER_TIMEOUT)
+            except asyncio.TimeoutError:
+                return await self._respond(writer, "408 Request Timeout")
+            except ValueError: # Too many or too large headers
+                return await self._respond(writer, "431 Request Header Fields Too Large")
+
+            if len(request_line) < 2 or request_line[0] != "GET":
+                return await self._respond(writer, "405 Method Not Allowed")
+            url = url_parser.urlsplit(request_line[1])
+            if url.path != STREAM_PATH:
+                return await self._respond(writer, "404 Not Found")
+            params = dict(url_parser.parse_qsl(url.query))
+            if not self._authorized(headers.get("authorization") or params.get("token")):
+                return await self._respond(writer, "401 Unauthorized")
+
+            last_event_id = headers.get("last-event-id") or params.get("last_event_id")
+            after_id = params.get("after_id")
+            try:
+                sequence = int(last_event_id) if last_event_id else None
+                gunshot_id = int(after_id) if after_id else None
+            except ValueError:
+                return await self._respond(writer, "400 Bad Request")
+            await self._stream(writer, sequence, gunshot_id)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass # Subscriber disconnected
+        except asyncio.CancelledError:
+            pass # Server closed
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Read the request line and headers, limited to MAX_HEADERS lines and MAX_HEADER_SIZE bytes
+        @return (tuple): the words of the request line and the headers by lowercase name
+        @raise ValueError: if the limits are exceeded
+        """
+        line = await reader.readline()
+        size = len(line)
+        request_line = line.decode("latin-1").split()
+        headers = {}
+        for _ in range(MAX_HEADERS + 1): # The headers and the empty line ending them
+            line = await reader.readline()
+            size += len(line)
+            if size > MAX_HEADER_SIZE:
+                break
+            line = line.decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                return request_line, headers
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise ValueError("request headers exceed the limits")
+
+    async def _stream(self, writer, sequence, gunshot_id):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n")
+        self.connections += 1
+        self.subscribers += 1
+        try:
+            if sequence is not None:
+                changes, reset = self.feed.since(sequence)
+            else: # Only new changes, after the latest state of the gunshots after gunshot_id if given
+                sequence = self.feed.latest
+                changes, reset = self.feed.since(gunshot_id=gunshot_id)
+            while True:
+                if reset: # The history no longer reaches back to the cursor
+                    writer.write(b"event: reset\ndata: {}\n\n")
+                    sequence = 0 # Continue from the returned changes, also if the cursor was ahead of the feed
+                for change_sequence, _, message in changes:
+                    writer.write(message)
+                    sequence = max(sequence, change_sequence)
+                self.sent += len(changes)
+                await writer.drain()
+                await self._wait_for_change()
+                changes, reset = self.feed.since(sequence)
+                if not changes and not reset:
+                    writer.write(b": keepalive\n\n")
+        finally:
+            self.subscribers -= 1
+
+    async def _respond(self, writer, status):
+        if status.startswith("401"):
+            self.rejected += 1
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode("latin-1"))
+        await writer.drain()
+
+    def _authorized(self, token):
+        if not token:
+            return False
+        try:
+            decoded_token = jwt.decode(token, self.secret_key, "HS256")
+            return decoded_token.get("exp", 0) >= round(time.time() * 1000)
+        except (jwt.InvalidTokenError, KeyError):
+            return False
@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+
+from gunshot import Position, GunshotReport, GunshotEvent
+
+
+def capture_events(events):
+    """
+    Capture the state of the live events, cheap enough to do while holding
+    the lock of the observer. Rows of the report arrays never change once
+    added, so the arrays are referenced rather than copied.
+
+    @param events: The live events, with the attributes set by GunshotObserver
+    @return: List of the state of each event, to pass to snapshot_arrays
+    """
+    return [(event.event_id, event.weapontype, event.size, *_columns(event), event.report_ids[:event.size],
+             None if event.pending_reports is None else list(event.pending_reports), event.persisted,
+             event.solved_version == event.version, event.estimate, event.position, event.timestamp, event.cost)
+            for event in events]
+
+
+def _columns(event):
+    """Coordinates, timestamps, client indices and client IDs of the reports of an event"""
+    if event.reports is not None: # No columns are kept for a few reports
+        clients = {}
+        client_indices = [clients.setdefault(report.clientid, len(clients)) for report in event.reports]
+        return [report.position.v for report in event.reports], [report.timestamp for report in event.reports], client_indices, list(clients)
+    return event.coordinates, event.timestamps, event.client_indices, list(event.client_ids)
+
+
+def snapshot_arrays(states, watermark):
+    """
+    Convert the captured state of the events into arrays, with one row per
+    event and one row per report
+
+    @param states: The states returned by capture_events
+    @param watermark: The latest report timestamp seen by the observer
+    @return: Dictionary of arrays to pass to save_snapshot
+    """
+    none = np.full(4, np.nan)
+    (event_ids, weapontypes, sizes, coordinates, timestamps, client_indices, client_ids, report_ids, pending, persisted,
+     solved, estimates, positions, event_timestamps, costs) = zip(*states) if states else [()] * 15
+    return {
+        "watermark": np.array(watermark, dtype=float),
+        # Events
+        "event_ids": np.array(event_ids, dtype=np.int64),
+        "weapontypes": np.array(weapontypes, dtype=str),
+        "sizes": np.array(sizes, dtype=np.int64),
+        "solved": np.array(solved, dtype=bool),
+        "estimates": np.array([(*estimate[0].v, estimate[1]) if estimate is not None else none for estimate in estimates], dtype=float).reshape(-1, 4),
+        "positions": np.array([position.v if position is not None else none[:3] for position in positions], dtype=float).reshape(-1, 3),
+        "timestamps": np.array([np.nan if timestamp is None else timestamp for timestamp in event_timestamps], dtype=float),
+        "costs": np.array([np.nan if cost is None else cost for cost in costs], dtype=float),
+        "has_persisted": np.array([state is not None for state in persisted], dtype=bool),
+        "persisted": np.array([[np.nan if value is None else value for value in state or (None,) * 5] for state in persisted], dtype=float).reshape(-1, 5),
+        "pending_counts": np.array([-1 if ids is None else len(ids) for ids in pending], dtype=np.int64),
+        "pending_ids": np.array([report_id for ids in pending if ids for report_id in ids], dtype=np.int64),
+        # Reports, in the order they were added to their event
+        "report_ids": np.array([report_id for ids in report_ids for report_id in ids], dtype=np.int64),
+        "report_coordinates": np.concatenate([c[:size] for c, size in zip(coordinates, sizes)]) if states else np.empty((0, 3)),
+        "report_timestamps": np.concatenate([t[:size] for t, size in zip(timestamps, sizes)]) if states else np.empty(0),
+        "report_clients": np.concatenate([np.array(ids, dtype=str)[indices[:size]] for ids, indices, size in zip(client_ids, client_indices, sizes)])
+                          if states else np.empty(0, dtype=str)
+    }
+
+
+def save_snapshot(path, arrays):
+    """
+    Write a snapshot to a compact binary file, an uncompressed NumPy archive.
+    The file is written next to path and then renamed, so a crash while
+    writing never leaves a partial snapshot behind.
+
+    @param path: Path of the snapshot file
+    @param arrays: The arrays returned by snapshot_arrays
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(temporary_path, path)
+
+
+def load_snapshot(path):
+    """
+    Read the events of a snapshot written by save_snapshot. The events are
+    rebuilt by adding their reports in the original order, and keep their
+    cached position estimates.
+
+    @param path: Path of the snapshot file
+    @return: Tuple of the list of events and the watermark of the snapshot
+    """
+    with np.load(path, allow_pickle=False) as snapshot:
+        arrays = {name: snapshot[name] for name in snapshot.files}
+
+    # Converting whole columns to lists at once is much faster than indexing the arrays per report
+    coordinates = arrays["report_coordinates"].tolist()
+    timestamps = arrays["report_timestamps"].tolist()
+    clients = arrays["report_clients"].tolist()
+    report_ids = arrays["report_ids"].tolist()
+    weapontypes = arrays["weapontypes"].tolist()
+
+    events = []
+    offsets = np.concatenate(([0], np.cumsum(arrays["sizes"]))).tolist()
+    pending_offset = 0
+    for i, event_id in enumerate(arrays["event_ids"].tolist()):
+        start, end = offsets[i], offsets[i + 1]
+        reports = [GunshotReport(Position(*coordinates[row]), timestamps[row], weapontypes[i], clients[row]) for row in range(start, end)]
+        event = GunshotEvent(reports[0])
+        for report in reports[1:]:
+            event.add_report(report)
+        event.event_id = event_id
+        event.report_ids = report_ids[start:end]
+
+        if not np.isnan(arrays["estimates"][i][0]):
+            latitude, longitude, altitude, timestamp = arrays["estimates"][i].tolist()
+            event.estimate = (Position(latitude, longitude, altitude), timestamp)
+        if arrays["solved"][i]: # Same reports added in the same order, so the same version
+            event.solved_version = event.version
+            event.position = None if np.isnan(arrays["positions"][i][0]) else Position(*arrays["positions"][i].tolist())
+            event.timestamp = None if np.isnan(arrays["timestamps"][i]) else arrays["timestamps"][i].item()
+            event.cost = None if np.isnan(arrays["costs"][i]) else arrays["costs"][i].item()
+
+        event.persisted = None
+        if arrays["has_persisted"][i]:
+            event.persisted = tuple(None if np.isnan(value) else value for value in arrays["persisted"][i].tolist())
+
+        count = arrays["pending_counts"][i]
+        event.pending_reports = None
+        if count >= 0:
+            event.pending_reports = arrays["pending_ids"][pending_offset:pending_offset + count].tolist()
+            pending_offset += count
+        events.append(event)
+    return events, arrays["watermark"].item()
@@ -0,0 +1,6 @@
+-- Searches by time range (get_report_range, get_gunshots_by_timestamp) and the recent reports recovered on start
+-- (get_recent_reports) filter on timestamp, which scanned the whole table. InnoDB appends the primary key to every
+-- secondary index, so these indexes also hold the report_id/gunshot_id the results are paged by, and the join from a
+-- report to its gunshot is covered by the UNIQUE (report_id) index of GunshotReports
+CREATE INDEX IF NOT EXISTS reports_timestamp ON Reports (timestamp);
+CREATE INDEX IF NOT EXISTS gunshots_timestamp ON Gunshots (timestamp);
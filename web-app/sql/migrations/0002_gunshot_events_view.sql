@@ -0,0 +1,6 @@
+-- GunshotEventsWithReports joined every gunshot with every report. Join them through GunshotReports instead, so the
+-- reports of a gunshot are found with the (gunshot_id, report_id) primary key and the gunshot of a report with the
+-- UNIQUE (report_id) index, both covering
+CREATE OR REPLACE VIEW GunshotEventsWithReports AS
+    SELECT G.gunshot_id, GR.report_id, G.timestamp, X(G.coord) AS coord_lat, Y(G.coord) AS coord_long, G.altitude AS coord_alt, G.gun, G.shots_fired
+    FROM Gunshots AS G JOIN GunshotReports AS GR ON GR.gunshot_id = G.gunshot_id;
@@ -0,0 +1,8 @@
+-- Gunshot IDs are reserved in blocks from IdCounters (see id_allocator.py). On an existing database the counter starts
+-- after the greatest gunshot ID, so reserved IDs never collide with stored gunshots
+CREATE TABLE IF NOT EXISTS IdCounters(
+    name    VARCHAR(255) PRIMARY KEY,
+    next_id INT NOT NULL
+);
+INSERT INTO IdCounters SELECT "gunshot", COALESCE(MAX(gunshot_id), 0) + 1 FROM Gunshots
+    ON DUPLICATE KEY UPDATE next_id = GREATEST(next_id, VALUES(next_id));
@@ -0,0 +1,27 @@
+-- Radius and bounding box searches read the spatial index of GunshotLocations, which the triggers keep in sync with
+-- the located gunshots. The locations of the gunshots stored before the triggers existed are copied once
+CREATE TABLE IF NOT EXISTS GunshotLocations(
+    gunshot_id INT PRIMARY KEY REFERENCES Gunshots,
+    coord      POINT NOT NULL,
+    SPATIAL INDEX (coord)
+);
+
+DELIMITER //
+CREATE OR REPLACE TRIGGER GunshotLocationsInsert AFTER INSERT ON Gunshots FOR EACH ROW
+BEGIN
+    IF NEW.coord IS NOT NULL THEN
+        REPLACE INTO GunshotLocations VALUES (NEW.gunshot_id, NEW.coord);
+    END IF;
+END //
+
+CREATE OR REPLACE TRIGGER GunshotLocationsUpdate AFTER UPDATE ON Gunshots FOR EACH ROW
+BEGIN
+    IF NEW.coord IS NOT NULL THEN
+        REPLACE INTO GunshotLocations VALUES (NEW.gunshot_id, NEW.coord);
+    ELSE
+        DELETE FROM GunshotLocations WHERE gunshot_id = NEW.gunshot_id;
+    END IF;
+END //
+DELIMITER ;
+
+REPLACE INTO GunshotLocations SELECT gunshot_id, coord FROM Gunshots WHERE coord IS NOT NULL;
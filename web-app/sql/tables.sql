@@ -33,6 +33,24 @@ CREATE OR REPLACE TABLE GunshotReports(
     PRIMARY KEY (gunshot_id, report_id)
 );
 
+-- Location of every gunshot with a determined position. Gunshots.coord is NULL until then, and a SPATIAL INDEX
+-- requires a NOT NULL column, so the locations are copied here by the triggers below
+CREATE OR REPLACE TABLE GunshotLocations(
+    gunshot_id INT PRIMARY KEY REFERENCES Gunshots,
+    coord      POINT NOT NULL,
+    SPATIAL INDEX (coord)
+);
+
+-- Counters of IDs that are allocated in blocks by the application, see id_allocator.py
+CREATE OR REPLACE TABLE IdCounters(
+    name    VARCHAR(255) PRIMARY KEY,
+    next_id INT NOT NULL
+);
+INSERT INTO IdCounters SELECT "gunshot", COALESCE(MAX(gunshot_id), 0) + 1 FROM Gunshots; -- as in migration 0003
+
+-- The recreated tables have none of the migrations in sql/migrations applied, see migrate.py
+DROP TABLE IF EXISTS SchemaMigrations;
+
 -- Views --
 CREATE OR REPLACE VIEW ReportsView AS
     SELECT report_id, timestamp, X(coord) AS coord_lat, Y(coord) AS coord_long, altitude AS coord_alt, gun, client_id
@@ -45,3 +63,22 @@ CREATE OR REPLACE VIEW GunshotsView AS
 CREATE OR REPLACE VIEW GunshotEventsWithReports AS
     SELECT G.gunshot_id, R.report_id, G.timestamp, X(G.coord) AS coord_lat, Y(G.coord) AS coord_long, G.altitude AS coord_alt, G.gun, G.shots_fired
     FROM Gunshots AS G, Reports AS R;
+
+-- Triggers --
+DELIMITER //
+CREATE OR REPLACE TRIGGER GunshotLocationsInsert AFTER INSERT ON Gunshots FOR EACH ROW
+BEGIN
+    IF NEW.coord IS NOT NULL THEN
+        REPLACE INTO GunshotLocations VALUES (NEW.gunshot_id, NEW.coord);
+    END IF;
+END //
+
+CREATE OR REPLACE TRIGGER GunshotLocationsUpdate AFTER UPDATE ON Gunshots FOR EACH ROW
+BEGIN
+    IF NEW.coord IS NOT NULL THEN
+        REPLACE INTO GunshotLocations VALUES (NEW.gunshot_id, NEW.coord);
+    ELSE
+        DELETE FROM GunshotLocations WHERE gunshot_id = NEW.gunshot_id;
+    END IF;
+END //
+DELIMITER ;
@@ -12,3 +12,7 @@ class SubjectInterface(ABC):
     @abstractmethod
     def notify(self, report):
         pass
+
+    @abstractmethod
+    def notify_batch(self, reports):
+        pass
@@ -5,7 +5,7 @@ url = "https://lukas.tottes.net"
     
 class Test:
     def __init__(self, start_timestamp, max_timestamp_error = 100, max_position_error = 15, client_amount = (4,8),
-                 client_distance = (50,500), client_heard = 0.9, local = False, got = False):
+                 client_distance = (50,500), client_heard = 0.9, local = False, got = False, client_bearing = (0,360)):
         self.start_timestamp = start_timestamp
         self.gunshots_fired = 0
         self.max_timestamp_error = max_timestamp_error
@@ -13,6 +13,7 @@ class Test:
         self.client_amount = client_amount
         self.client_distance = client_distance
         self.client_heard = client_heard
+        self.client_bearing = client_bearing
         self.local = local
         if got:
             self.gunshot_lat, self.gunshot_long = random.uniform(57.624, 57.775), random.uniform(11.89, 12.165)
@@ -51,10 +52,11 @@ class Test:
         if len(event) == 0:
             print("Could not find event")
             return None
-        if isinstance(event, list):
+        if len(event) > 1:
             print("Too many events")
             return None
         
+        event = event[0] # Searches always return a list
         event_pos = Position(event["coord_lat"], event["coord_long"], event["coord_alt"])
         print(f"Error in meters: {self.gunshot_pos.distance(event_pos)}")
         return self.gunshot_pos.distance(event_pos)
@@ -74,7 +76,7 @@ class Client:
         self.first_report = True
 
         self.true_pos = test.gunshot_pos.shift(random.uniform(*test.client_distance), 
-                                                               theta=random.uniform(0,360),
+                                                               theta=random.uniform(*test.client_bearing),
                                                                phi=random.uniform(-10,10))
         self.gps_pos = self.true_pos.shift(random.uniform(0,test.max_position_error), 
                                                                theta=random.uniform(0,360),